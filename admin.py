@@ -0,0 +1,24 @@
+"""Access control for operational endpoints.
+
+Admin routes are disabled (404) unless ADMIN_TOKEN is set, and then require
+it in an ``X-Admin-Token`` header.
+"""
+import hmac
+import os
+
+from fastapi import HTTPException, Request
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+
+def is_admin(request: Request):
+    token = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def require_admin(request: Request):
+    """FastAPI dependency guarding admin routes."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin token required")
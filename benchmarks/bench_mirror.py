@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""End-to-end mirror benchmarks against a local stub origin.
+
+    python benchmarks/bench_mirror.py [--requests 200] [--concurrency 20]
+                                      [--output results.json] [--compare previous.json]
+
+The app runs in-process (httpx over ASGITransport) with its own temporary
+cache, rate-limit and metrics files; the origin is a uvicorn server on
+127.0.0.1 serving a generated corpus of HTML, CSS, JS and binary pages, so
+runs are repeatable and need no network.  Scenarios:
+
+    cold_miss            every request is a first fetch of a distinct URL
+    warm_hit             the same URLs again, served from the cache
+    large_html           a ~600KB page, cached, with fiddle injection
+    large_binary         a 2MB binary, cached
+    concurrent_same_url  --concurrency clients asking for one new URL at once
+
+Each scenario reports throughput and p50/p95/p99 latency.  Results are
+written as JSON; --compare prints the change against an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+FIDDLE = "cats-d8c4vu"
+
+
+def isolate_environment(directory):
+    """Point every on-disk store at directory and lift limits that would skew the numbers."""
+    os.environ["CACHE_DB_PATH"] = os.path.join(directory, "cache.db")
+    os.environ["RATE_LIMIT_DB"] = os.path.join(directory, "ratelimit.db")
+    os.environ["METRICS_DIR"] = os.path.join(directory, "metrics")
+    os.environ["COSTLOG_PATH"] = ""
+    for name in ("RATE_LIMIT_IP_BURST", "RATE_LIMIT_IP_RATE", "RATE_LIMIT_FIDDLE_BURST", "RATE_LIMIT_FIDDLE_RATE"):
+        os.environ[name] = "1000000000"
+    # Background subresource prefetches would turn later "cold" requests into hits.
+    os.environ["PREFETCH_MAX_PENDING"] = "0"
+    for name in ("LOADSHED_DEGRADE_LAG", "LOADSHED_SHED_LAG", "LOADSHED_DEGRADE_INFLIGHT", "LOADSHED_SHED_INFLIGHT"):
+        os.environ[name] = "1000000"
+
+
+def html_page(index, paragraphs=20):
+    rng = random.Random(index)
+    words = ["proxy", "fiddle", "cache", "style", "script", "origin", "latency", "browser", "page", "edit"]
+    body = "\n".join("<p>%s</p>" % " ".join(rng.choice(words) for _ in range(60)) for _ in range(paragraphs))
+    return ("""<!DOCTYPE html><html><head><title>Page %d</title>
+<link rel="stylesheet" href="/static/site-%d.css"><script src="/static/app-%d.js"></script>
+</head><body><h1>Page %d</h1><a href="http://example.com/about">about</a><img src="/img/%d.png">
+%s</body></html>""" % (index, index, index, index, index, body)).encode("utf-8")
+
+
+def build_corpus(pages):
+    corpus = {}
+    for i in range(pages):
+        corpus["/page-%d.html" % i] = ("text/html; charset=utf-8", html_page(i))
+        corpus["/static/site-%d.css" % i] = ("text/css", (".c%d { color: red; background: url(/img/%d.png) }\n"
+                                                           % (i, i)).encode() * 200)
+        corpus["/static/app-%d.js" % i] = ("application/javascript", b"console.log('hi');\n" * 500)
+        corpus["/img/%d.png" % i] = ("image/png", os.urandom(20000))
+    corpus["/large.html"] = ("text/html; charset=utf-8", html_page(10 ** 6, paragraphs=1500))
+    corpus["/large.bin"] = ("application/octet-stream", os.urandom(2 * 1024 * 1024))
+    return corpus
+
+
+class StubOrigin(object):
+    """Serves a fixed corpus from a uvicorn server running in a background thread."""
+
+    def __init__(self, corpus, delay=0.0):
+        self.corpus = corpus
+        self.delay = delay
+        self.hits = {}
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.host = "127.0.0.1:%d" % self.port
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path = scope["path"]
+        self.hits[path] = self.hits.get(path, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        page = self.corpus.get(path)
+        status, content_type, body = (200,) + page if page else (404, "text/plain", b"not found")
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", content_type.encode()),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+
+    def start(self):
+        import uvicorn
+        self.server = uvicorn.Server(uvicorn.Config(self, host="127.0.0.1", port=self.port, log_level="error",
+                                                    lifespan="off"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(5)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_scenario(client, paths, concurrency):
+    """Request every path once with at most concurrency in flight; returns summary stats."""
+    latencies = []
+    statuses = {}
+    queue = list(reversed(paths))
+    total_bytes = 0
+
+    async def worker():
+        nonlocal total_bytes
+        while queue:
+            path = queue.pop()
+            start = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            total_bytes += len(response.content)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mb_per_s": round(total_bytes / elapsed / 1e6, 2),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+async def run_benchmarks(origin, requests, concurrency):
+    import httpx
+    from main import app
+
+    def url(path):
+        return "/%s/%s%s" % (FIDDLE, origin.host, path)
+
+    pages = sorted(p for p in origin.corpus if p.startswith(("/page-", "/static/", "/img/")))
+    cold_paths = [url(p) for p in pages[:requests]]
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        results["cold_miss"] = await run_scenario(client, cold_paths, concurrency)
+        results["warm_hit"] = await run_scenario(client, cold_paths, concurrency)
+
+        for name, path in (("large_html", "/large.html"), ("large_binary", "/large.bin")):
+            await client.get(url(path))
+            # Large bodies are only admitted to the cache on their second request.
+            await client.get(url(path))
+            results[name] = await run_scenario(client, [url(path)] * max(10, requests // 10), concurrency)
+
+        origin.delay = 0.05
+        same = "/static/app-0.js?bench=%d" % time.time_ns()
+        before = origin.hits.get("/static/app-0.js", 0)
+        results["concurrent_same_url"] = await run_scenario(client, [url(same)] * concurrency, concurrency)
+        # GET + the HEAD redirect probe: 2 origin requests means the fill was coalesced.
+        results["concurrent_same_url"]["origin_requests"] = origin.hits.get("/static/app-0.js", 0) - before
+        origin.delay = 0.0
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=str(ROOT),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    print("\n%-20s %14s %14s" % ("vs previous", "throughput", "p95"))
+    for name, result in current["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        print("%-20s %+13.1f%% %+13.1f%%" % (
+            name,
+            100.0 * (result["throughput_rps"] - old["throughput_rps"]) / (old["throughput_rps"] or 1),
+            100.0 * (result["p95_ms"] - old["p95_ms"]) / (old["p95_ms"] or 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        isolate_environment(tmp)
+        origin = StubOrigin(build_corpus(pages=max(1, args.requests // 4 + 1)))
+        origin.start()
+        try:
+            scenarios = asyncio.run(run_benchmarks(origin, args.requests, args.concurrency))
+        finally:
+            origin.stop()
+
+    results = {
+        "benchmark": "mirror",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "parameters": {"requests": args.requests, "concurrency": args.concurrency},
+        "scenarios": scenarios,
+    }
+    print("%-20s %9s %9s %9s %9s %9s" % ("scenario", "req/s", "p50 ms", "p95 ms", "p99 ms", "MB/s"))
+    for name, r in scenarios.items():
+        print("%-20s %9.1f %9.2f %9.2f %9.2f %9.2f" % (name, r["throughput_rps"], r["p50_ms"], r["p95_ms"],
+                                                      r["p99_ms"], r["mb_per_s"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Compare fiddle saves/lookups per second: connect-per-call vs the pooled layer.
+
+    python benchmarks/bench_models.py [iterations]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import models
+from db import ConnectionPool
+from models import Fiddle
+
+
+def legacy_save(path, obj):
+    # The original models.Fiddle.save: new connection, SELECT then UPDATE or INSERT.
+    conn = sqlite3.connect(path)
+    with conn:
+        row = conn.execute("SELECT id FROM fiddles WHERE id=?", (obj.id,)).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE fiddles SET title=?, description=?, start_url=?, script=?, style=?, script_language=?, "
+                "style_language=?, updated=CURRENT_TIMESTAMP WHERE id=?",
+                (obj.title, obj.description, obj.start_url, obj.script, obj.style,
+                 obj.script_language, obj.style_language, obj.id))
+        else:
+            conn.execute(
+                "INSERT INTO fiddles (id, title, description, start_url, script, style, script_language, "
+                "style_language) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (obj.id, obj.title, obj.description, obj.start_url, obj.script, obj.style,
+                 obj.script_language, obj.style_language))
+    conn.close()
+
+
+def legacy_by_id(path, fiddle_id):
+    conn = sqlite3.connect(path)
+    row = conn.execute(models.FIDDLE_BY_ID_SQL, (fiddle_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def rate(label, fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print("%-28s %10.0f ops/s" % (label, iterations / elapsed))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        models.pool = ConnectionPool(legacy_path, schema=models.create_schema)
+        models.init_db()
+        models.pool.close_all()
+        models.pool = ConnectionPool(os.path.join(tmp, "pooled.db"), schema=models.create_schema)
+        models.init_db()
+
+        fiddle = lambda i: Fiddle(id="f%d" % (i % 500), title="t%d" % i, script="s" * 200)
+        rate("legacy saves", lambda i: legacy_save(legacy_path, fiddle(i)), iterations)
+        rate("pooled upsert saves", lambda i: Fiddle.save(fiddle(i)), iterations)
+        rate("legacy lookups", lambda i: legacy_by_id(legacy_path, "f%d" % (i % 500)), iterations)
+        rate("pooled lookups", lambda i: Fiddle.byId("f%d" % (i % 500)), iterations)
+        models.pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Fiddle search over a synthetic table: LIKE scan vs FTS5, and OFFSET vs cursor pages.
+
+    python benchmarks/bench_search.py [--fiddles 1000000] [--db search.db] [--depth 50]
+
+Builds --fiddles fiddles of made-up words (a few very common, most rare, the
+way real text is) through the same schema and triggers as the app, then
+times a few kinds of query.  With --db the table is kept and reused by
+later runs of the same size; building a million fiddles takes a minute or two.
+For each query it prints the time to the first page with LIKE (unranked, so
+it stops at the first page of matches and only scans the whole table for
+rare words) and with FTS, and to page --depth with OFFSET and with the
+keyset cursor Fiddle.search uses ("nan" when there are fewer pages).
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import models
+from db import ConnectionPool
+from models import Fiddle
+
+PAGE = 20
+VOCABULARY = 20000
+
+LIKE_SQL = """SELECT id, title, description, start_url FROM fiddles
+    WHERE title LIKE ?1 OR description LIKE ?1 OR script LIKE ?1 LIMIT ?2"""
+OFFSET_SQL = """SELECT f.id, f.title, f.description, f.start_url FROM (
+        SELECT rowid, rank FROM fiddles_fts WHERE fiddles_fts MATCH ? ORDER BY rank, rowid LIMIT ? OFFSET ?
+    ) AS m JOIN fiddles f ON f.rowid = m.rowid ORDER BY m.rank, m.rowid"""
+
+
+def make_words(rng, count=VOCABULARY):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def build(path, fiddles, seed=1):
+    rng = random.Random(seed)
+    words = make_words(rng)
+    # Zipf: the k-th word is 1/k as common as the first.
+    cum_weights, total = [], 0.0
+    for k in range(1, len(words) + 1):
+        total += 1.0 / k
+        cum_weights.append(total)
+
+    def text(n):
+        return " ".join(rng.choices(words, cum_weights=cum_weights, k=n))
+
+    conn = sqlite3.connect(path)
+    models.create_schema(conn)
+    start = time.perf_counter()
+    with conn:
+        for batch in range(0, fiddles, 10000):
+            conn.executemany(
+                "INSERT INTO fiddles (id, title, description, start_url, script) VALUES (?, ?, ?, ?, ?)",
+                [("%x" % i, text(rng.randint(2, 6)), text(rng.randint(5, 30)), "https://example.com/%d" % i,
+                  text(rng.randint(10, 60))) for i in range(batch, min(batch + 10000, fiddles))])
+    conn.execute("INSERT INTO fiddles_fts (fiddles_fts) VALUES ('optimize')")
+    conn.close()
+    print("built %d fiddles in %.1f s, %.0f MB" % (fiddles, time.perf_counter() - start,
+                                                    os.path.getsize(path) / 1e6))
+    return words
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def bench_query(label, text, depth):
+    with models.pool.connection() as conn:
+        like_ms, _ = timed(lambda: conn.execute(LIKE_SQL, ("%" + text.split()[0] + "%", PAGE)).fetchall())
+        query = models.search_query(text)
+        matches = conn.execute("SELECT count(*) FROM fiddles_fts WHERE fiddles_fts MATCH ?", (query,)).fetchone()[0]
+        offset_ms, _ = timed(lambda: conn.execute(OFFSET_SQL, (query, PAGE, PAGE * depth)).fetchall())
+    first_ms, (_, cursor) = timed(lambda: Fiddle.search(text, None, PAGE))
+    page = 0
+    while cursor is not None and page < depth - 1:
+        cursor = Fiddle.search(text, cursor, PAGE)[1]
+        page += 1
+    cursor_ms, _ = timed(lambda: Fiddle.search(text, cursor, PAGE)) if cursor else (float("nan"), None)
+    print("%-22s %9d %9.2f %9.2f %11.2f %11.2f" % (label, matches, like_ms, first_ms, offset_ms, cursor_ms))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fiddles", type=int, default=1000000)
+    parser.add_argument("--db", help="keep the synthetic table in this file and reuse it")
+    parser.add_argument("--depth", type=int, default=50, help="page to time OFFSET and cursor paging at")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, "search.db")
+        rng = random.Random(1)
+        if os.path.exists(path) and sqlite3.connect(path).execute(
+                "SELECT count(*) FROM fiddles").fetchone()[0] == args.fiddles:
+            words = make_words(rng)
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            words = build(path, args.fiddles)
+        models.pool = ConnectionPool(path, schema=models.create_schema)
+
+        print("%-22s %9s %9s %9s %11s %11s" % ("query", "matches", "like ms", "fts ms", "offset p%d" % args.depth,
+                                               "cursor p%d" % args.depth))
+        bench_query("common word", words[1], args.depth)
+        bench_query("mid word", words[200], args.depth)
+        bench_query("rare word", words[-1], args.depth)
+        bench_query("two words", "%s %s" % (words[3], words[40]), args.depth)
+        bench_query("prefix", words[5][:2], args.depth)
+        models.pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""Replay recorded traffic against the app with a recorded upstream.
+
+    python benchmarks/replay.py logs/costlog.jsonl* [--store upstream.db] [--record]
+                                [--concurrency 20 | --rate 100] [--limit N]
+                                [--interval 5] [--output results.json]
+
+Requests are read from cost logs (costlog.py's JSON lines) or from common /
+combined format access logs, in file order; only GET and HEAD requests are
+replayed.  The app runs in-process with its own temporary cache, so a replay
+starts cold and warms up the way production does after a deploy.
+
+The upstream side is served from a SQLite store of recorded responses keyed
+by normalized URL.  With --record, URLs missing from the store are fetched
+from the real origin once and saved, so later runs need no network.  URLs
+that were never recorded get a synthetic body of the logged type and size,
+which is enough to exercise the cache and injection paths at realistic sizes.
+
+Load is either closed-loop (--concurrency clients, each sending its next
+request when the last one finishes) or open-loop (--rate requests per second
+regardless of how fast the app answers; latency is measured from when each
+request was due, so queueing delay is counted).  Every --interval seconds a
+line is printed with throughput, latency percentiles, the cache hit ratio
+and the process's resident memory; the timeline and a summary are written
+as JSON with --output.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import platform
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent))
+from bench_mirror import ROOT, git_revision, isolate_environment, percentile
+
+# 127.0.0.1 - - [10/Oct/2024:13:55:36 +0000] "GET /path?q=1 HTTP/1.1" 200 2326 ...
+_ACCESS_LOG_RE = re.compile(r'"(?P<method>[A-Z]+) (?P<target>\S+)(?: HTTP/[\d.]+)?" (?P<status>\d{3}) '
+                            r'(?P<bytes>\d+|-)')
+REPLAY_METHODS = ("GET", "HEAD")
+# Internal endpoints whose traffic says nothing about serving pages.
+SKIP_PREFIXES = ("/_admin/", "/_peer/", "/metrics")
+SYNTHETIC_DEFAULT_BYTES = 2048
+# Response headers that don't describe the stored (already decoded) body.
+_DROP_HEADERS = frozenset(["content-length", "content-encoding", "transfer-encoding", "connection",
+                           "keep-alive"])
+
+
+def parse_line(line):
+    """A request dict (method, path, query, status, bytes, type) from a log line, or None."""
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith("{"):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        if not record.get("path"):
+            return None
+        return {"method": record.get("method", "GET"), "path": record["path"], "query": record.get("query", ""),
+                "status": record.get("status"), "bytes": record.get("bytes"), "type": record.get("type")}
+    match = _ACCESS_LOG_RE.search(line)
+    if match is None:
+        return None
+    path, _, query = match.group("target").partition("?")
+    size = match.group("bytes")
+    return {"method": match.group("method"), "path": path, "query": query, "status": int(match.group("status")),
+            "bytes": None if size == "-" else int(size), "type": None}
+
+
+def load_requests(paths, limit=None):
+    requests = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                request = parse_line(line)
+                if (request is None or request["method"] not in REPLAY_METHODS
+                        or request["path"].startswith(SKIP_PREFIXES)):
+                    continue
+                requests.append(request)
+                if limit and len(requests) >= limit:
+                    return requests
+    return requests
+
+
+def store_key(url):
+    from mirror.url_normalize import normalize_url
+    return normalize_url(url).split("://", 1)[-1]
+
+
+def upstream_url(path, query=""):
+    """The origin URL the mirror fetches for path, or None if path isn't a mirror path."""
+    parts = path.split("/", 3)
+    # /{fiddle_name}/{host}/...; fiddle names always contain a dash and hosts a dot or port.
+    if len(parts) < 3 or "-" not in parts[1] or not any(c in parts[2] for c in ".:"):
+        return None
+    return "http://" + path.split("/", 2)[2] + ("?" + query if query else "")
+
+
+def upstream_hints(requests):
+    """Logged content type and size per upstream URL, for synthesizing unrecorded responses."""
+    hints = {}
+    for request in requests:
+        url = upstream_url(request["path"], request["query"])
+        if url is not None and (request["status"] or 200) < 400:
+            hints.setdefault(store_key(url), (request["type"], request["bytes"]))
+    return hints
+
+
+def synthetic_body(content_type, size):
+    size = size or SYNTHETIC_DEFAULT_BYTES
+    if content_type == "text/html":
+        head = b"<!DOCTYPE html><html><head><title>replay</title></head><body>"
+        tail = b"</body></html>"
+        paragraph = b"<p>recorded traffic replay filler text</p>\n"
+        count = max(0, size - len(head) - len(tail)) // len(paragraph) + 1
+        return head + paragraph * count + tail
+    if content_type and content_type.startswith("text/") or content_type in ("application/javascript",
+                                                                             "application/json"):
+        return (b"/* replay */\n" * (size // 13 + 1))[:size]
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+
+class ResponseStore(object):
+    """Recorded upstream responses in SQLite, keyed by store_key(url)."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                recorded INTEGER
+            )
+        """)
+
+    def get(self, key):
+        row = self.conn.execute("SELECT status, headers, body FROM responses WHERE url = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def put(self, key, status, headers, body):
+        self.conn.execute("INSERT OR REPLACE INTO responses (url, status, headers, body, recorded) "
+                          "VALUES (?, ?, ?, ?, ?)", (key, status, json.dumps(headers), body, int(time.time())))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def make_transport(store, hints, record=False):
+    """An httpx transport answering from store, recording or synthesizing what it lacks."""
+    import httpx
+
+    class ReplayTransport(httpx.AsyncBaseTransport):
+        def __init__(self):
+            self.live = httpx.AsyncHTTPTransport() if record else None
+            self.counters = {"stored": 0, "recorded": 0, "synthetic": 0, "missing": 0}
+
+        async def handle_async_request(self, request):
+            key = store_key(str(request.url))
+            stored = store.get(key)
+            if stored is not None:
+                self.counters["stored"] += 1
+            elif self.live is not None:
+                response = await self.live.handle_async_request(request)
+                try:
+                    body = await response.aread()
+                finally:
+                    await response.aclose()
+                headers = [[k, v] for k, v in response.headers.multi_items() if k.lower() not in _DROP_HEADERS]
+                if request.method == "GET":
+                    store.put(key, response.status_code, headers, body)
+                self.counters["recorded"] += 1
+                stored = (response.status_code, headers, body)
+            elif key in hints:
+                content_type, size = hints[key]
+                self.counters["synthetic"] += 1
+                stored = (200, [["content-type", content_type or "application/octet-stream"]],
+                          synthetic_body(content_type, size))
+            else:
+                self.counters["missing"] += 1
+                stored = (404, [["content-type", "text/plain"]], b"not recorded")
+            status, headers, body = stored
+            return httpx.Response(status, headers=headers, content=b"" if request.method == "HEAD" else body,
+                                  request=request)
+
+        async def aclose(self):
+            if self.live is not None:
+                await self.live.aclose()
+
+    return ReplayTransport()
+
+
+def rss_bytes():
+    """Resident memory of this process (the app runs in it)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Linux reports ru_maxrss in KB, macOS in bytes; this is the peak, not current.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class ReplayStats(object):
+    """Client-side latencies plus the cache outcome the app annotated on each request."""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.bytes = 0
+        self.hits = 0
+        self.lookups = 0
+        self.started = time.perf_counter()
+        self._window_start = 0
+        self._window_hits = 0
+        self._window_lookups = 0
+        self._window_time = self.started
+        self.timeline = []
+
+    def record_request(self, timing, status, content_type, body_bytes):
+        """timing.request_listeners hook."""
+        cache = timing.tags.get("cache")
+        if cache in ("hit", "miss", "peer"):
+            self.lookups += 1
+            self.hits += cache == "hit"
+
+    def add(self, latency, status, size):
+        self.latencies.append(latency)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        self.bytes += size
+
+    def sample(self, in_flight=0):
+        now = time.perf_counter()
+        window = sorted(self.latencies[self._window_start:])
+        lookups = self.lookups - self._window_lookups
+        elapsed = now - self._window_time
+        point = {
+            "t": round(now - self.started, 2),
+            "requests": len(window),
+            "throughput_rps": round(len(window) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(window, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(window, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(window, 0.99) * 1000, 2),
+            "hit_ratio": round((self.hits - self._window_hits) / lookups, 3) if lookups else None,
+            "in_flight": in_flight,
+            "rss_mb": round(rss_bytes() / 1e6, 1),
+        }
+        self._window_start = len(self.latencies)
+        self._window_hits, self._window_lookups, self._window_time = self.hits, self.lookups, now
+        self.timeline.append(point)
+        return point
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "seconds": round(elapsed, 3),
+            "throughput_rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            "mb_per_s": round(self.bytes / elapsed / 1e6, 2),
+            "hit_ratio": round(self.hits / self.lookups, 3) if self.lookups else None,
+            "peak_rss_mb": max([p["rss_mb"] for p in self.timeline] or [round(rss_bytes() / 1e6, 1)]),
+            "statuses": dict(sorted(self.statuses.items())),
+        }
+
+
+def print_point(point):
+    print("%8.1fs %9.1f %9.2f %9.2f %9.2f %7s %8d %8.1f" % (
+        point["t"], point["throughput_rps"], point["p50_ms"], point["p95_ms"], point["p99_ms"],
+        "-" if point["hit_ratio"] is None else "%.3f" % point["hit_ratio"], point["in_flight"], point["rss_mb"]))
+
+
+async def replay(requests, transport, concurrency=20, rate=None, interval=5.0, verbose=True):
+    """Send requests through the app; returns the ReplayStats."""
+    import httpx
+    import mirror.mirror
+    import timing
+    from main import app
+
+    stats = ReplayStats()
+    upstream = httpx.AsyncClient(transport=transport, max_redirects=3, headers={"Accept-Encoding": "identity"})
+    original_client = mirror.mirror.get_upstream_client
+    mirror.mirror.get_upstream_client = lambda: upstream
+    timing.request_listeners.append(stats.record_request)
+    in_flight = 0
+
+    async def send(client, request, due):
+        nonlocal in_flight
+        in_flight += 1
+        url = request["path"] + ("?" + request["query"] if request["query"] else "")
+        try:
+            response = await client.request(request["method"], url)
+            stats.add(time.perf_counter() - due, response.status_code, len(response.content))
+        except Exception as e:
+            stats.add(time.perf_counter() - due, type(e).__name__, 0)
+        finally:
+            in_flight -= 1
+
+    async def sampler():
+        while True:
+            await asyncio.sleep(interval)
+            point = stats.sample(in_flight)
+            if verbose:
+                print_point(point)
+
+    if verbose:
+        print("%9s %9s %9s %9s %9s %7s %8s %8s" % ("time", "req/s", "p50 ms", "p95 ms", "p99 ms", "hits",
+                                                   "inflight", "rss MB"))
+    sampling = asyncio.ensure_future(sampler())
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://replay") as client:
+            if rate:
+                # Open loop: arrivals follow the schedule however slow the responses are.
+                start = time.perf_counter()
+                tasks = []
+                for index, request in enumerate(requests):
+                    due = start + index / rate
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    tasks.append(asyncio.ensure_future(send(client, request, due)))
+                await asyncio.gather(*tasks)
+            else:
+                queue = list(reversed(requests))
+
+                async def worker():
+                    while queue:
+                        await send(client, queue.pop(), time.perf_counter())
+
+                await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        sampling.cancel()
+        timing.request_listeners.remove(stats.record_request)
+        mirror.mirror.get_upstream_client = original_client
+        await upstream.aclose()
+    point = stats.sample(in_flight)
+    if verbose and point["requests"]:
+        print_point(point)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("logs", nargs="+", help="cost log or access log files (.gz is fine)")
+    parser.add_argument("--store", help="recorded upstream responses (SQLite; created if missing)")
+    parser.add_argument("--record", action="store_true", help="fetch and store responses missing from --store")
+    parser.add_argument("--concurrency", type=int, default=20, help="closed-loop clients")
+    parser.add_argument("--rate", type=float, help="open-loop requests per second instead of --concurrency")
+    parser.add_argument("--limit", type=int, help="replay at most this many requests")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between timeline samples")
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args(argv)
+    if args.record and not args.store:
+        parser.error("--record needs --store")
+
+    requests = load_requests(args.logs, args.limit)
+    if not requests:
+        parser.error("no GET/HEAD requests found in %s" % ", ".join(args.logs))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        isolate_environment(tmp)
+        # Unlike the benchmarks, a replay should include the prefetches real pages trigger.
+        os.environ.pop("PREFETCH_MAX_PENDING", None)
+        os.chdir(str(ROOT))
+        store = ResponseStore(args.store or os.path.join(tmp, "upstream.db"))
+        transport = make_transport(store, upstream_hints(requests), record=args.record)
+        try:
+            stats = asyncio.run(replay(requests, transport, args.concurrency, args.rate, args.interval))
+        finally:
+            store.close()
+
+    results = {
+        "benchmark": "replay",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "parameters": {"logs": args.logs, "requests": len(requests), "concurrency": None if args.rate else
+                       args.concurrency, "rate": args.rate},
+        "summary": stats.summary(),
+        "upstream": transport.counters,
+        "timeline": stats.timeline,
+    }
+    summary = results["summary"]
+    print("\n%d requests in %.1fs: %.1f req/s, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, hit ratio %s, peak %.1f MB"
+          % (summary["requests"], summary["seconds"], summary["throughput_rps"], summary["p50_ms"],
+             summary["p95_ms"], summary["p99_ms"], summary["hit_ratio"], summary["peak_rss_mb"]))
+    print("statuses %s, upstream %s" % (summary["statuses"], transport.counters))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,11 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
 # Blacklisted URLs that have been identified as phishing attempts
 BLACKLISTED_URLS = {
     # eBay related phishing URLs
@@ -23,3 +31,150 @@ BLACKLISTED_URLS = {
     "www.linkedin.com/in/cathy-foster-15108916",
     "www.linkedin.com"
 }
+
+# Extra rules, one per line, in the same format as BLACKLISTED_URLS.  A leading
+# "*." or "." makes the rule match the domain and all of its subdomains.
+BLACKLIST_FILE = Path(os.environ.get("BLACKLIST_FILE", Path(__file__).parent / "blacklist.txt"))
+RELOAD_CHECK_SECONDS = 5
+
+# Characters after which a path rule counts as a prefix of the requested path.
+PATH_BOUNDARIES = "/?&"
+
+_SLASHES_RE = re.compile(r"/{2,}")
+
+
+def parse_rule(rule):
+    """Split a rule into (is_suffix, domain, path)."""
+    rule = rule.strip()
+    is_suffix = rule.startswith("*.") or rule.startswith(".")
+    rule = rule.lstrip("*").lstrip(".")
+    domain, _, path = rule.partition("/")
+    return is_suffix, domain.lower(), path
+
+
+def _path_candidates(path):
+    """Every prefix of path that ends on a boundary, plus the path itself."""
+    yield ""
+    for i, char in enumerate(path):
+        if char in PATH_BOUNDARIES:
+            yield path[:i]
+            yield path[:i + 1]
+    yield path
+
+
+class BlacklistMatcher(object):
+    """Domain/path rule index.
+
+    Lookups cost one dict probe per domain label and per path segment, no
+    matter how many rules are loaded.  The rules file is re-read when its
+    mtime changes, checked at most every ``check_interval`` seconds.
+    """
+
+    def __init__(self, builtin=(), path=None, check_interval=RELOAD_CHECK_SECONDS):
+        self.builtin = tuple(builtin)
+        self.path = Path(path) if path else None
+        self.check_interval = check_interval
+        self._file_signature = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.lookups = 0
+        self.match_seconds = 0.0
+        self.max_match_seconds = 0.0
+        self.rule_count = 0
+        self._exact = {}
+        self._suffix = {}
+        self.reload()
+
+    def _read_file_rules(self):
+        if self.path is None or not self.path.exists():
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+    def _signature(self):
+        if self.path is None:
+            return None
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        exact, suffix = {}, {}
+        signature = self._signature()
+        rules = list(self.builtin) + self._read_file_rules()
+        for rule in rules:
+            is_suffix, domain, path = parse_rule(rule)
+            if not domain:
+                continue
+            index = suffix if is_suffix else exact
+            index.setdefault(domain, {})[path] = rule
+        # Swap both indexes at once so concurrent lookups see a consistent set.
+        self._exact, self._suffix = exact, suffix
+        self.rule_count = len(rules)
+        self._file_signature = signature
+        logging.info("Loaded %d blacklist rules", self.rule_count)
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            if self._signature() != self._file_signature:
+                try:
+                    self.reload()
+                except (OSError, UnicodeDecodeError) as e:
+                    logging.error("Could not reload blacklist from %s: %s", self.path, e)
+
+    def _find(self, domain, path):
+        paths = self._exact.get(domain)
+        if paths:
+            for candidate in _path_candidates(path):
+                if candidate in paths:
+                    return paths[candidate]
+        if self._suffix:
+            labels = domain.split(".")
+            for i in range(len(labels)):
+                paths = self._suffix.get(".".join(labels[i:]))
+                if paths:
+                    for candidate in _path_candidates(path):
+                        if candidate in paths:
+                            return paths[candidate]
+        return None
+
+    def match(self, url):
+        """Return the rule blocking url ("domain/path?query"), or None."""
+        self.maybe_reload()
+        start = time.perf_counter()
+        domain, _, path = url.partition("/")
+        # Origins treat "ebay.com." like "ebay.com" and "//ws" like "/ws", so the rules must too.
+        domain = domain.lower().split(":")[0].rstrip(".")
+        path, query_mark, query = path.partition("?")
+        path = _SLASHES_RE.sub("/", path).lstrip("/") + query_mark + query
+        rule = self._find(domain, path)
+        elapsed = time.perf_counter() - start
+        self.lookups += 1
+        self.match_seconds += elapsed
+        if elapsed > self.max_match_seconds:
+            self.max_match_seconds = elapsed
+        if rule is not None:
+            self.hits[rule] += 1
+        return rule
+
+    def stats(self, top=20):
+        return {
+            "rules": self.rule_count,
+            "lookups": self.lookups,
+            "blocked": sum(self.hits.values()),
+            "avg_match_us": (self.match_seconds / self.lookups * 1e6) if self.lookups else 0.0,
+            "max_match_us": self.max_match_seconds * 1e6,
+            "top_rules": self.hits.most_common(top),
+        }
+
+
+blacklist_matcher = BlacklistMatcher(BLACKLISTED_URLS, BLACKLIST_FILE)
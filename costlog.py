@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Per-request cost log and a local analyzer for it.
+
+Every request appends one compact JSON line to COSTLOG_PATH (default
+logs/costlog.jsonl) with its route, fiddle, origin host, cache outcome,
+stage timings in ms, response bytes and status.  Lines are queued and
+written by a background thread so requests never wait on the disk; if the
+queue is full, records are dropped and counted.  The file is rotated to
+costlog.jsonl.1, .2, ... once it passes COSTLOG_MAX_BYTES.
+
+The same reports analysing-logs.md builds in BigQuery, from local files:
+
+    python costlog.py cost logs/costlog.jsonl*      # where the time goes
+    python costlog.py size logs/costlog.jsonl*      # largest responses
+    python costlog.py errors logs/costlog.jsonl*    # most expensive errors
+
+Files are read one line at a time (.gz files too), so reports work on logs
+much larger than memory as long as the number of distinct paths is not.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+COSTLOG_PATH = os.environ.get("COSTLOG_PATH", os.path.join("logs", "costlog.jsonl"))
+COSTLOG_MAX_BYTES = int(os.environ.get("COSTLOG_MAX_BYTES", 50 * 1024 * 1024))
+COSTLOG_BACKUPS = int(os.environ.get("COSTLOG_BACKUPS", 5))
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+
+
+def make_record(timing, status, content_type, body_bytes):
+    record = {
+        "ts": round(time.time(), 3),
+        "method": timing.method,
+        "route": timing.route,
+        "path": timing.path,
+        "status": status,
+        "bytes": body_bytes,
+        "ms": round(timing.elapsed() * 1000, 2),
+        "stages": {name: round(seconds * 1000, 2) for name, seconds in timing.stages.items()},
+    }
+    if timing.query:
+        record["query"] = timing.query
+    if content_type:
+        record["type"] = content_type.split(";")[0].strip()
+    record.update(timing.tags)
+    return record
+
+
+class CostLogWriter(object):
+    def __init__(self, path=COSTLOG_PATH, max_bytes=COSTLOG_MAX_BYTES, backups=COSTLOG_BACKUPS,
+                 queue_size=QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        # Threads don't survive fork(); each gunicorn worker starts its own writer.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                    self._thread = threading.Thread(target=self._run, name="costlog", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def record_request(self, timing, status, content_type, body_bytes):
+        """timing.request_listeners hook."""
+        self.write(make_record(timing, status, content_type, body_bytes))
+
+    def write(self, record):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5):
+        """Wait until everything queued so far is on disk."""
+        if self._pid == os.getpid():
+            done = threading.Event()
+            self._queue.put(done, timeout=timeout)
+            done.wait(timeout)
+
+    def _run(self):
+        work = self._queue
+        while True:
+            batch = [work.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(work.get_nowait())
+                except queue.Empty:
+                    break
+            records = [item for item in batch if isinstance(item, dict)]
+            if records:
+                try:
+                    self._append(records)
+                except OSError as e:
+                    logging.warning("Could not write cost log %s: %s", self.path, e)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _append(self, records):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records).encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            size = f.tell()
+        self.written += len(records)
+        if size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = "%s.%d" % (self.path, index)
+            if os.path.exists(source):
+                os.replace(source, "%s.%d" % (self.path, index + 1))
+        os.replace(self.path, self.path + ".1")
+
+
+cost_log = CostLogWriter()
+
+
+def read_records(paths):
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def aggregate(records, errors_only=False):
+    """Per-path totals, built in one pass over records."""
+    totals = {}
+    for record in records:
+        status = record.get("status") or 0
+        if errors_only and status < 400:
+            continue
+        key = record.get("path") or ""
+        entry = totals.get(key)
+        if entry is None:
+            entry = totals[key] = {"path": key, "requests": 0, "ms": 0.0, "bytes": 0, "max_bytes": 0,
+                                   "errors": 0, "hits": 0, "stages": {}}
+        entry["requests"] += 1
+        entry["ms"] += record.get("ms") or 0
+        size = record.get("bytes") or 0
+        entry["bytes"] += size
+        entry["max_bytes"] = max(entry["max_bytes"], size)
+        if status >= 400:
+            entry["errors"] += 1
+        if record.get("cache") == "hit":
+            entry["hits"] += 1
+        for name, ms in (record.get("stages") or {}).items():
+            entry["stages"][name] = entry["stages"].get(name, 0.0) + ms
+    return totals
+
+
+REPORTS = {
+    "cost": ("ms", False),
+    "size": ("max_bytes", False),
+    "errors": ("ms", True),
+}
+
+
+def report(kind, paths, top=10):
+    sort_key, errors_only = REPORTS[kind]
+    totals = aggregate(read_records(paths), errors_only=errors_only)
+    return sorted(totals.values(), key=lambda entry: entry[sort_key], reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("report", choices=sorted(REPORTS))
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    rows = report(args.report, args.files, args.top)
+    if args.json:
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+        return
+    print("%10s %8s %7s %12s %12s  %s" % ("total ms", "requests", "errors", "bytes", "max bytes", "path"))
+    for row in rows:
+        print("%10.0f %8d %7d %12d %12d  %s" % (row["ms"], row["requests"], row["errors"], row["bytes"],
+                                               row["max_bytes"], row["path"]))
+
+
+if __name__ == "__main__":
+    main()
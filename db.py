@@ -0,0 +1,107 @@
+"""Pooled SQLite connections and helpers to run queries off the event loop.
+
+Connections are opened in WAL mode so readers don't block the writer, and are
+kept per worker process for reuse.  Reusing a connection also reuses its
+compiled-statement cache, so the constant SQL strings in models.py are only
+prepared once per connection.
+"""
+import asyncio
+import functools
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+EXECUTOR_THREADS = int(os.environ.get("DB_EXECUTOR_THREADS", 4))
+BUSY_TIMEOUT_MS = 5000
+CACHED_STATEMENTS = 256
+
+
+class ConnectionPool(object):
+    """schema(conn), if given, is run on the first connection handed out so
+    tables are created on first use rather than when the module is imported.
+    """
+
+    def __init__(self, path, size=POOL_SIZE, pragmas=(), schema=None):
+        self.path = path
+        self.size = size
+        self.pragmas = tuple(pragmas)
+        self.schema = schema
+        self._schema_ready = schema is None
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=%d" % BUSY_TIMEOUT_MS)
+        for pragma in self.pragmas:
+            conn.execute("PRAGMA " + pragma)
+        return conn
+
+    def _check_fork(self):
+        # A connection inherited across fork() must never be used by the child.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue(maxsize=self.size)
+                    self._pid = os.getpid()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; it goes back to the pool (or is closed) afterwards."""
+        self._check_fork()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            if not self._schema_ready:
+                self._ensure_schema(conn)
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _ensure_schema(self, conn):
+        with self._lock:
+            if not self._schema_ready:
+                self.schema(conn)
+                self._schema_ready = True
+
+    def reset(self):
+        """Close idle connections and run the schema again on next use, e.g. after the file is replaced."""
+        self.close_all()
+        self._schema_ready = self.schema is None
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_executor = ThreadPoolExecutor(max_workers=EXECUTOR_THREADS, thread_name_prefix="db")
+
+
+async def run_in_db_thread(fn, *args, **kwargs):
+    """Run a blocking database call on the db thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+def submit_to_db_thread(fn, *args, **kwargs):
+    """Start a blocking database call on the db thread pool without waiting for it; returns its Future."""
+    return _executor.submit(fn, *args, **kwargs)
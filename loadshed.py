@@ -0,0 +1,162 @@
+"""Event-loop-lag driven admission control.
+
+A background task sleeps for a fixed interval and measures how late it wakes
+up; that overshoot is the time callbacks spend queued behind blocking work
+(SQLite, regex transforms, bcrypt...).  LoadShedMiddleware uses the lag and
+the number of in-flight requests to pick a level per request:
+
+* normal   - everything is served.
+* degraded - requests are served, but handlers that check ``is_degraded()``
+             should skip expensive work (the mirror serves cache hits only).
+* shed     - requests are rejected with a cheap 503 and Retry-After.
+"""
+import asyncio
+import contextvars
+import logging
+import math
+import os
+
+SAMPLE_INTERVAL_SECONDS = 0.1
+# Lag decays by this factor per sample so one long stall keeps us cautious briefly.
+LAG_DECAY = 0.8
+
+DEGRADE_LAG_SECONDS = float(os.environ.get("LOADSHED_DEGRADE_LAG", 0.25))
+SHED_LAG_SECONDS = float(os.environ.get("LOADSHED_SHED_LAG", 1.0))
+DEGRADE_INFLIGHT = int(os.environ.get("LOADSHED_DEGRADE_INFLIGHT", 60))
+SHED_INFLIGHT = int(os.environ.get("LOADSHED_SHED_INFLIGHT", 150))
+
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, math.inf)
+
+# Health checks, stats and static assets are never shed.
+EXEMPT_PREFIXES = ("/_ah/", "/_stats/", "/static/")
+EXEMPT_PATHS = frozenset(["/warmup", "/favicon.ico", "/metrics"])
+
+NORMAL = "normal"
+DEGRADED = "degraded"
+SHED = "shed"
+
+_degraded = contextvars.ContextVar("loadshed_degraded", default=False)
+
+
+def is_degraded():
+    """True when the current request was admitted in degraded mode."""
+    return _degraded.get()
+
+
+class LoopLagMonitor(object):
+    def __init__(self, interval=SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.samples = 0
+        self.bucket_counts = [0] * len(LAG_BUCKETS)
+        self.lag_sum = 0.0
+        self._task = None
+        self._loop = None
+
+    def observe(self, lag):
+        self.lag = max(lag, self.lag * LAG_DECAY)
+        self.max_lag = max(self.max_lag, lag)
+        self.samples += 1
+        self.lag_sum += lag
+        for i, bound in enumerate(LAG_BUCKETS):
+            if lag <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._loop is not loop or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.observe(max(0.0, loop.time() - started - self.interval))
+
+    def histogram(self):
+        """Cumulative (le, count) pairs in Prometheus histogram order."""
+        cumulative, total = [], 0
+        for bound, count in zip(LAG_BUCKETS, self.bucket_counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class LoadShedMiddleware(object):
+    def __init__(self, app, monitor=None, degrade_lag=DEGRADE_LAG_SECONDS, shed_lag=SHED_LAG_SECONDS,
+                 degrade_inflight=DEGRADE_INFLIGHT, shed_inflight=SHED_INFLIGHT):
+        self.app = app
+        self.monitor = monitor or lag_monitor
+        self.degrade_lag = degrade_lag
+        self.shed_lag = shed_lag
+        self.degrade_inflight = degrade_inflight
+        self.shed_inflight = shed_inflight
+        self.inflight = 0
+        self.counts = {NORMAL: 0, DEGRADED: 0, SHED: 0}
+        load_shedders.append(self)
+
+    def level(self):
+        lag = self.monitor.lag
+        if lag >= self.shed_lag or self.inflight >= self.shed_inflight:
+            return SHED
+        if lag >= self.degrade_lag or self.inflight >= self.degrade_inflight:
+            return DEGRADED
+        return NORMAL
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in EXEMPT_PATHS or path.startswith(EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        self.monitor.ensure_running()
+        level = self.level()
+        self.counts[level] += 1
+        if level == SHED:
+            logging.warning("Shedding %s (lag %.3fs, in flight %d)",
+                            scope.get("path"), self.monitor.lag, self.inflight)
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [(b"content-type", b"text/plain"), (b"retry-after", b"1")],
+            })
+            await send({"type": "http.response.body", "body": b"Server busy, please retry"})
+            return
+
+        token = _degraded.set(level == DEGRADED)
+        self.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.inflight -= 1
+            _degraded.reset(token)
+
+    def stats(self):
+        monitor = self.monitor
+        return {
+            "level": self.level(),
+            "in_flight": self.inflight,
+            "admitted": self.counts[NORMAL],
+            "degraded": self.counts[DEGRADED],
+            "shed": self.counts[SHED],
+            "lag_seconds": monitor.lag,
+            "max_lag_seconds": monitor.max_lag,
+            "lag_samples": monitor.samples,
+            "lag_sum_seconds": monitor.lag_sum,
+            "lag_histogram": [["+Inf" if math.isinf(le) else le, count] for le, count in monitor.histogram()],
+        }
+
+
+def stats():
+    if load_shedders:
+        return load_shedders[-1].stats()
+    return {"level": NORMAL, "lag_seconds": lag_monitor.lag}
+
+
+lag_monitor = LoopLagMonitor()
+# Middleware instances are built lazily by Starlette; keep track of them for stats.
+load_shedders = []
@@ -1,32 +1,52 @@
 #!/usr/bin/env python
+import startup  # first, so its clock starts as close to process start as possible
 import json
+import logging
 import os
 from pathlib import Path
 
-from fastapi import FastAPI, Request, Response, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Request, Response, Form
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from fastapi.middleware.wsgi import WSGIMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
 import sqlite3
-import bcrypt
 
 current_dir = Path(__file__).parent
 
 import fixtures
 from gameon_utils import GameOnUtils
-from mirror.mirror import mirror_router
-from models import Fiddle, default_fiddle, init_db, DATABASE_PATH
+from timing import TimingMiddleware
+from costlog import cost_log
+from metrics import metrics
+import loadshed
+from loadshed import LoadShedMiddleware
+from admin import is_admin
+from mirror.cache_admin import cache_admin_router
+from mirror.mirror import cache_hits, mirror_router
+from db import run_in_db_thread
+from models import Fiddle, User, default_fiddle, fiddle_views, init_db, top_fiddles, DATABASE_PATH
+from page_cache import etag_matches, page_cache
+from passwords import PasswordBusy, login_retry_after, login_succeeded, password_hasher
+from profiler import ProfileMiddleware, profile_router
+from templating import templates
+import models
+import sitemap
+import timing
+import warmup
 
 app = FastAPI()
 
 app.add_middleware(SessionMiddleware, secret_key=os.environ.get("SECRET_KEY", "changeme"))
+# Inside TimingMiddleware so profiled requests can report their stages.
+app.add_middleware(ProfileMiddleware)
+app.add_middleware(TimingMiddleware)
+timing.request_listeners.append(metrics.record_request)
+if cost_log.path:
+    timing.request_listeners.append(cost_log.record_request)
+# Added last so it runs first: shed requests skip every other middleware.
+app.add_middleware(LoadShedMiddleware)
 
-init_db()
-
-templates = Jinja2Templates(directory=os.path.dirname(__file__))
 debug = (
     os.environ.get("SERVER_SOFTWARE", "").startswith("Development")
     or os.environ.get("IS_DEVELOP", "") == "1"
@@ -34,6 +54,9 @@ debug = (
 )
 
 GCLOUD_STATIC_BUCKET_URL = "/static" if debug else "https://static.netwrck.com/simstatic"
+SITE_HOST = os.environ.get("SITE_HOST", "webfiddle.net")
+
+models.save_listeners.append(lambda fiddle: page_cache.invalidate(fiddle.id))
 
 # Mount static files before any routes
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -51,39 +74,127 @@ async def bingsiteauth():
 """
     return Response(content=xml_content, media_type="application/xml")
 
+def fiddle_page(request: Request, fiddle: Fiddle, title: str, description: str):
+    """Rendered index page for a fiddle, cached until the fiddle is saved again."""
+    user = request.session.get("user")
+    key = (fiddle.id, fiddle.revision, str(request.url), user)
+    page = page_cache.get(key)
+    if page is None:
+        current_saved_fiddle = {
+            "id": fiddle.id,
+            "title": fiddle.title,
+            "description": fiddle.description,
+            "start_url": fiddle.start_url,
+            "script": fiddle.script,
+            "style": fiddle.style,
+            "script_language": fiddle.script_language,
+            "style_language": fiddle.style_language
+        }
+        with timing.stage("render"):
+            body = templates.get_template("templates/index.jinja2").render({
+                "request": request,
+                "fiddle": fiddle,
+                "current_saved_fiddle": json.dumps(current_saved_fiddle),
+                "title": title,
+                "description": description,
+                "json": json,
+                "fixtures": fixtures,
+                "GameOnUtils": GameOnUtils,
+                "static_url": GCLOUD_STATIC_BUCKET_URL,
+                "url": request.url,
+            })
+        page = page_cache.put(key, fiddle.id, body.encode("utf-8"))
+    return page
+
+
+def page_response(request: Request, page):
+    if etag_matches(request.headers.get("if-none-match"), page.etag):
+        return Response(status_code=304, headers={"etag": page.etag})
+    return HTMLResponse(content=page.body, headers={"etag": page.etag})
+
+
+DEFAULT_TITLE = "WebSim by Netwrck!"
+DEFAULT_DESCRIPTION = "AI Creator - Make CSS and JavaScript To Create any and every web page! Share the results!"
+
+
+def render_default_page():
+    # The default fiddle never changes, so render "/" for the canonical site URL up front.
+    scope = {
+        "type": "http", "method": "GET", "scheme": "https", "path": "/", "query_string": b"",
+        "headers": [(b"host", SITE_HOST.encode())], "server": (SITE_HOST, 443), "session": {},
+    }
+    return fiddle_page(Request(scope), default_fiddle, DEFAULT_TITLE, DEFAULT_DESCRIPTION)
+
+
+@app.on_event("startup")
+def prerender_default_page():
+    try:
+        with startup.phase("prerender"):
+            render_default_page()
+    except Exception as e:
+        print(f"Could not prerender default page: {str(e)}")
+    logging.info("Worker %d %s", os.getpid(), startup.summary())
+
+
+async def warm_default_page(deadline):
+    return {"bytes": len(render_default_page().body)}
+
+
+warmup.register("default_page", warm_default_page, order=20)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def main_handler(request: Request):
     try:
-        current_saved_fiddle = {
-            "id": default_fiddle.id,
-            "title": default_fiddle.title,
-            "description": default_fiddle.description,
-            "start_url": default_fiddle.start_url,
-            "script": default_fiddle.script,
-            "style": default_fiddle.style,
-            "script_language": default_fiddle.script_language,
-            "style_language": default_fiddle.style_language
-        }
-        return templates.TemplateResponse("templates/index.jinja2", {
-            "request": request,
-            "fiddle": default_fiddle,
-            "current_saved_fiddle": json.dumps(current_saved_fiddle),
-            "title": "WebSim by Netwrck!",
-            "description": "AI Creator - Make CSS and JavaScript To Create any and every web page! Share the results!",
-            "json": json,
-            "fixtures": fixtures,
-            "GameOnUtils": GameOnUtils,
-            "static_url": GCLOUD_STATIC_BUCKET_URL,
-            "url": request.url,
-        })
+        return page_response(request, fiddle_page(request, default_fiddle, DEFAULT_TITLE, DEFAULT_DESCRIPTION))
     except Exception as e:
         # Log the error and return a simple error page
         print(f"Error in main_handler: {str(e)}")
         return HTMLResponse(content="<h1>Error loading page</h1><p>Please try again later.</p>", status_code=500)
 
+# Before /{fiddlekey}, which would otherwise claim /warmup.
 @app.get("/_ah/warmup")
+@app.get("/warmup")
 async def warmup_handler():
-    return ""
+    return await warmup.run()
+
+@app.get("/_stats/loadshed")
+async def loadshed_stats_handler():
+    return loadshed.stats()
+
+@app.get("/_stats/fiddles")
+async def popular_fiddles_handler(limit: int = 20):
+    return await run_in_db_thread(top_fiddles, min(max(limit, 1), 100))
+
+# Defined before /{fiddlekey}, which would otherwise treat "metrics" as a fiddle.
+@app.get("/metrics", include_in_schema=False)
+async def metrics_handler(request: Request):
+    # Origin hosts say what people browse, so only admins see them per host.
+    return Response(content=metrics.render(private=is_admin(request)), media_type="text/plain; version=0.0.4")
+
+@app.get("/search")
+async def search_handler(q: str = "", cursor: str = None, limit: int = 20):
+    """Fiddles matching q, best match first; pass back "next" as cursor for the next page."""
+    results, next_cursor = await Fiddle.searchAsync(q, cursor, min(max(limit, 1), 100))
+    return {"results": results, "next": next_cursor}
+
+# Before /{fiddlekey} as well.
+@app.get("/sitemap.xml")
+async def sitemap_handler():
+    await run_in_db_thread(sitemap.sitemaps.refresh)
+    return Response(content=sitemap.sitemaps.index_xml(), media_type="application/xml",
+                    headers={"cache-control": "public, max-age=3600"})
+
+@app.get("/sitemap-{shard:int}.xml.gz")
+async def sitemap_shard_handler(shard: int):
+    await run_in_db_thread(sitemap.sitemaps.refresh)
+    path = sitemap.sitemaps.shard_path(shard)
+    if not os.path.exists(path) and shard in (sitemap.sitemaps.load_state() or {"shards": {}})["shards"]:
+        # The file was cleaned away from under the cache: rebuild it all.
+        await run_in_db_thread(sitemap.sitemaps.refresh, True)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404)
+    return FileResponse(path, media_type="application/gzip", headers={"cache-control": "public, max-age=3600"})
 
 @app.get("/createfiddle")
 async def create_fiddle_handler(request: Request):
@@ -101,37 +212,18 @@ async def create_fiddle_handler(request: Request):
     fiddle.script_language = fixtures.SCRIPT_TYPES[script_language] if script_language else fixtures.SCRIPT_TYPES['javascript']
     fiddle.style_language = fixtures.STYLE_TYPES[style_language] if style_language else fixtures.STYLE_TYPES['css']
 
-    Fiddle.save(fiddle)
+    await Fiddle.saveAsync(fiddle)
     return "success"
 
 @app.get("/{fiddlekey}", response_class=HTMLResponse)
 async def get_fiddle_handler(request: Request, fiddlekey: str):
-    current_fiddle = Fiddle.byUrlKey(fiddlekey)
+    current_fiddle = await Fiddle.byUrlKeyAsync(fiddlekey)
     if not current_fiddle:
         current_fiddle = default_fiddle
-
-    current_saved_fiddle = {
-        "id": current_fiddle.id,
-        "title": current_fiddle.title,
-        "description": current_fiddle.description,
-        "start_url": current_fiddle.start_url,
-        "script": current_fiddle.script,
-        "style": current_fiddle.style,
-        "script_language": current_fiddle.script_language,
-        "style_language": current_fiddle.style_language
-    }
-    return templates.TemplateResponse("templates/index.jinja2", {
-        "request": request,
-        "fiddle": current_fiddle,
-        "current_saved_fiddle": json.dumps(current_saved_fiddle),
-        "title": current_fiddle.title,
-        "description": current_fiddle.description,
-        "json": json,
-        "fixtures": fixtures,
-        "GameOnUtils": GameOnUtils,
-        "static_url": GCLOUD_STATIC_BUCKET_URL,
-        "url": request.url,
-    })
+    elif current_fiddle is not default_fiddle:
+        fiddle_views.record(current_fiddle.id)
+    page = fiddle_page(request, current_fiddle, current_fiddle.title, current_fiddle.description)
+    return page_response(request, page)
 
 
 @app.get("/login", response_class=HTMLResponse)
@@ -150,13 +242,28 @@ async def login_form(request: Request):
 
 @app.post("/login")
 async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    conn = sqlite3.connect(DATABASE_PATH)
-    row = conn.execute("SELECT password_hash FROM users WHERE username=?", (username,)).fetchone()
-    conn.close()
-    if row and bcrypt.checkpw(password.encode(), row[0].encode()):
-        request.session["user"] = username
-        return RedirectResponse("/", status_code=302)
-    return HTMLResponse("Invalid credentials", status_code=400)
+    # Throttle per account before doing any bcrypt work.
+    retry_after = login_retry_after(username)
+    if retry_after:
+        return HTMLResponse("Too many login attempts, please try again later", status_code=429,
+                            headers={"retry-after": str(int(retry_after) + 1)})
+    user = await User.byUsernameAsync(username)
+    try:
+        verified = user is not None and await password_hasher.verify(password, user.password_hash)
+    except PasswordBusy:
+        return HTMLResponse("Server busy, please try again", status_code=503, headers={"retry-after": "1"})
+    if not verified:
+        return HTMLResponse("Invalid credentials", status_code=400)
+    if password_hasher.needs_rehash(user.password_hash):
+        # The configured cost changed; upgrade the stored hash while we have the password.
+        # Best effort: the next login will try again if no hashing slot is free now.
+        try:
+            await User.updatePasswordHashAsync(username, await password_hasher.hash(password))
+        except PasswordBusy:
+            logging.info("Skipped upgrading the password hash for %s: hasher busy", username)
+    login_succeeded(username)
+    request.session["user"] = username
+    return RedirectResponse("/", status_code=302)
 
 
 @app.get("/register", response_class=HTMLResponse)
@@ -175,15 +282,14 @@ async def register_form(request: Request):
 
 @app.post("/register")
 async def register(request: Request, username: str = Form(...), password: str = Form(...)):
-    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        with conn:
-            conn.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, hashed))
+        hashed = await password_hasher.hash(password)
+    except PasswordBusy:
+        return HTMLResponse("Server busy, please try again", status_code=503, headers={"retry-after": "1"})
+    try:
+        await User.createAsync(username, hashed)
     except sqlite3.IntegrityError:
-        conn.close()
         return HTMLResponse("User already exists", status_code=400)
-    conn.close()
     request.session["user"] = username
     return RedirectResponse("/", status_code=302)
 
@@ -193,15 +299,19 @@ async def logout(request: Request):
     request.session.clear()
     return RedirectResponse("/", status_code=302)
 
-@app.get("/sitemap.xml", response_class=HTMLResponse)
-async def sitemap_handler(request: Request):
-    content = templates.get_template("sitemap.xml").render({"request": request})
-    return Response(content=content, media_type="text/xml")
-
 @app.get("/{url:path}/")
 async def slash_murderer(url: str):
     return RedirectResponse(url=f"/{url}", status_code=302)
 
+@app.on_event("shutdown")
+def flush_buffers():
+    cache_hits.flush()
+    fiddle_views.flush()
+    cost_log.flush()
+
+# Admin routes first: the mirror's catch-all would otherwise claim /_admin/...
+app.include_router(cache_admin_router)
+app.include_router(profile_router)
 # Include the mirror router
 app.include_router(mirror_router)
 
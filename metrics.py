@@ -0,0 +1,267 @@
+"""Prometheus metrics aggregated across gunicorn workers.
+
+Each worker keeps its counters and histograms in memory and every few
+seconds writes a snapshot to METRICS_DIR/<pid>-<random id>.json, holding a
+lock on the matching .lock file for as long as it runs.  /metrics merges
+the snapshots of every worker and renders the Prometheus text format.
+Snapshots whose lock is free belong to workers that have exited: they are
+folded into retired.json and deleted, so counters never go backwards when
+workers restart (even when a new worker gets a dead one's pid) and the
+directory doesn't grow with every restart.
+
+Stage latencies come from the ``timing.stage`` blocks of each request, so
+anything timed for Server-Timing also shows up here.
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "webfiddle-metrics"))
+FLUSH_SECONDS = 5
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Label values beyond this many per metric are folded into "other".
+MAX_LABEL_VALUES = 200
+RETIRED = "retired.json"
+
+HELP = {
+    "webfiddle_stage_seconds": ("histogram", "Time spent in each request stage."),
+    "webfiddle_request_seconds": ("histogram", "Total request time."),
+    "webfiddle_requests_total": ("counter", "Requests by response status class."),
+    "webfiddle_cache_lookups_total": ("counter", "Mirror cache lookups by result and cache policy."),
+    "webfiddle_cache_hit_ratio": ("gauge", "Mirror cache hits / lookups since the metrics began."),
+    "webfiddle_served_bytes_total": ("counter", "Response body bytes by content type."),
+    "webfiddle_upstream_errors_total": ("counter", "Failed upstream fetches by origin host."),
+}
+
+# Labels naming what people browse; only admins see them, elsewhere their series are summed.
+PRIVATE_LABELS = ("origin",)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    return ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+
+
+def _without_labels(counters, names):
+    """counters with the labels in names removed, summing the series that then coincide."""
+    pattern = re.compile(r'(^|,)(%s)="(?:[^"\\]|\\.)*"' % "|".join(names))
+    merged = {}
+    for (name, labels), value in counters.items():
+        key = (name, pattern.sub("", labels).lstrip(","))
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _merge(counters, histograms, snapshot):
+    """Add a snapshot's values into the counters and histograms dicts."""
+    for name, labels, value in snapshot["counters"]:
+        counters[(name, labels)] = counters.get((name, labels), 0) + value
+    for name, labels, h in snapshot["histograms"]:
+        merged = histograms.setdefault((name, labels), {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], h["buckets"])]
+        merged["sum"] += h["sum"]
+        merged["count"] += h["count"]
+
+
+def _as_snapshot(counters, histograms):
+    return {"counters": [[name, labels, value] for (name, labels), value in counters.items()],
+            "histograms": [[name, labels, h] for (name, labels), h in histograms.items()]}
+
+
+class Metrics(object):
+    def __init__(self, directory=METRICS_DIR, flush_seconds=FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._counters = {}
+        self._histograms = {}
+        self._label_values = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._pid = None
+        self._name = None
+        self._lock_file = None
+
+    def _bounded(self, name, labels):
+        seen = self._label_values.setdefault(name, set())
+        key = _labels(labels)
+        if key not in seen:
+            if len(seen) >= MAX_LABEL_VALUES:
+                return _labels({k: "other" for k in labels})
+            seen.add(key)
+        return key
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            key = (name, self._bounded(name, labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            key = (name, self._bounded(name, labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+        self.maybe_flush()
+
+    def record_request(self, timing, status, content_type, body_bytes):
+        """timing.request_listeners hook, called once per finished HTTP request."""
+        for stage, seconds in timing.stages.items():
+            self.observe("webfiddle_stage_seconds", seconds, stage=stage)
+        self.observe("webfiddle_request_seconds", timing.elapsed())
+        self.inc("webfiddle_requests_total", status="%dxx" % (status // 100))
+        if body_bytes:
+            self.inc("webfiddle_served_bytes_total", body_bytes,
+                     content_type=(content_type or "none").split(";")[0].strip().lower())
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, dict(h, buckets=list(h["buckets"]))]
+                               for (name, labels), h in self._histograms.items()],
+            }
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def snapshot_name(self):
+        """This worker's snapshot file name, taking the lock that marks it as running."""
+        if self._pid != os.getpid():
+            # First use, or a worker forked from a process that already had one.
+            self._pid = os.getpid()
+            self._name = "%d-%s.json" % (self._pid, os.urandom(4).hex())
+            self._lock_file = open(os.path.join(self.directory, self._name[:-len(".json")] + ".lock"), "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        return self._name
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, self.snapshot_name())
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("Could not write metrics snapshot: %s", e)
+
+    def _read(self, file_name):
+        try:
+            with open(os.path.join(self.directory, file_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_running(self, file_name):
+        """Whether the worker that wrote file_name still holds its lock."""
+        lock_path = os.path.join(self.directory, file_name[:-len(".json")] + ".lock")
+        try:
+            with open(lock_path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def _retire(self, names):
+        """Fold the snapshots of exited workers into retired.json and delete them."""
+        with open(os.path.join(self.directory, "retire.lock"), "a") as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            retired = self._read(RETIRED) or {"counters": [], "histograms": [], "merged": []}
+            done = set(retired["merged"])
+            dead = [n for n in names if n != self._name and n not in done and not self._is_running(n)]
+            if not dead:
+                return
+            counters, histograms = {}, {}
+            _merge(counters, histograms, retired)
+            merged = []
+            for file_name in dead:
+                snapshot = self._read(file_name)
+                if snapshot is not None:
+                    _merge(counters, histograms, snapshot)
+                    merged.append(file_name)
+            # Names are kept until their files are gone, so a crash between writing
+            # retired.json and deleting them can't count a snapshot twice.
+            retired = dict(_as_snapshot(counters, histograms), merged=[
+                n for n in done if os.path.exists(os.path.join(self.directory, n))] + merged)
+            path = os.path.join(self.directory, RETIRED)
+            with open(path + ".tmp", "w") as f:
+                json.dump(retired, f)
+            os.replace(path + ".tmp", path)
+            for file_name in merged:
+                for suffix in (".json", ".lock"):
+                    try:
+                        os.remove(os.path.join(self.directory, file_name[:-len(".json")] + suffix))
+                    except OSError:
+                        pass
+
+    def collect(self):
+        """Merge the snapshots of all workers, including this one's live values."""
+        self.flush()
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json") and n != RETIRED]
+            self._retire(names)
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json") and n != RETIRED]
+        except OSError as e:
+            logging.warning("Could not retire metrics snapshots: %s", e)
+            names = []
+        retired = self._read(RETIRED) or {"counters": [], "histograms": [], "merged": []}
+        done = set(retired["merged"])
+        counters, histograms = {}, {}
+        _merge(counters, histograms, retired)
+        for file_name in names:
+            snapshot = None if file_name in done else self._read(file_name)
+            if snapshot is not None:
+                _merge(counters, histograms, snapshot)
+        return counters, histograms
+
+    def render(self, private=True):
+        """The Prometheus text format; without private, PRIVATE_LABELS are left out."""
+        counters, histograms = self.collect()
+        if not private:
+            counters = _without_labels(counters, PRIVATE_LABELS)
+        hits = sum(v for (name, labels), v in counters.items()
+                   if name == "webfiddle_cache_lookups_total" and 'result="hit"' in labels)
+        lookups = sum(v for (name, labels), v in counters.items() if name == "webfiddle_cache_lookups_total")
+        gauges = {("webfiddle_cache_hit_ratio", ""): (hits / lookups) if lookups else 0.0}
+
+        lines = []
+        for name, (kind, help_text) in HELP.items():
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if kind == "histogram":
+                for (metric, labels), h in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    prefix = labels + "," if labels else ""
+                    for bound, count in zip(BUCKETS, h["buckets"]):
+                        lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+                    lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, h["count"]))
+                    suffix = "{%s}" % labels if labels else ""
+                    lines.append("%s_sum%s %.6f" % (name, suffix, h["sum"]))
+                    lines.append("%s_count%s %d" % (name, suffix, h["count"]))
+            else:
+                values = gauges if kind == "gauge" else counters
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append("%s%s %s" % (name, "{%s}" % labels if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""Inspect and purge the mirror cache (cache.db) by host.
+
+Usable as an admin API (mounted under /_admin/cache) or from the shell:
+
+    python -m mirror.cache_admin stats [--limit 20]
+    python -m mirror.cache_admin top --by size|hits [--limit 20]
+    python -m mirror.cache_admin purge --host example.com
+    python -m mirror.cache_admin purge --prefix http://example.com/static/
+    python -m mirror.cache_admin backfill
+
+Purges delete in small batches with a pause in between so request
+traffic can still write to the cache while a large host is removed.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from admin import require_admin
+from db import run_in_db_thread, submit_to_db_thread
+
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "cache.db")
+
+PURGE_BATCH_SIZE = 500
+PURGE_PAUSE_SECONDS = 0.01
+
+HIT_FLUSH_SECONDS = 10
+HIT_FLUSH_PENDING = 1000
+
+# Called with (host, prefix) after a purge so in-memory copies can be dropped too.
+purge_listeners = []
+# Database paths connect() has run the cache schema on in this process.
+_schema_ready = set()
+
+
+def host_of(url):
+    """The host[:port] part of a mirrored URL, lowercased."""
+    return urlsplit(url).netloc.lower()
+
+
+def _like_prefix(prefix):
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def connect(path=None):
+    """A connection to the cache db, creating its tables first if it is a new one."""
+    from mirror.mirror import create_schema  # mirror.mirror imports this module
+
+    path = path or CACHE_DB_PATH
+    conn = sqlite3.connect(path, timeout=5)
+    conn.execute("PRAGMA busy_timeout=5000")
+    if path not in _schema_ready:
+        create_schema(conn)
+        _schema_ready.add(path)
+    return conn
+
+
+def host_stats(conn, limit=20):
+    rows = conn.execute(
+        "SELECT host, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM mirrored_content "
+        "GROUP BY host ORDER BY 3 DESC LIMIT ?", (limit,)).fetchall()
+    total_entries, total_bytes = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mirrored_content").fetchone()
+    return {
+        "entries": total_entries,
+        "bytes": total_bytes,
+        "hosts": [{"host": host, "entries": entries, "bytes": size, "hits": hits}
+                  for host, entries, size, hits in rows],
+    }
+
+
+def top_keys(conn, by="size", limit=20):
+    if by not in ("size", "hits"):
+        raise ValueError("by must be 'size' or 'hits'")
+    rows = conn.execute(
+        "SELECT key_name, original_address, COALESCE(size, 0), COALESCE(hits, 0) FROM mirrored_content "
+        "ORDER BY %s DESC LIMIT ?" % by, (limit,)).fetchall()
+    return [{"key": key, "url": url, "bytes": size, "hits": hits} for key, url, size, hits in rows]
+
+
+def purge(conn, host=None, prefix=None, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE_SECONDS):
+    """Delete entries for a host and/or URL prefix in batches; returns the count deleted."""
+    if not host and not prefix:
+        raise ValueError("host or prefix is required")
+    if prefix and not host:
+        host = host_of(prefix)
+    where, params = "host = ?", [host.lower()]
+    if prefix:
+        where += " AND original_address LIKE ? ESCAPE '\\'"
+        params.append(_like_prefix(prefix))
+    deleted = 0
+    while True:
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM mirrored_content WHERE rowid IN "
+                "(SELECT rowid FROM mirrored_content WHERE %s LIMIT ?)" % where, params + [batch_size])
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            break
+        time.sleep(pause)
+    for listener in purge_listeners:
+        listener(host, prefix)
+    return deleted
+
+
+def backfill_hosts(conn, batch_size=PURGE_BATCH_SIZE):
+    """Fill host/size for rows cached before those columns existed."""
+    updated = 0
+    while True:
+        rows = conn.execute(
+            "SELECT rowid, original_address, length(data) FROM mirrored_content WHERE host IS NULL LIMIT ?",
+            (batch_size,)).fetchall()
+        if not rows:
+            return updated
+        with conn:
+            conn.executemany("UPDATE mirrored_content SET host = ?, size = ? WHERE rowid = ?",
+                             [(host_of(url or ""), size or 0, rowid) for rowid, url, size in rows])
+        updated += len(rows)
+
+
+class HitCounter(object):
+    """Buffers cache hits per key and writes them out in one batch."""
+
+    def __init__(self, path=None, flush_seconds=HIT_FLUSH_SECONDS, flush_pending=HIT_FLUSH_PENDING):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.flush_pending = flush_pending
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flushing = None
+
+    def record(self, key_name):
+        """Count a hit.  Called from request handlers, so a due batch is written on
+        the db thread pool rather than on the event loop."""
+        with self._lock:
+            self._pending[key_name] += 1
+            if self._flushing is None and (len(self._pending) >= self.flush_pending
+                                           or time.monotonic() - self._last_flush >= self.flush_seconds):
+                self._flushing = submit_to_db_thread(self._background_flush)
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._flushing = None
+
+    def drain(self):
+        """Wait for a batch being written in the background, if any."""
+        flushing = self._flushing
+        if flushing is not None:
+            flushing.result()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            conn = connect(self.path)
+            with conn:
+                conn.executemany("UPDATE mirrored_content SET hits = COALESCE(hits, 0) + ? WHERE key_name = ?",
+                                 [(count, key) for key, count in pending.items()])
+            conn.close()
+        except sqlite3.Error:
+            # Hit counts are advisory; never fail a request over them.
+            pass
+
+
+cache_admin_router = APIRouter(prefix="/_admin/cache", dependencies=[Depends(require_admin)])
+
+
+def _with_connection(fn, *args, **kwargs):
+    conn = connect()
+    try:
+        return fn(conn, *args, **kwargs)
+    finally:
+        conn.close()
+
+
+@cache_admin_router.get("/stats")
+async def cache_stats_handler(limit: int = 20):
+    return await run_in_db_thread(_with_connection, host_stats, limit)
+
+
+@cache_admin_router.get("/top")
+async def cache_top_handler(by: str = "size", limit: int = 20):
+    if by not in ("size", "hits"):
+        raise HTTPException(status_code=400, detail="by must be 'size' or 'hits'")
+    return await run_in_db_thread(_with_connection, top_keys, by, limit)
+
+
+@cache_admin_router.post("/purge")
+async def cache_purge_handler(host: str = "", prefix: str = ""):
+    if not host and not prefix:
+        raise HTTPException(status_code=400, detail="host or prefix is required")
+    deleted = await run_in_db_thread(_with_connection, purge, host or None, prefix or None)
+    return {"deleted": deleted}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stats_parser = commands.add_parser("stats", help="entries and bytes per host")
+    stats_parser.add_argument("--limit", type=int, default=20)
+    top_parser = commands.add_parser("top", help="largest or most hit entries")
+    top_parser.add_argument("--by", choices=("size", "hits"), default="size")
+    top_parser.add_argument("--limit", type=int, default=20)
+    purge_parser = commands.add_parser("purge", help="delete entries by host or URL prefix")
+    purge_parser.add_argument("--host")
+    purge_parser.add_argument("--prefix")
+    purge_parser.add_argument("--batch-size", type=int, default=PURGE_BATCH_SIZE)
+    commands.add_parser("backfill", help="fill host/size columns for old rows")
+    args = parser.parse_args(argv)
+
+    conn = connect(args.db)
+    if args.command == "stats":
+        result = host_stats(conn, args.limit)
+    elif args.command == "top":
+        result = top_keys(conn, args.by, args.limit)
+    elif args.command == "purge":
+        if not args.host and not args.prefix:
+            parser.error("purge needs --host or --prefix")
+        result = {"deleted": purge(conn, args.host, args.prefix, args.batch_size)}
+    else:
+        result = {"updated": backfill_hosts(conn)}
+    conn.close()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Decide how long mirrored responses are stored and what clients may cache.
+
+Each response is classified into a policy by content type.  The policy
+bounds the storage TTL derived from the upstream Cache-Control / Expires
+headers, sets the Cache-Control sent to clients, and decides whether the
+response is admitted to the cache at all:
+
+* ``no-store`` and ``private`` responses, and 5xx errors, are never stored;
+* bodies over LARGE_BODY_BYTES are only stored the second time they are
+  requested, so one-off large downloads don't churn the cache.
+
+Policies can be tuned with a JSON file named by CACHE_POLICY_FILE, mapping a
+policy name to overrides of its fields, e.g. ``{"image": {"max_ttl": 86400}}``.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+DAY = 3600 * 24
+
+LARGE_BODY_BYTES = int(os.environ.get("CACHE_LARGE_BODY_BYTES", 5 * 1024 * 1024))
+# How many large-body keys we remember while waiting for their second request.
+ADMISSION_MEMORY = 10000
+ERROR_TTL_SECONDS = 300
+
+CACHE_POLICY_FILE = os.environ.get("CACHE_POLICY_FILE")
+
+
+class Policy(object):
+    def __init__(self, name, content_types, default_ttl, min_ttl, max_ttl, client_max_age,
+                 revalidate=False):
+        self.name = name
+        self.content_types = tuple(content_types)
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.client_max_age = client_max_age
+        # Clients must revalidate (we inject per-fiddle code into these).
+        self.revalidate = revalidate
+
+
+POLICIES = [
+    Policy("html", ["text/html"], default_ttl=3600, min_ttl=60, max_ttl=DAY, client_max_age=0,
+           revalidate=True),
+    Policy("css", ["text/css"], default_ttl=7 * DAY, min_ttl=3600, max_ttl=30 * DAY, client_max_age=DAY),
+    Policy("script", ["application/javascript", "text/javascript", "application/x-javascript"],
+           default_ttl=7 * DAY, min_ttl=3600, max_ttl=30 * DAY, client_max_age=DAY),
+    Policy("image", ["image/"], default_ttl=30 * DAY, min_ttl=3600, max_ttl=30 * DAY, client_max_age=30 * DAY),
+    Policy("font", ["font/", "application/font", "application/x-font", "application/vnd.ms-fontobject"],
+           default_ttl=30 * DAY, min_ttl=DAY, max_ttl=30 * DAY, client_max_age=30 * DAY),
+    Policy("media", ["video/", "audio/"], default_ttl=7 * DAY, min_ttl=3600, max_ttl=30 * DAY,
+           client_max_age=7 * DAY),
+    Policy("other", [""], default_ttl=DAY, min_ttl=300, max_ttl=30 * DAY, client_max_age=3600),
+]
+
+
+def load_overrides(path, policies):
+    if not path:
+        return
+    try:
+        with open(path) as f:
+            overrides = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Could not load cache policy overrides from %s: %s", path, e)
+        return
+    by_name = {policy.name: policy for policy in policies}
+    for name, fields in overrides.items():
+        policy = by_name.get(name)
+        if policy is None:
+            logging.warning("Unknown cache policy in overrides: %s", name)
+            continue
+        for field, value in fields.items():
+            setattr(policy, field, value)
+
+
+def parse_cache_control(value):
+    """Parse a Cache-Control header into {directive: value or True}."""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else True
+    return directives
+
+
+def upstream_ttl(headers, now):
+    """Freshness lifetime the origin asked for, or None if it didn't say."""
+    directives = parse_cache_control(headers.get("cache-control"))
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]))
+            except (TypeError, ValueError):
+                pass
+    expires = headers.get("expires")
+    if expires:
+        try:
+            return max(0, int(parsedate_to_datetime(expires).timestamp() - now))
+        except (TypeError, ValueError):
+            return 0
+    return None
+
+
+class Decision(object):
+    __slots__ = ("policy", "store", "ttl", "reason")
+
+    def __init__(self, policy, store, ttl, reason):
+        self.policy = policy
+        self.store = store
+        self.ttl = ttl
+        self.reason = reason
+
+
+class CachePolicyEngine(object):
+    def __init__(self, policies=POLICIES, large_body_bytes=LARGE_BODY_BYTES):
+        self.policies = policies
+        self.large_body_bytes = large_body_bytes
+        self._seen_large = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {policy.name: {"hits": 0, "misses": 0, "stored": 0, "rejected": 0}
+                         for policy in policies}
+
+    def classify(self, content_type):
+        content_type = (content_type or "").lower()
+        for policy in self.policies:
+            if any(content_type.startswith(prefix) for prefix in policy.content_types):
+                return policy
+        return self.policies[-1]
+
+    def _admit_large(self, key_name):
+        """Admit a large body only when it was already requested recently."""
+        with self._lock:
+            if key_name in self._seen_large:
+                del self._seen_large[key_name]
+                return True
+            self._seen_large[key_name] = True
+            while len(self._seen_large) > ADMISSION_MEMORY:
+                self._seen_large.popitem(last=False)
+            return False
+
+    def admit_fill(self, key_name, size):
+        """Whether a body of size is worth fetching whole for the cache.  Large bodies count
+        as requested, as in decide(), and pass the second time; decide() then admits them."""
+        if size <= self.large_body_bytes:
+            return True
+        with self._lock:
+            if key_name in self._seen_large:
+                return True
+            self._seen_large[key_name] = True
+            while len(self._seen_large) > ADMISSION_MEMORY:
+                self._seen_large.popitem(last=False)
+            return False
+
+    def decide(self, key_name, status, upstream_headers, content_type, size, now=None):
+        now = time.time() if now is None else now
+        policy = self.classify(content_type)
+        directives = parse_cache_control(upstream_headers.get("cache-control"))
+        if "no-store" in directives or "private" in directives:
+            decision = Decision(policy, False, 0, "no-store")
+        elif status >= 500:
+            decision = Decision(policy, False, 0, "server-error")
+        elif size > self.large_body_bytes and not self._admit_large(key_name):
+            decision = Decision(policy, False, 0, "large-body")
+        elif status != 200:
+            decision = Decision(policy, True, ERROR_TTL_SECONDS, "status")
+        else:
+            ttl = upstream_ttl(upstream_headers, now)
+            if "no-cache" in directives:
+                # We can't revalidate with the origin, so keep it as briefly as allowed.
+                ttl = 0
+            if ttl is None:
+                ttl = policy.default_ttl
+            decision = Decision(policy, True, max(policy.min_ttl, min(policy.max_ttl, ttl)), "fresh")
+        self.counters[policy.name]["stored" if decision.store else "rejected"] += 1
+        return decision
+
+    def client_cache_control(self, content_type, expiry, now=None):
+        """Cache-Control for a response served from an entry expiring at expiry."""
+        policy = self.classify(content_type)
+        if policy.revalidate:
+            return "no-cache"
+        now = time.time() if now is None else now
+        remaining = int(expiry - now) if expiry else policy.client_max_age
+        return "public, max-age=%d" % max(0, min(policy.client_max_age, remaining))
+
+    def record(self, content_type, hit):
+        self.counters[self.classify(content_type).name]["hits" if hit else "misses"] += 1
+
+    def stats(self):
+        stats = {}
+        for name, counts in self.counters.items():
+            lookups = counts["hits"] + counts["misses"]
+            stats[name] = dict(counts, hit_ratio=(counts["hits"] / lookups) if lookups else 0.0)
+        return stats
+
+
+load_overrides(CACHE_POLICY_FILE, POLICIES)
+cache_policy = CachePolicyEngine()
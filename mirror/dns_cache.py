@@ -0,0 +1,214 @@
+"""In-process DNS cache and happy-eyeballs connector for the upstream client.
+
+httpx resolves the origin hostname through the system resolver on every new
+connection.  CachingDNSTransport swaps in a network backend that answers from
+a TTL-bound cache (including negative entries) and races IPv6/IPv4 connection
+attempts (RFC 8305) so one slow address family doesn't stall the fetch.
+
+The resolver is pluggable: pass ``resolver=`` an async callable taking
+``(host, port)`` and returning ``(addresses, ttl)`` where addresses is a list of
+``(family, ip)`` tuples.  Tests use this to run against a stub resolver.
+"""
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+
+import httpcore
+import httpx
+
+import timing
+
+DEFAULT_TTL_SECONDS = 60
+MIN_TTL_SECONDS = 5
+MAX_TTL_SECONDS = 3600
+NEGATIVE_TTL_SECONDS = 30
+MAX_ENTRIES = 10000
+
+# Delay before starting the next connection attempt (RFC 8305 recommends 250ms).
+HAPPY_EYEBALLS_DELAY_SECONDS = 0.25
+
+
+class DNSResolutionError(httpcore.ConnectError):
+    """Raised when a hostname has no usable addresses (possibly cached)."""
+
+
+async def system_resolver(host, port):
+    """Resolve via getaddrinfo.  The system resolver doesn't expose TTLs."""
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = []
+    for family, _, _, _, sockaddr in infos:
+        address = (family, sockaddr[0])
+        if address not in addresses:
+            addresses.append(address)
+    return addresses, None
+
+
+def interleave_families(addresses):
+    """Order addresses IPv6, IPv4, IPv6, ... keeping resolver order per family."""
+    v6 = [a for a in addresses if a[0] == socket.AF_INET6]
+    v4 = [a for a in addresses if a[0] != socket.AF_INET6]
+    ordered = []
+    for i in range(max(len(v6), len(v4))):
+        if i < len(v6):
+            ordered.append(v6[i])
+        if i < len(v4):
+            ordered.append(v4[i])
+    return ordered
+
+
+def _literal_address(host):
+    try:
+        ip = ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        return None
+    family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+    return [(family, str(ip))]
+
+
+class DNSCache(object):
+    def __init__(self, resolver=None, default_ttl=DEFAULT_TTL_SECONDS,
+                 min_ttl=MIN_TTL_SECONDS, max_ttl=MAX_TTL_SECONDS,
+                 negative_ttl=NEGATIVE_TTL_SECONDS, max_entries=MAX_ENTRIES,
+                 clock=time.monotonic):
+        self.resolver = resolver or system_resolver
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # host -> (expires_at, addresses or None for a negative entry)
+        self._entries = {}
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def _clamp_ttl(self, ttl):
+        if ttl is None:
+            ttl = self.default_ttl
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    def _store(self, host, addresses, ttl):
+        if len(self._entries) >= self.max_entries:
+            now = self.clock()
+            for key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+                del self._entries[key]
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+        self._entries[host] = (self.clock() + ttl, addresses)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def resolve(self, host, port=80):
+        """Return a list of (family, ip) for host, raising DNSResolutionError."""
+        literal = _literal_address(host)
+        if literal is not None:
+            return literal
+
+        host = host.lower()
+        entry = self._entries.get(host)
+        if entry is not None and entry[0] > self.clock():
+            if entry[1] is None:
+                self.negative_hits += 1
+                raise DNSResolutionError("Cached resolution failure for %s" % host)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        inflight = self._inflight.get(host)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._lookup(host, port))
+            self._inflight[host] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(host, None))
+        addresses = await asyncio.shield(inflight)
+        if not addresses:
+            raise DNSResolutionError("Could not resolve %s" % host)
+        return addresses
+
+    async def _lookup(self, host, port):
+        try:
+            addresses, ttl = await self.resolver(host, port)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.warning("DNS resolution failed for %s: %s", host, e)
+            addresses, ttl = [], None
+        if addresses:
+            self._store(host, list(addresses), self._clamp_ttl(ttl))
+        else:
+            self._store(host, None, self.negative_ttl)
+        return addresses
+
+
+async def happy_eyeballs_connect(addresses, connect, delay=HAPPY_EYEBALLS_DELAY_SECONDS):
+    """Start connect(address) attempts staggered by delay; first success wins.
+
+    Losing attempts are cancelled, and any that connected anyway are closed.
+    """
+    remaining = interleave_families(addresses)
+    pending = set()
+    errors = []
+    winner = None
+    try:
+        while winner is None and (remaining or pending):
+            if remaining:
+                pending.add(asyncio.ensure_future(connect(remaining.pop(0))))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    await task.result().aclose()
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                await result.aclose()
+    if winner is None:
+        if errors:
+            raise errors[0]
+        raise httpcore.ConnectError("No addresses to connect to")
+    return winner
+
+
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    def __init__(self, dns_cache, backend=None, delay=HAPPY_EYEBALLS_DELAY_SECONDS):
+        self.dns_cache = dns_cache
+        self.backend = backend or httpcore.AnyIOBackend()
+        self.delay = delay
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        with timing.stage("dns"):
+            addresses = await self.dns_cache.resolve(host, port)
+
+        async def connect(address):
+            return await self.backend.connect_tcp(
+                address[1], port, timeout=timeout,
+                local_address=local_address, socket_options=socket_options)
+
+        with timing.stage("connect"):
+            return await happy_eyeballs_connect(addresses, connect, self.delay)
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+class CachingDNSTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, dns_cache, **kwargs):
+        super().__init__(**kwargs)
+        # httpx has no public hook for the network backend, so swap it on the pool.
+        self._pool._network_backend = CachingNetworkBackend(dns_cache)
+
+
+dns_cache = DNSCache()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
+import asyncio
 import hashlib
 import logging
 import os
 import urllib.parse
+from email.utils import formatdate, parsedate_to_datetime
+from collections import Counter
 from pathlib import Path
 from typing import Optional
 
@@ -13,18 +16,36 @@ import time
 import re
 
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, Response
-from fastapi.templating import Jinja2Templates
-
-from models import Fiddle
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+import loadshed
+from admin import is_admin
+import models
+import startup
+import timing
+import warmup
+from metrics import metrics
+from db import ConnectionPool, run_in_db_thread
+from models import Fiddle, default_fiddle, fiddle_views
+from page_cache import etag_matches
+from mirror.cache_admin import CACHE_DB_PATH, HitCounter, host_of
+from mirror.cache_policy import cache_policy
+from mirror import cache_admin
+from mirror.dns_cache import CachingDNSTransport, dns_cache
+from mirror.peers import META_HEADER, encode_meta, peer_cache, token_ok
+from mirror.prefetch import extract_subresources, preload_header, prefetcher
+from mirror.ranges import CHUNK_SIZE, if_range_allows, parse_range, range_response, unsatisfiable_response
+from mirror.ratelimit import client_ip, rate_limiter
+from mirror.shared_cache import LEASE_TABLE_SQL, FetchLeases, HotCache, SingleFlight
 from mirror.transform_content import TransformContent
-from blacklist import BLACKLISTED_URLS
+from mirror.url_normalize import key_aliases, normalize_url
+from blacklist import blacklist_matcher
+from templating import templates
 
 mirror_router = APIRouter()
-templates = Jinja2Templates(directory=".")
 
 DEBUG = False
-EXPIRATION_DELTA_SECONDS = 3600 * 24 * 30
 
 HTTP_PREFIX = "http://"
 
@@ -54,57 +75,145 @@ TRANSFORMED_CONTENT_TYPES = frozenset([
 
 MAX_CONTENT_SIZE = 10 ** 64
 
-# Initialize SQLite database and table for caching mirrored content.
+# cache.db is shared by all workers on the node; map it so hot pages are read from the page cache.
+CACHE_MMAP_BYTES = int(os.environ.get("CACHE_MMAP_BYTES", 256 * 1024 * 1024))
+# What /warmup loads: the most-hit cache entries and the start pages of the most popular fiddles.
+WARMUP_HOT_ENTRIES = int(os.environ.get("WARMUP_HOT_ENTRIES", 200))
+WARMUP_FIDDLES = int(os.environ.get("WARMUP_FIDDLES", 20))
+WARMUP_CONCURRENCY = 4
+
+def create_schema(conn):
+    """Table for caching mirrored content; run on the cache pool's first connection."""
+    with startup.phase("cache.schema"), conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS mirrored_content (
+                key_name TEXT PRIMARY KEY,
+                original_address TEXT,
+                translated_address TEXT,
+                status INTEGER,
+                headers TEXT,
+                data BLOB,
+                base_url TEXT,
+                expiry INTEGER,
+                etag TEXT,
+                fetched INTEGER,
+                host TEXT,
+                hits INTEGER DEFAULT 0,
+                size INTEGER,
+                subresources TEXT
+            )
+        ''')
+        # Columns added after the table was first created.
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(mirrored_content)")]
+        for column, column_type in (("etag", "TEXT"), ("fetched", "INTEGER"), ("host", "TEXT"),
+                                    ("hits", "INTEGER DEFAULT 0"), ("size", "INTEGER"), ("subresources", "TEXT")):
+            if column not in columns:
+                conn.execute("ALTER TABLE mirrored_content ADD COLUMN %s %s" % (column, column_type))
+        # Covers cache_admin.host_stats, so per-host totals never read the bodies; purges use its host prefix.
+        conn.execute("CREATE INDEX IF NOT EXISTS mirrored_content_host_size_hits "
+                     "ON mirrored_content (host, size, hits)")
+        conn.execute("DROP INDEX IF EXISTS mirrored_content_host")
+        # Warmup and the admin API list the most-hit and largest entries; without these that's a
+        # scan through every body.
+        conn.execute("CREATE INDEX IF NOT EXISTS mirrored_content_hits ON mirrored_content (hits)")
+        conn.execute("CREATE INDEX IF NOT EXISTS mirrored_content_size ON mirrored_content (size)")
+        conn.execute(LEASE_TABLE_SQL)
+
+
+# Pooled connections are opened in WAL mode, so readers (request handlers,
+# admin scans) don't block on purges.
+cache_pool = ConnectionPool(CACHE_DB_PATH, pragmas=("mmap_size=%d" % CACHE_MMAP_BYTES,), schema=create_schema)
+
+
 def init_db():
-    conn = sqlite3.connect('cache.db')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS mirrored_content (
-            key_name TEXT PRIMARY KEY,
-            original_address TEXT,
-            translated_address TEXT,
-            status INTEGER,
-            headers TEXT,
-            data BLOB,
-            base_url TEXT,
-            expiry INTEGER
+    """Create the cache tables now instead of on first use."""
+    cache_pool.reset()
+    with cache_pool.connection():
+        pass
+
+cache_hits = HitCounter()
+hot_cache = HotCache()
+cache_admin.purge_listeners.append(hot_cache.clear)
+
+_upstream_client = None
+_upstream_loop = None
+
+
+def get_upstream_client():
+    """Shared upstream client so connections and DNS answers are reused."""
+    global _upstream_client, _upstream_loop
+    loop = asyncio.get_running_loop()
+    if _upstream_client is None or _upstream_loop is not loop:
+        # Pooled connections are bound to the loop that opened them.
+        _upstream_client = httpx.AsyncClient(
+            transport=CachingDNSTransport(dns_cache),
+            max_redirects=3,
+            headers={'Accept-Encoding': 'identity'}  # Disable compression
         )
-    ''')
-    conn.commit()
-    conn.close()
+        _upstream_loop = loop
+    return _upstream_client
+
+
+def content_etag(data):
+    """Strong validator for a cached body."""
+    return '"%s"' % hashlib.sha256(data).hexdigest()[:32]
+
+
+def record_lookup(content_type, hit):
+    timing.annotate(cache="hit" if hit else "miss")
+    cache_policy.record(content_type, hit)
+    metrics.inc("webfiddle_cache_lookups_total", result="hit" if hit else "miss",
+                policy=cache_policy.classify(content_type).name)
+
+
+def record_upstream_error(url, reason):
+    metrics.inc("webfiddle_upstream_errors_total", origin=host_of(url), reason=reason)
 
-init_db()
 
 def get_url_key_name(url):
     url_hash = hashlib.sha256()
-    url_hash.update(url.encode('utf-8'))
+    url_hash.update(normalize_url(url).encode('utf-8'))
     return "hash_" + url_hash.hexdigest()
 
 
 class MirroredContent(object):
     def __init__(self, original_address, translated_address,
-                 status, headers, data, base_url):
+                 status, headers, data, base_url, etag=None, fetched=None, expiry=None, subresources=None,
+                 size=None):
         self.original_address = original_address
         self.translated_address = translated_address
         self.status = status
         self.headers = headers
+        # None when only the metadata was loaded (see get_metadata_by_key_name).
         self.data = data
+        self.size = len(data) if data is not None else size
         self.base_url = base_url
+        # Rows cached before validators were stored get theirs computed on load.
+        self.etag = etag or content_etag(data)
+        self.fetched = fetched
+        self.expiry = expiry
+        # [url, kind] pairs referenced by an HTML page, for prefetching and preload hints.
+        self.subresources = subresources or []
+        # Set when the response must not be cached downstream either.
+        self.cache_control = None
 
     @staticmethod
     def get_by_key_name(key_name):
-        conn = sqlite3.connect('cache.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.execute("SELECT * FROM mirrored_content WHERE key_name = ?", (key_name,))
-        row = cursor.fetchone()
-        if row is None:
-            conn.close()
-            return None
-        current_time = int(time.time())
-        if row['expiry'] < current_time:
-            conn.execute("DELETE FROM mirrored_content WHERE key_name = ?", (key_name,))
-            conn.commit()
-            conn.close()
-            return None
+        with timing.stage("cache_memory"):
+            content = hot_cache.get(key_name)
+        if content is not None:
+            return content
+        with timing.stage("cache_disk"), cache_pool.connection() as conn:
+            cursor = conn.execute("SELECT * FROM mirrored_content WHERE key_name = ?", (key_name,))
+            cursor.row_factory = sqlite3.Row
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            current_time = int(time.time())
+            if row['expiry'] < current_time:
+                conn.execute("DELETE FROM mirrored_content WHERE key_name = ?", (key_name,))
+                conn.commit()
+                return None
         headers = json.loads(row['headers'])
         new_content = MirroredContent(
             original_address=row['original_address'],
@@ -112,42 +221,95 @@ class MirroredContent(object):
             status=row['status'],
             headers=headers,
             data=row['data'],
-            base_url=row['base_url']
+            base_url=row['base_url'],
+            etag=row['etag'],
+            fetched=row['fetched'],
+            expiry=row['expiry'],
+            subresources=json.loads(row['subresources'] or "[]")
         )
-        conn.close()
+        hot_cache.put(key_name, new_content)
         return new_content
 
+    @staticmethod
+    def get_metadata_by_key_name(key_name):
+        """Like get_by_key_name but leaves the body in cache.db; see read_stored_range."""
+        with timing.stage("cache_memory"):
+            content = hot_cache.get(key_name)
+        if content is not None:
+            return content
+        with timing.stage("cache_disk"), cache_pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT original_address, translated_address, status, headers, base_url, etag, fetched, expiry, "
+                "length(data) AS size FROM mirrored_content WHERE key_name = ? AND expiry >= ? AND etag IS NOT NULL",
+                (key_name, int(time.time())))
+            cursor.row_factory = sqlite3.Row
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return MirroredContent(
+            original_address=row['original_address'],
+            translated_address=row['translated_address'],
+            status=row['status'],
+            headers=json.loads(row['headers']),
+            data=None,
+            base_url=row['base_url'],
+            etag=row['etag'],
+            fetched=row['fetched'],
+            expiry=row['expiry'],
+            size=row['size']
+        )
+
+    @staticmethod
+    def read_stored_range(key_name, etag, start, end):
+        """Yield bytes start..end (inclusive) of a stored body without reading the rest."""
+        with cache_pool.connection() as conn:
+            row = conn.execute("SELECT rowid FROM mirrored_content WHERE key_name = ? AND etag = ?",
+                               (key_name, etag)).fetchone()
+            if row is None:
+                # Replaced since the headers went out; cut the response short rather than mix bodies.
+                raise LookupError("cache entry %s changed while streaming" % key_name)
+            with conn.blobopen("mirrored_content", "data", row[0], readonly=True) as blob:
+                blob.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = blob.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
     @staticmethod
     async def fetch_and_store(key_name, base_url, translated_address, mirrored_url):
         """Fetch and cache a page with redirect handling"""
         final_url = mirrored_url
         try:
-            # Add headers to prevent compressed responses
-            async with httpx.AsyncClient(
-                max_redirects=3,
-                headers={'Accept-Encoding': 'identity'}  # Disable compression
-            ) as client:
+            client = get_upstream_client()
+            with timing.stage("fetch"):
                 # First HEAD request to check for redirects
                 head_resp = await client.head(mirrored_url, follow_redirects=True)
-                final_url = str(head_resp.url)
-                
-                # If redirected, update the mirrored URL
-                if final_url != mirrored_url:
-                    translated_address = final_url[len(HTTP_PREFIX):]
-                    mirrored_url = final_url
-                    key_name = get_url_key_name(mirrored_url)
-                    
-                    # Check cache again with new URL
-                    existing = MirroredContent.get_by_key_name(key_name)
-                    if existing:
-                        return existing
+            final_url = str(head_resp.url)
 
+            # If redirected, update the mirrored URL
+            if final_url != mirrored_url:
+                translated_address = final_url[len(HTTP_PREFIX):]
+                mirrored_url = final_url
+                key_name = get_url_key_name(mirrored_url)
+
+                # Check cache again with new URL
+                existing = await run_in_db_thread(MirroredContent.get_by_key_name, key_name)
+                if existing:
+                    return existing
+
+            with timing.stage("fetch"):
                 # Now get the full content
                 response = await client.get(mirrored_url, follow_redirects=True)
-                
+
         except httpx.HTTPError as e:
             logging.exception("Could not fetch URL: %s", e)
+            record_upstream_error(mirrored_url, type(e).__name__)
             return None
+        if response.status_code >= 500:
+            record_upstream_error(mirrored_url, "status_%d" % response.status_code)
 
         # Process response as before...
         adjusted_headers = {}
@@ -162,12 +324,16 @@ class MirroredContent(object):
 
         content = response.content
         page_content_type = adjusted_headers.get("content-type", "")
+        subresources = None
+        if page_content_type.startswith("text/html") and response.status_code == 200:
+            subresources = extract_subresources(content, mirrored_url)
         for content_type in TRANSFORMED_CONTENT_TYPES:
             # startswith() because there could be a 'charset=UTF-8' in the header.
             if page_content_type.startswith(content_type):
                 # Transform and encode to bytes before storage
-                content_str = TransformContent(base_url, mirrored_url, content)
-                content = content_str.encode('utf-8')
+                with timing.stage("transform"):
+                    content_str = TransformContent(base_url, mirrored_url, content)
+                    content = content_str.encode('utf-8')
                 break
 
         # Ensure proper byte handling
@@ -190,30 +356,204 @@ class MirroredContent(object):
             translated_address=translated_address,
             status=response.status_code,
             headers=adjusted_headers,
-            data=content
+            data=content,
+            fetched=int(time.time()),
+            subresources=subresources
         )
+        decision = cache_policy.decide(key_name, response.status_code, response.headers,
+                                       page_content_type, len(content), now=new_content.fetched)
+        record_lookup(page_content_type, hit=False)
+        if not decision.store:
+            logging.info("Not caching %s (%s)", mirrored_url, decision.reason)
+            if decision.reason in ("no-store", "server-error"):
+                new_content.cache_control = "no-store"
+            return new_content
+        new_content.expiry = new_content.fetched + decision.ttl
+        await run_in_db_thread(new_content.store, key_name)
+        return new_content
+
+    def store(self, key_name):
         try:
-            conn = sqlite3.connect('cache.db')
-            conn.execute(
-                "INSERT OR REPLACE INTO mirrored_content "
-                "(key_name, original_address, translated_address, status, headers, data, base_url, expiry) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (key_name, new_content.original_address, new_content.translated_address, new_content.status,
-                 json.dumps(new_content.headers), new_content.data, new_content.base_url,
-                 int(time.time()) + EXPIRATION_DELTA_SECONDS)
-            )
-            conn.commit()
-            conn.close()
+            with cache_pool.connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO mirrored_content "
+                    "(key_name, original_address, translated_address, status, headers, data, base_url, expiry, "
+                    "etag, fetched, host, size, subresources) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key_name, self.original_address, self.translated_address, self.status,
+                     json.dumps(self.headers), self.data, self.base_url,
+                     self.expiry, self.etag, self.fetched,
+                     host_of(self.original_address), len(self.data), json.dumps(self.subresources))
+                )
+                conn.commit()
+            hot_cache.put(key_name, self)
         except Exception as e:
             logging.error('SQLite insert failed: key_name = "%s", original_url = "%s", error: %s',
-                          key_name, mirrored_url, e)
+                          key_name, self.original_address, e)
 
-        return new_content
+    @staticmethod
+    async def fetch_from_peer_or_origin(key_name, base_url, translated_address, mirrored_url):
+        """Fill a miss from the instance that owns the key, else from upstream."""
+        owner = peer_cache.remote_owner(key_name)
+        if owner is not None:
+            with timing.stage("peer"):
+                answer = await peer_cache.fetch(owner, mirrored_url, base_url, translated_address,
+                                                get_upstream_client())
+            if answer is not None:
+                timing.annotate(cache="peer")
+                meta, data = answer
+                content = MirroredContent(
+                    original_address=meta["original_address"],
+                    translated_address=meta["translated_address"],
+                    status=meta["status"],
+                    headers=meta["headers"],
+                    data=data,
+                    base_url=meta["base_url"],
+                    etag=meta["etag"],
+                    fetched=meta["fetched"],
+                    expiry=meta["expiry"],
+                    subresources=meta.get("subresources")
+                )
+                content.cache_control = meta["cache_control"]
+                if content.expiry and content.cache_control != "no-store":
+                    await run_in_db_thread(content.store, key_name)
+                return content
+        return await MirroredContent.fetch_and_store(key_name, base_url, translated_address, mirrored_url)
+
+
+fetch_flight = SingleFlight(FetchLeases(cache_pool), MirroredContent.get_by_key_name)
+
+
+async def fill_cache(fiddle_name, url):
+    """Make sure url is cached the way mirror_handler would; returns (outcome, content)."""
+    if loadshed.is_degraded():
+        return "skipped", None
+    parts = urllib.parse.urlsplit(url)
+    translated_address = parts.netloc + parts.path
+    query = "?" + parts.query if parts.query else ""
+    if blacklist_matcher.match(translated_address + query) is not None:
+        return "skipped", None
+    mirrored_url = normalize_url(HTTP_PREFIX + translated_address + query)
+    key_name = get_url_key_name(mirrored_url)
+    content = MirroredContent.get_by_key_name(key_name)
+    if content is not None:
+        return "cached", content
+    proxy_base = f"{fiddle_name}/{parts.netloc}"
+    content = await fetch_flight.do(key_name, lambda: MirroredContent.fetch_from_peer_or_origin(
+        key_name, proxy_base, translated_address, mirrored_url))
+    return ("fetched" if content is not None else "failed"), content
+
+
+async def prefetch_subresource(fiddle_name, url):
+    """Fill the cache entry for a subresource the way mirror_handler would."""
+    await fill_cache(fiddle_name, url)
+
+
+async def warm_pools(deadline):
+    def open_databases():
+        with models.pool.connection(), cache_pool.connection():
+            pass
+
+    await run_in_db_thread(open_databases)
+    get_upstream_client()
+    return {"opened": ["users.db", "cache.db", "upstream client"]}
+
+
+def load_hot_entries(limit, deadline):
+    """Read the most-hit cache entries into hot_cache, hottest first, while they fit."""
+    # The warmup step may already have timed out waiting for a free db thread.
+    if time.monotonic() > deadline:
+        return {"candidates": 0, "loaded": 0, "bytes": 0}
+    with cache_pool.connection() as conn:
+        rows = cache_admin.top_keys(conn, "hits", limit)
+    loaded = loaded_bytes = 0
+    for row in rows:
+        if not row["hits"] or hot_cache.bytes + row["bytes"] > hot_cache.max_bytes or time.monotonic() > deadline:
+            break
+        if MirroredContent.get_by_key_name(row["key"]) is not None:
+            loaded += 1
+            loaded_bytes += row["bytes"]
+    return {"candidates": len(rows), "loaded": loaded, "bytes": loaded_bytes}
+
+
+async def warm_hot_entries(deadline):
+    return await run_in_db_thread(load_hot_entries, WARMUP_HOT_ENTRIES, deadline)
+
+
+async def warm_popular_fiddles(deadline):
+    """Fetch the start pages of the most popular fiddles, then prefetch their subresources."""
+    fiddles = await Fiddle.popularAsync(WARMUP_FIDDLES)
+    outcomes = Counter()
+    slots = asyncio.Semaphore(WARMUP_CONCURRENCY)
+
+    async def warm(fiddle):
+        fiddle_name = "%s-%s" % (fiddle.title or "fiddle", fiddle.id)
+        start_url = fiddle.start_url.strip()
+        url = start_url if "://" in start_url else HTTP_PREFIX + start_url
+        async with slots:
+            try:
+                outcome, content = await fill_cache(fiddle_name, url)
+            except Exception as e:
+                logging.info("Warmup of %s failed: %s", url, e)
+                outcome, content = "failed", None
+        outcomes[outcome] += 1
+        if content is not None and content.subresources:
+            outcomes["subresources"] += len(content.subresources)
+            prefetcher.schedule([url for url, _ in content.subresources],
+                                lambda url: prefetch_subresource(fiddle_name, url))
+
+    tasks = [asyncio.ensure_future(warm(fiddle)) for fiddle in fiddles]
+    if tasks:
+        # Fetches still running at the deadline finish in the background.
+        _, pending = await asyncio.wait(tasks, timeout=warmup.remaining(deadline))
+        outcomes["pending"] = len(pending)
+    return dict(outcomes, fiddles=len(fiddles))
+
+
+warmup.register("pools", warm_pools, order=10)
+warmup.register("hot_entries", warm_hot_entries, order=30)
+warmup.register("popular_fiddles", warm_popular_fiddles, order=40)
+
+
+@mirror_router.get("/_stats/cache")
+async def cache_stats_handler(request: Request):
+    # The most aliased URLs are what people browse, so only admins see them.
+    return {"policies": cache_policy.stats(), "normalization": key_aliases.stats(top=20 if is_admin(request) else 0),
+            "hot": hot_cache.stats(), "single_flight": fetch_flight.stats(), "prefetch": prefetcher.stats()}
+
+
+@mirror_router.get("/_stats/peers")
+async def peer_stats_handler():
+    return peer_cache.stats()
+
+
+@mirror_router.get("/_peer/cache")
+async def peer_cache_handler(request: Request, url: str, base: str, translated: str):
+    """Serve a cache entry we own to another instance, fetching it upstream if needed."""
+    if not peer_cache.enabled:
+        raise HTTPException(status_code=404)
+    if not token_ok(request.headers.get("x-peer-token")):
+        raise HTTPException(status_code=403)
+    mirrored_url = normalize_url(url)
+    if blacklist_matcher.match(mirrored_url.split("://", 1)[-1]) is not None:
+        raise HTTPException(status_code=403, detail="Access to this URL is not allowed")
+    key_name = get_url_key_name(mirrored_url)
+    content = MirroredContent.get_by_key_name(key_name)
+    if content is None:
+        # Never forward to another peer from here: the owner goes upstream itself.
+        content = await fetch_flight.do(key_name, lambda: MirroredContent.fetch_and_store(
+            key_name, base, translated, mirrored_url))
+    if content is None:
+        raise HTTPException(status_code=404)
+    peer_cache.served += 1
+    return Response(content=content.data, media_type="application/octet-stream",
+                    headers={META_HEADER: encode_meta(content)})
 
 
-@mirror_router.get("/warmup")
-async def warmup_handler():
-    return {"status": "ok"}
+@mirror_router.get("/_stats/blacklist")
+async def blacklist_stats_handler(request: Request):
+    # Rule hits show which sites people try to reach, so only admins see them.
+    return blacklist_matcher.stats(top=20 if is_admin(request) else 0)
 
 
 @mirror_router.get("/", response_class=HTMLResponse)
@@ -354,8 +694,126 @@ document.addEventListener('DOMContentLoaded', () => {{
 """
 
 
+# Changes whenever the markup injected into proxied pages changes.
+INJECTION_VERSION = hashlib.sha256((add_code + big_add_code + request_blocker("")).encode('utf-8')).hexdigest()[:8]
+
+# Headers worth repeating on a 304 (RFC 7232 section 4.1).
+NOT_MODIFIED_HEADERS = ("etag", "last-modified", "cache-control", "expires", "vary", "content-location")
+
+
+def assembled_etag(content, fiddle_name, fiddle):
+    revision = "%s:%s" % (fiddle.id, fiddle.revision) if fiddle else "-"
+    validator = "%s|%s|%s|%s" % (content.etag, fiddle_name, revision, INJECTION_VERSION)
+    return '"%s"' % hashlib.sha256(validator.encode('utf-8')).hexdigest()[:32]
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """Evaluate If-None-Match, or failing that If-Modified-Since, for a GET."""
+    if request.method not in ("GET", "HEAD"):
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return last_modified <= since
+    return False
+
+
+def not_modified_response(headers):
+    return Response(status_code=304, headers={k: v for k, v in headers.items() if k in NOT_MODIFIED_HEADERS})
+
+
+def is_transformed(content_type):
+    return any(content_type.startswith(t) for t in TRANSFORMED_CONTENT_TYPES)
+
+
+async def ranged_response(request, key_name, mirrored_url, fiddle_name):
+    """Answer a Range request from the cache or upstream; None means serve it normally."""
+    with timing.stage("cache"):
+        content = MirroredContent.get_metadata_by_key_name(key_name)
+    if content is None:
+        if loadshed.is_degraded():
+            return None
+        return await forward_range_upstream(request, key_name, mirrored_url, fiddle_name)
+    content_type = content.headers.get('content-type', '')
+    # Transformed bodies (and HTML with its injected fiddle) are always sent whole.
+    if content.status != 200 or is_transformed(content_type):
+        return None
+    headers = dict(content.headers)
+    if not DEBUG:
+        headers["cache-control"] = content.cache_control or cache_policy.client_cache_control(
+            content_type, content.expiry)
+    headers["etag"] = content.etag
+    if content.fetched:
+        headers["last-modified"] = formatdate(content.fetched, usegmt=True)
+    if is_not_modified(request, content.etag, content.fetched):
+        return not_modified_response(headers)
+    if not if_range_allows(request.headers.get("if-range"), content.etag, content.fetched):
+        return None
+    ranges = parse_range(request.headers["range"], content.size)
+    if ranges is None:
+        return None
+    record_lookup(content_type, hit=True)
+    cache_hits.record(key_name)
+    if not ranges:
+        return unsatisfiable_response(content.size)
+    if content.data is not None:
+        read = lambda start, end: iter((content.data[start:end + 1],))
+    else:
+        read = lambda start, end: MirroredContent.read_stored_range(key_name, content.etag, start, end)
+    return range_response(ranges, content.size, headers, read)
+
+
+# Upstream headers passed through on a forwarded 206.
+FORWARDED_RANGE_HEADERS = frozenset([
+    "content-type", "content-range", "content-length", "etag", "last-modified", "accept-ranges",
+])
+
+
+async def forward_range_upstream(request, key_name, mirrored_url, fiddle_name):
+    """Relay a Range request for an uncached object and fill the cache with the whole body in the
+    background, so later ranges are served by ranged_response."""
+    # Byte offsets must be into the plain body: content-encoding isn't relayed.
+    upstream_headers = {"range": request.headers["range"], "accept-encoding": "identity"}
+    if request.headers.get("if-range"):
+        upstream_headers["if-range"] = request.headers["if-range"]
+    client = get_upstream_client()
+    try:
+        with timing.stage("fetch"):
+            response = await client.send(client.build_request("GET", mirrored_url, headers=upstream_headers),
+                                         stream=True, follow_redirects=True)
+    except httpx.HTTPError as e:
+        logging.info("Range request upstream failed for %s: %s", mirrored_url, e)
+        record_upstream_error(mirrored_url, type(e).__name__)
+        return None
+    if (response.status_code != 206 or is_transformed(response.headers.get("content-type", ""))
+            or response.headers.get("content-encoding", "identity").lower() != "identity"):
+        # The origin ignored the range or identity (or the body needs rewriting): fetch and cache it whole instead.
+        await response.aclose()
+        return None
+    timing.annotate(cache="range_upstream")
+    total = response.headers.get("content-range", "").rpartition("/")[2]
+    if total.isdigit() and cache_policy.admit_fill(key_name, int(total)):
+        prefetcher.schedule([mirrored_url], lambda url: fill_cache(fiddle_name, url))
+    headers = {k: v for k, v in response.headers.items() if k.lower() in FORWARDED_RANGE_HEADERS}
+    headers["cache-control"] = "no-store"
+    return StreamingResponse(response.aiter_raw(), status_code=206, headers=headers,
+                             background=BackgroundTask(response.aclose))
+
+
 @mirror_router.get("/{fiddle_name}/{base_url:path}", response_class=HTMLResponse)
 async def mirror_handler(request: Request, fiddle_name: str, base_url: str):
+    # Admission control comes first so limited clients cost as little as possible.
+    retry_after = rate_limiter.check(client_ip(request), fiddle_name)
+    if retry_after:
+        return Response(content="Too many requests", status_code=429,
+                        headers={"retry-after": str(retry_after)}, media_type="text/plain")
+
     # Check for recursive requests.
     user_agent = request.headers.get("user-agent", "")
     if "AppEngine-Google" in user_agent:
@@ -365,35 +823,72 @@ async def mirror_handler(request: Request, fiddle_name: str, base_url: str):
     if base_url.endswith("favicon.ico"):
         return RedirectResponse(url="/favicon.ico", status_code=302)
     
-    # Check if the URL is blacklisted
-    domain = base_url.split('/')[0].lower()  # Get the domain part
-    if domain in BLACKLISTED_URLS:
+    # Check if the URL (domain, path and query) is blacklisted
+    checked_url = base_url + ("?" + request.url.query if request.url.query else "")
+    with timing.stage("blacklist"):
+        blocked_by = blacklist_matcher.match(checked_url)
+    if blocked_by is not None:
         raise HTTPException(status_code=403, detail="Access to this URL is not allowed")
     
     # Parse base_url as domain/path without fiddle prefix
     domain_part = base_url.split('/', 1)[0]
+    timing.annotate(fiddle=fiddle_name, origin=domain_part)
     proxy_base = f"{fiddle_name}/{domain_part}"
     
     # Ensure translated_address includes the full path
     translated_address = base_url
-    mirrored_url = HTTP_PREFIX + translated_address
+    raw_url = HTTP_PREFIX + translated_address + ("?" + request.url.query if request.url.query else "")
+    # Fetch and key on the canonical URL so trivially different requests share an entry.
+    mirrored_url = normalize_url(raw_url)
+    key_aliases.record(raw_url, mirrored_url)
 
     # Use sha256 hash of the mirrored_url for the cache key.
     key_name = get_url_key_name(mirrored_url)
-    content = MirroredContent.get_by_key_name(key_name)
-    if content is None:
-        content = await MirroredContent.fetch_and_store(key_name, proxy_base, translated_address, mirrored_url)
+    if "range" in request.headers:
+        response = await ranged_response(request, key_name, mirrored_url, fiddle_name)
+        if response is not None:
+            return response
+    with timing.stage("cache"):
+        content = MirroredContent.get_by_key_name(key_name)
+    if content is not None:
+        record_lookup(content.headers.get('content-type', ''), hit=True)
+        cache_hits.record(key_name)
+    else:
+        if loadshed.is_degraded():
+            # Overloaded: keep serving cache hits but don't start new upstream fetches.
+            return Response(content="Server busy, please retry", status_code=503,
+                            headers={"retry-after": "5"}, media_type="text/plain")
+        content = await fetch_flight.do(key_name, lambda: MirroredContent.fetch_from_peer_or_origin(
+            key_name, proxy_base, translated_address, mirrored_url))
+        if content is not None and content.subresources:
+            # The browser is about to ask for these one by one; start filling them now.
+            prefetcher.schedule([url for url, _ in content.subresources],
+                                lambda url: prefetch_subresource(fiddle_name, url))
     if content is None:
         raise HTTPException(status_code=404)
     
     headers = dict(content.headers)
     if not DEBUG:
-        headers["cache-control"] = "max-age=%d" % EXPIRATION_DELTA_SECONDS
+        headers["cache-control"] = content.cache_control or cache_policy.client_cache_control(
+            content.headers.get('content-type', ''), content.expiry)
 
     if content.headers.get('content-type', '').startswith('text/html'):
+        fiddle = await Fiddle.byUrlKeyAsync(fiddle_name)
+        if fiddle is not None and fiddle is not default_fiddle:
+            # Pages only: subresources would count every page view many times over.
+            fiddle_views.record(fiddle.id, mirror=True)
+        # The assembled page depends on the cached body and on the fiddle injected into it.
+        headers["etag"] = assembled_etag(content, fiddle_name, fiddle)
+        preload = preload_header(fiddle_name, content.subresources)
+        if preload:
+            headers["link"] = preload
+        if content.status == 200 and is_not_modified(request, headers["etag"]):
+            return not_modified_response(headers)
+
         # Transform content and handle size limits
         content_str = content.data.decode('utf-8') if isinstance(content.data, bytes) else content.data
-        content_str = TransformContent(proxy_base, mirrored_url, content_str)
+        with timing.stage("transform"):
+            content_str = TransformContent(proxy_base, mirrored_url, content_str)
         if len(content_str) > MAX_CONTENT_SIZE:
             logging.warning("Content is over MAX_CONTENT_SIZE; truncating") 
             content_str = content_str[:MAX_CONTENT_SIZE]
@@ -414,14 +909,14 @@ async def mirror_handler(request: Request, fiddle_name: str, base_url: str):
         headers["content-security-policy"] = csp_policy
         
         # Use the properly converted content_str
-        request_blocked_data = re.sub(r'(?i)<head[^>]*>', 
-            lambda m: m.group() + request_blocker(fiddle_name), 
-            content_str,
-            1)
-        add_data = re.sub(r'(?P<tag><body[\w\W]*?>)',
-                          r'\g<tag>' + add_code,
-                          request_blocked_data, 1)
-        fiddle = Fiddle.byUrlKey(fiddle_name)
+        with timing.stage("inject"):
+            request_blocked_data = re.sub(r'(?i)<head[^>]*>',
+                lambda m: m.group() + request_blocker(fiddle_name),
+                content_str,
+                1)
+            add_data = re.sub(r'(?P<tag><body[\w\W]*?>)',
+                              r'\g<tag>' + add_code,
+                              request_blocked_data, 1)
         if fiddle:
             script = str(fiddle.script) if fiddle.script is not None else ""
             style = str(fiddle.style) if fiddle.style is not None else ""
@@ -455,6 +950,14 @@ async def mirror_handler(request: Request, fiddle_name: str, base_url: str):
         else:
             return HTMLResponse(content=add_data, status_code=content.status, headers=headers)
     else:
+        headers["etag"] = content.etag
+        if content.status == 200:
+            headers["accept-ranges"] = "bytes"
+        if content.fetched:
+            headers["last-modified"] = formatdate(content.fetched, usegmt=True)
+        if content.status == 200 and is_not_modified(request, content.etag, content.fetched):
+            return not_modified_response(headers)
+
         # For non-HTML content, use original data but verify length
         content_data = content.data
         if len(content_data) != int(headers.get("content-length", 0)):
@@ -0,0 +1,137 @@
+"""Share mirror cache entries between instances.
+
+Membership is static: PEERS lists every instance's base URL (including this
+one) and PEER_SELF says which of them we are.  Each cache key is owned by one
+instance on a consistent-hash ring; on a miss, a non-owner asks the owner
+over HTTP (GET /_peer/cache) and the owner answers from its cache or fetches
+upstream itself, so a URL leaves the cluster for the origin once.  If the
+owner is down or slow we fall back to fetching upstream directly and back off
+from that peer for a while.
+
+PEER_TOKEN must be set to the same secret on every instance: the peer
+endpoint skips rate limiting and writes to the cache, so without a token
+peering stays off.  With PEERS unset the feature is off too.
+"""
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+import httpx
+
+PEERS = [p.strip().rstrip("/") for p in os.environ.get("PEERS", "").split(",") if p.strip()]
+PEER_SELF = os.environ.get("PEER_SELF", "").rstrip("/")
+PEER_TOKEN = os.environ.get("PEER_TOKEN", "")
+PEER_TIMEOUT_SECONDS = float(os.environ.get("PEER_TIMEOUT_SECONDS", 10))
+PEER_BACKOFF_SECONDS = 30
+VIRTUAL_NODES = 100
+
+META_HEADER = "x-peer-meta"
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing(object):
+    """Consistent hashing with virtual nodes, so adding a peer moves ~1/n keys."""
+
+    def __init__(self, nodes, vnodes=VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        points = sorted((_hash("%s#%d" % (node, i)), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._nodes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def encode_meta(content):
+    return json.dumps({
+        "status": content.status,
+        "headers": content.headers,
+        "original_address": content.original_address,
+        "translated_address": content.translated_address,
+        "base_url": content.base_url,
+        "etag": content.etag,
+        "fetched": content.fetched,
+        "expiry": content.expiry,
+        "cache_control": content.cache_control,
+        "subresources": content.subresources,
+    })
+
+
+def token_ok(token):
+    return bool(PEER_TOKEN) and hmac.compare_digest(token or "", PEER_TOKEN)
+
+
+class PeerCache(object):
+    def __init__(self, peers=PEERS, self_url=PEER_SELF, timeout=PEER_TIMEOUT_SECONDS,
+                 backoff=PEER_BACKOFF_SECONDS, clock=time.monotonic, token=PEER_TOKEN):
+        self.self_url = self_url
+        self.ring = HashRing(peers)
+        self.enabled = len(peers) > 1 and self_url in peers and bool(token)
+        if peers and self_url not in peers:
+            logging.warning("Peer cache disabled: PEER_SELF %r is not one of PEERS", self_url)
+        elif peers and not token:
+            logging.warning("Peer cache disabled: PEER_TOKEN is not set")
+        self.timeout = timeout
+        self.backoff = backoff
+        self.clock = clock
+        self._down_until = {}
+        self.counters = {peer: {"requests": 0, "hits": 0, "misses": 0, "errors": 0, "skipped": 0}
+                         for peer in peers if peer != self_url}
+        self.served = 0
+
+    def remote_owner(self, key_name):
+        """The peer that owns key_name, or None if it's us (or peering is off)."""
+        if not self.enabled:
+            return None
+        owner = self.ring.owner(key_name)
+        return None if owner == self.self_url else owner
+
+    async def fetch(self, owner, mirrored_url, base_url, translated_address, client):
+        """Ask owner for the entry; returns (meta dict, body) or None."""
+        counters = self.counters[owner]
+        if self._down_until.get(owner, 0) > self.clock():
+            counters["skipped"] += 1
+            return None
+        counters["requests"] += 1
+        try:
+            response = await client.get(
+                owner + "/_peer/cache",
+                params={"url": mirrored_url, "base": base_url, "translated": translated_address},
+                headers={"x-peer-token": PEER_TOKEN},
+                timeout=self.timeout,
+                follow_redirects=False,
+            )
+        except httpx.HTTPError as e:
+            logging.warning("Peer %s failed: %s", owner, e)
+            counters["errors"] += 1
+            self._down_until[owner] = self.clock() + self.backoff
+            return None
+        if response.status_code != 200 or META_HEADER not in response.headers:
+            if response.status_code >= 500:
+                counters["errors"] += 1
+            else:
+                counters["misses"] += 1
+            return None
+        counters["hits"] += 1
+        return json.loads(response.headers[META_HEADER]), response.content
+
+    def stats(self):
+        peers = {}
+        for peer, counts in self.counters.items():
+            answered = counts["hits"] + counts["misses"]
+            peers[peer] = dict(counts, hit_ratio=(counts["hits"] / answered) if answered else 0.0,
+                               backing_off=self._down_until.get(peer, 0) > self.clock())
+        return {"enabled": self.enabled, "self": self.self_url, "served": self.served, "peers": peers}
+
+
+peer_cache = PeerCache()
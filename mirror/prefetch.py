@@ -0,0 +1,151 @@
+"""Warm the cache for a page's subresources and tell browsers to preload them.
+
+When an HTML page is fetched upstream, the stylesheets, scripts and images
+it references are recorded with the cache entry.  The first time the page is
+served, those are fetched in the background by a bounded ``Prefetcher`` so the
+browser's follow-up requests are cache hits.  Every HTML response also gets
+``Link: rel=preload`` headers for its first few stylesheets and scripts;
+Cloudflare turns those into 103 Early Hints when Early Hints is enabled for
+the zone (uvicorn can't send 103 responses itself).
+"""
+import asyncio
+import logging
+import os
+import re
+from collections import Counter
+from urllib.parse import quote, urljoin, urlsplit
+
+import timing
+
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", 4))
+# Queued plus running prefetches, in total and per upstream host.
+PREFETCH_MAX_PENDING = int(os.environ.get("PREFETCH_MAX_PENDING", 200))
+PREFETCH_PER_HOST = int(os.environ.get("PREFETCH_PER_HOST", 8))
+MAX_SUBRESOURCES = 30
+PRELOAD_LIMIT = 6
+PRELOAD_TYPES = ("style", "script")
+
+_TAG_RE = re.compile(r"<(link|script|img)\b([^>]*)>", re.IGNORECASE)
+_ATTR_RE = re.compile(r"""([a-zA-Z-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+_PRELOAD_AS = frozenset(["style", "script", "image", "font"])
+
+
+def _attributes(tag_body):
+    return {m.group(1).lower(): m.group(2) or m.group(3) or m.group(4) or ""
+            for m in _ATTR_RE.finditer(tag_body)}
+
+
+def extract_subresources(html, page_url, limit=MAX_SUBRESOURCES):
+    """[url, kind] pairs for the stylesheets, scripts and images html references."""
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors="replace")
+    found = []
+    seen = set()
+    for match in _TAG_RE.finditer(html):
+        tag = match.group(1).lower()
+        attrs = _attributes(match.group(2))
+        if tag == "link":
+            rel = attrs.get("rel", "").lower().split()
+            if "stylesheet" in rel:
+                kind = "style"
+            elif "preload" in rel and attrs.get("as", "").lower() in _PRELOAD_AS:
+                kind = attrs["as"].lower()
+            else:
+                continue
+            ref = attrs.get("href")
+        else:
+            kind = "script" if tag == "script" else "image"
+            ref = attrs.get("src")
+        if not ref:
+            continue
+        url = urljoin(page_url, ref.strip()).split("#", 1)[0]
+        if urlsplit(url).scheme not in ("http", "https") or url in seen:
+            continue
+        seen.add(url)
+        found.append([url, kind])
+        if len(found) >= limit:
+            break
+    return found
+
+
+def mirror_path(fiddle_name, url):
+    """The path this mirror serves url under for fiddle_name, percent-encoded.
+
+    Pages can reference non-ASCII URLs, and headers built from paths must be latin-1.
+    """
+    return quote("/%s/%s" % (fiddle_name, url.split("://", 1)[-1]), safe=":/?&=%;@+,~")
+
+
+def preload_header(fiddle_name, subresources, limit=PRELOAD_LIMIT):
+    links = ["<%s>; rel=preload; as=%s" % (mirror_path(fiddle_name, url), kind)
+             for url, kind in subresources if kind in PRELOAD_TYPES][:limit]
+    return ", ".join(links) or None
+
+
+class Prefetcher(object):
+    """Runs background fetches with global and per-host bounds; excess work is dropped."""
+
+    def __init__(self, concurrency=PREFETCH_CONCURRENCY, max_pending=PREFETCH_MAX_PENDING,
+                 per_host=PREFETCH_PER_HOST):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.per_host = per_host
+        self._pending_by_host = Counter()
+        self._tasks = set()
+        self._slots = None
+        self._loop = None
+        self.counters = {"scheduled": 0, "fetched": 0, "failed": 0, "dropped": 0, "host_limited": 0}
+
+    @property
+    def pending(self):
+        return sum(self._pending_by_host.values())
+
+    def _get_slots(self):
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._slots
+
+    def schedule(self, urls, fetch):
+        """Start fetch(url) in the background for each url that fits within the limits."""
+        loop = asyncio.get_running_loop()
+        for url in urls:
+            host = urlsplit(url).netloc
+            if self.pending >= self.max_pending:
+                self.counters["dropped"] += 1
+                continue
+            if self._pending_by_host[host] >= self.per_host:
+                self.counters["host_limited"] += 1
+                continue
+            self._pending_by_host[host] += 1
+            self.counters["scheduled"] += 1
+            task = loop.create_task(self._run(url, host, fetch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, url, host, fetch):
+        # Tasks copy the request's context; keep their stages out of its timings.
+        timing.detach()
+        try:
+            async with self._get_slots():
+                await fetch(url)
+            self.counters["fetched"] += 1
+        except Exception as e:
+            logging.info("Prefetch of %s failed: %s", url, e)
+            self.counters["failed"] += 1
+        finally:
+            self._pending_by_host[host] -= 1
+            if not self._pending_by_host[host]:
+                del self._pending_by_host[host]
+
+    async def drain(self):
+        """Wait for the prefetches running on this loop (used by tests and benchmarks)."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self):
+        return dict(self.counters, pending=self.pending)
+
+
+prefetcher = Prefetcher()
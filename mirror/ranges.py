@@ -0,0 +1,111 @@
+"""Byte-range (206 Partial Content) responses for cached mirror entries.
+
+Only plain ``bytes`` ranges are supported.  A Range header we can't use is
+ignored and the whole body is sent, as RFC 9110 allows; a range wholly past
+the end of the body is answered with 416.  Bodies are produced by a
+``read(start, end)`` callable yielding chunks, so slices can be streamed
+straight out of cache.db without loading the whole entry.
+"""
+import os
+from email.utils import parsedate_to_datetime
+
+from fastapi.responses import Response, StreamingResponse
+
+# More ranges than this in one request is more likely abuse than a real client.
+MAX_RANGES = 16
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """(start, end) inclusive pairs for a Range header against a body of size bytes.
+
+    Returns None when the header should be ignored and [] when no range is
+    satisfiable.  Overlapping and adjacent ranges are merged.
+    """
+    unit, _, spec = (header or "").partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        if not dash:
+            return None
+        try:
+            if not first.strip():
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last.strip() else size - 1
+                if start < 0 or (last.strip() and end < start):
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_allows(if_range, etag, last_modified):
+    """True if a request's If-Range validator still matches, so the ranges apply."""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith("W/"):
+        # Weak validators never match for ranges.
+        return False
+    try:
+        return last_modified is not None and int(parsedate_to_datetime(if_range).timestamp()) == int(last_modified)
+    except (TypeError, ValueError):
+        return False
+
+
+def unsatisfiable_response(size):
+    return Response(status_code=416, headers={"content-range": "bytes */%d" % size, "accept-ranges": "bytes"})
+
+
+def range_response(ranges, size, headers, read):
+    """A 206 response for ranges of a body; headers are the full response's headers."""
+    content_type = headers.get("content-type", "application/octet-stream")
+    headers = {k: v for k, v in headers.items() if k not in ("content-length", "content-type")}
+    headers["accept-ranges"] = "bytes"
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = "bytes %d-%d/%d" % (start, end, size)
+        headers["content-length"] = str(end - start + 1)
+        return StreamingResponse(read(start, end), status_code=206, headers=headers, media_type=content_type)
+
+    boundary = os.urandom(12).hex()
+    part_headers = [
+        ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+         % (boundary, content_type, start, end, size)).encode("latin-1")
+        for start, end in ranges
+    ]
+    closing = ("\r\n--%s--\r\n" % boundary).encode("latin-1")
+    headers["content-length"] = str(sum(len(h) for h in part_headers) + len(closing)
+                                    + sum(end - start + 1 for start, end in ranges))
+
+    def parts():
+        for part_header, (start, end) in zip(part_headers, ranges):
+            yield part_header
+            yield from read(start, end)
+        yield closing
+
+    return StreamingResponse(parts(), status_code=206, headers=headers,
+                             media_type="multipart/byteranges; boundary=" + boundary)
@@ -0,0 +1,173 @@
+"""Token-bucket rate limiting shared by all workers on the machine.
+
+Buckets live in a small SQLite database so every gunicorn worker on the
+machine draws from the same budget.  Each check is one UPSERT statement that
+refills the bucket for the time elapsed since its last use and takes a token
+if one is available.
+
+Rates are tokens per second; a rate of 0 disables that limit.
+
+Clients are told apart by address.  X-Forwarded-For is only believed when
+the connection comes from one of TRUSTED_PROXIES (comma-separated addresses
+or networks; "cloudflare" stands for Cloudflare's published ranges), and
+then the client is the rightmost hop that isn't a trusted proxy, since
+anything to the left of that was written by the client itself.
+TRUSTED_PROXIES defaults to loopback, which is where a cloudflared tunnel on
+the same machine connects from; from there CF-Connecting-IP is also believed
+when X-Forwarded-For names nobody but trusted proxies.
+"""
+import ipaddress
+import logging
+import math
+import os
+import sqlite3
+import time
+
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", "ratelimit.db")
+
+IP_BURST = float(os.environ.get("RATE_LIMIT_IP_BURST", 120))
+IP_RATE = float(os.environ.get("RATE_LIMIT_IP_RATE", 20))
+FIDDLE_BURST = float(os.environ.get("RATE_LIMIT_FIDDLE_BURST", 1200))
+FIDDLE_RATE = float(os.environ.get("RATE_LIMIT_FIDDLE_RATE", 200))
+GLOBAL_BURST = float(os.environ.get("RATE_LIMIT_GLOBAL_BURST", 0))
+GLOBAL_RATE = float(os.environ.get("RATE_LIMIT_GLOBAL_RATE", 0))
+
+CLOUDFLARE_RANGES = (
+    "173.245.48.0/20", "103.21.244.0/22", "103.22.200.0/22", "103.31.4.0/22", "141.101.64.0/18",
+    "108.162.192.0/18", "190.93.240.0/20", "188.114.96.0/20", "197.234.240.0/22", "198.41.128.0/17",
+    "162.158.0.0/15", "104.16.0.0/13", "104.24.0.0/14", "172.64.0.0/13", "131.0.72.0/22",
+    "2400:cb00::/32", "2606:4700::/32", "2803:f800::/32", "2405:b500::/32", "2405:8100::/32",
+    "2a06:98c0::/29", "2c0f:f248::/32",
+)
+
+# Buckets idle for this long are full again and can be dropped.
+STALE_BUCKET_SECONDS = 3600
+CLEANUP_EVERY_CHECKS = 10000
+
+TAKE_TOKEN_SQL = """
+    INSERT INTO rate_buckets (key, tokens, updated, allowed) VALUES (:key, :burst - 1, :now, 1)
+    ON CONFLICT(key) DO UPDATE SET
+        allowed = min(:burst, tokens + (:now - updated) * :rate) >= 1,
+        tokens = min(:burst, tokens + (:now - updated) * :rate)
+                 - (min(:burst, tokens + (:now - updated) * :rate) >= 1),
+        updated = :now
+    RETURNING tokens, allowed
+"""
+
+
+class RateLimiter(object):
+    def __init__(self, db_path=RATE_LIMIT_DB, clock=time.time):
+        self.db_path = db_path
+        self.clock = clock
+        self._conn = None
+        self._pid = None
+        self._checks = 0
+        self.limited = 0
+
+    def _connection(self):
+        # Connections must not be shared across a fork, so reopen per worker.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("PRAGMA busy_timeout=100")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    allowed INTEGER NOT NULL
+                )"""
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def take(self, key, burst, rate):
+        """Take a token from bucket key; return 0 if allowed, else seconds to wait."""
+        if rate <= 0 or burst <= 0:
+            return 0
+        now = self.clock()
+        conn = self._connection()
+        tokens, allowed = conn.execute(
+            TAKE_TOKEN_SQL, {"key": key, "burst": burst, "rate": rate, "now": now}
+        ).fetchone()
+        self._checks += 1
+        if self._checks % CLEANUP_EVERY_CHECKS == 0:
+            conn.execute("DELETE FROM rate_buckets WHERE updated < ?", (now - STALE_BUCKET_SECONDS,))
+        if allowed:
+            return 0
+        return (1 - tokens) / rate
+
+    def reset(self, key):
+        """Refill bucket key completely."""
+        try:
+            self._connection().execute("DELETE FROM rate_buckets WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logging.warning("Rate limiter unavailable: %s", e)
+
+    def check(self, client_ip, fiddle_name):
+        """Return the Retry-After seconds for a request, or 0 when it may proceed."""
+        limits = [
+            ("ip:" + client_ip, IP_BURST, IP_RATE),
+            ("fiddle:" + fiddle_name, FIDDLE_BURST, FIDDLE_RATE),
+            ("global", GLOBAL_BURST, GLOBAL_RATE),
+        ]
+        try:
+            for key, burst, rate in limits:
+                wait = self.take(key, burst, rate)
+                if wait > 0:
+                    self.limited += 1
+                    return max(1, int(math.ceil(wait)))
+        except sqlite3.Error as e:
+            # Fail open: a locked or broken limiter shouldn't take the site down.
+            logging.warning("Rate limiter unavailable: %s", e)
+        return 0
+
+
+def parse_networks(value):
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if item.lower() == "cloudflare":
+            networks.extend(ipaddress.ip_network(network) for network in CLOUDFLARE_RANGES)
+        elif item:
+            networks.append(ipaddress.ip_network(item, strict=False))
+    return networks
+
+
+TRUSTED_PROXIES = parse_networks(os.environ.get("TRUSTED_PROXIES", "127.0.0.1/32,::1"))
+
+
+def _is_trusted(address, trusted):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted)
+
+
+def _is_loopback(address):
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+def client_ip(request, trusted=None):
+    """The connecting address, or behind trusted proxies the rightmost X-Forwarded-For hop they didn't add."""
+    trusted = TRUSTED_PROXIES if trusted is None else trusted
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted(peer, trusted):
+        return peer
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted(hop, trusted):
+            return hop
+    if _is_loopback(peer) and request.headers.get("cf-connecting-ip"):
+        # Only a local process, i.e. the tunnel, can connect from loopback.
+        return request.headers["cf-connecting-ip"].strip()
+    return hops[0] if hops else peer
+
+
+rate_limiter = RateLimiter()
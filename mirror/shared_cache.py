@@ -0,0 +1,207 @@
+"""Coalesce cache misses within a worker and across the workers on a node.
+
+cache.db is already shared by every gunicorn worker on the machine, so it is
+the node-local tier; in front of it each worker keeps a small ``HotCache`` of
+recently served entries.  What the workers did not share was the work of
+filling a miss: one new hot URL was fetched once per worker.
+
+``SingleFlight`` fixes that in two steps.  Concurrent requests in the same
+worker await a single future.  Across workers, the first one to insert a
+row into the ``fetch_leases`` table does the fetch while the others poll
+cache.db until the entry appears or the lease is released or expires.
+Lease changes and those polls are blocking SQLite calls, so they run on the
+db thread pool rather than the event loop.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from db import run_in_db_thread
+
+HOT_CACHE_BYTES = int(os.environ.get("HOT_CACHE_BYTES", 64 * 1024 * 1024))
+HOT_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+# Other workers can purge cache.db, so don't serve from memory for long.
+HOT_CACHE_MAX_AGE = int(os.environ.get("HOT_CACHE_MAX_AGE", 30))
+
+FETCH_LEASE_SECONDS = int(os.environ.get("FETCH_LEASE_SECONDS", 30))
+POLL_INITIAL_SECONDS = 0.01
+POLL_MAX_SECONDS = 0.25
+
+LEASE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS fetch_leases (
+        key_name TEXT PRIMARY KEY,
+        owner TEXT,
+        expires REAL
+    )
+"""
+
+# Take the lease if nobody holds it or the holder's lease ran out (it died mid-fetch).
+ACQUIRE_LEASE_SQL = """
+    INSERT INTO fetch_leases (key_name, owner, expires) VALUES (?, ?, ?)
+    ON CONFLICT(key_name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+    WHERE fetch_leases.expires < ?
+    RETURNING owner
+"""
+
+RELEASE_LEASE_SQL = "DELETE FROM fetch_leases WHERE key_name = ? AND owner = ?"
+LEASE_HELD_SQL = "SELECT 1 FROM fetch_leases WHERE key_name = ? AND expires >= ?"
+
+
+class HotCache(object):
+    """Per-worker LRU of small cache entries, bounded by total body bytes."""
+
+    def __init__(self, max_bytes=HOT_CACHE_BYTES, max_entry_bytes=HOT_CACHE_MAX_ENTRY_BYTES,
+                 max_age=HOT_CACHE_MAX_AGE, clock=time.time):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_age = max_age
+        self.clock = clock
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_name):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key_name)
+            if entry is not None:
+                content, stale_at = entry
+                if stale_at > now:
+                    self._entries.move_to_end(key_name)
+                    self.hits += 1
+                    return content
+                self._remove(key_name)
+            self.misses += 1
+            return None
+
+    def put(self, key_name, content):
+        size = len(content.data)
+        if size > self.max_entry_bytes or not content.expiry:
+            return
+        stale_at = min(content.expiry, self.clock() + self.max_age)
+        with self._lock:
+            self._remove(key_name)
+            self._entries[key_name] = (content, stale_at)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key_name):
+        entry = self._entries.pop(key_name, None)
+        if entry is not None:
+            self.bytes -= len(entry[0].data)
+
+    def clear(self, *args):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "hit_ratio": (self.hits / lookups) if lookups else 0.0}
+
+
+class FetchLeases(object):
+    """Cross-process "I'm fetching this key" markers stored in cache.db."""
+
+    def __init__(self, pool, lease_seconds=FETCH_LEASE_SECONDS, clock=time.time):
+        self.pool = pool
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+
+    def acquire(self, key_name):
+        """Return an owner token if we now hold the lease, else None."""
+        owner = uuid.uuid4().hex
+        now = self.clock()
+        try:
+            with self.pool.connection() as conn:
+                row = conn.execute(ACQUIRE_LEASE_SQL, (key_name, owner, now + self.lease_seconds, now)).fetchone()
+                conn.commit()
+        except sqlite3.Error as e:
+            # Without the lease table we just lose coalescing; fetch anyway.
+            logging.warning("Fetch lease unavailable for %s: %s", key_name, e)
+            return owner
+        return owner if row is not None else None
+
+    def release(self, key_name, owner):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute(RELEASE_LEASE_SQL, (key_name, owner))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.warning("Could not release fetch lease for %s: %s", key_name, e)
+
+    def held(self, key_name):
+        with self.pool.connection() as conn:
+            return conn.execute(LEASE_HELD_SQL, (key_name, self.clock())).fetchone() is not None
+
+
+class SingleFlight(object):
+    """Run at most one fetch per key per node; everyone else shares its result."""
+
+    def __init__(self, leases, lookup):
+        self.leases = leases
+        # lookup(key_name) -> cached content or None; used while waiting on another worker.
+        self.lookup = lookup
+        self._inflight = {}
+        self.counters = {"leader": 0, "joined": 0, "waited": 0, "waited_hit": 0}
+
+    async def do(self, key_name, fetch):
+        future = self._inflight.get(key_name)
+        if future is not None:
+            self.counters["joined"] += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key_name] = future
+        try:
+            result = await self._fetch_once(key_name, fetch)
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody else may be waiting; don't log "exception never retrieved".
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key_name]
+
+    async def _fetch_once(self, key_name, fetch):
+        delay = POLL_INITIAL_SECONDS
+        waited = False
+        while True:
+            owner = await run_in_db_thread(self.leases.acquire, key_name)
+            if owner is not None:
+                break
+            # Another worker is fetching it: wait for its result to land in cache.db.
+            waited = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_SECONDS)
+            content = await run_in_db_thread(self.lookup, key_name)
+            if content is not None:
+                self.counters["waited_hit"] += 1
+                return content
+        if waited:
+            self.counters["waited"] += 1
+            # The other worker may have stored it between our last poll and its release.
+            content = await run_in_db_thread(self.lookup, key_name)
+            if content is not None:
+                await run_in_db_thread(self.leases.release, key_name, owner)
+                self.counters["waited_hit"] += 1
+                return content
+        self.counters["leader"] += 1
+        try:
+            return await fetch()
+        finally:
+            await run_in_db_thread(self.leases.release, key_name, owner)
+
+    def stats(self):
+        return dict(self.counters, inflight=len(self._inflight))
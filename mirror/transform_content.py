@@ -2,6 +2,8 @@ import os
 import re
 from urllib.parse import urlparse
 
+import startup
+
 # Unique marker to prevent re-transformation
 MARKER = "###TRANSFORMED###"
 
@@ -47,14 +49,24 @@ UNCOMPILED_REGEXES = [
         r"url('/%(fiddle)s/\g<4>\g<5>')"),
 ]
 
-REPLACEMENT_REGEXES = []
-for reg, replace in UNCOMPILED_REGEXES:
-    try:
-        REPLACEMENT_REGEXES.append((re.compile(reg), replace))
-    except Exception as e:
-        print(f"Failed to compile regex: {reg}")
-        print(f"Error: {e}")
-        raise
+_replacement_regexes = None
+
+
+def replacement_regexes():
+    """UNCOMPILED_REGEXES, compiled the first time content is transformed."""
+    global _replacement_regexes
+    if _replacement_regexes is None:
+        compiled = []
+        with startup.phase("transform.regexes"):
+            for reg, replace in UNCOMPILED_REGEXES:
+                try:
+                    compiled.append((re.compile(reg), replace))
+                except Exception as e:
+                    print(f"Failed to compile regex: {reg}")
+                    print(f"Error: {e}")
+                    raise
+        _replacement_regexes = compiled
+    return _replacement_regexes
 
 ################################################################################
 
@@ -89,7 +101,7 @@ def TransformContent(base_url, accessed_url, content):
     }
 
     # Add validation for substitution patterns
-    for pattern, replacement in REPLACEMENT_REGEXES:
+    for pattern, replacement in replacement_regexes():
         try:
             rep_string = replacement % sub_dict
             content = pattern.sub(rep_string, content)
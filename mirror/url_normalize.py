@@ -0,0 +1,122 @@
+"""Normalize mirrored URLs before they are hashed into cache keys.
+
+Without this, ``?b=2&a=1`` and ``?a=1&b=2``, ``utm_*`` tracking parameters,
+``EXAMPLE.com`` and ``example.com:80`` all become separate cache entries and
+separate upstream fetches.  Each rule can be switched off with an environment
+variable (CACHE_KEY_SORT_QUERY=0, ...), and CACHE_KEY_STRIP_PARAMS adds
+comma-separated parameter names (or ``prefix_*`` patterns) to the denylist.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+
+def _flag(name, default=True):
+    return os.environ.get(name, "1" if default else "0") not in ("0", "false", "False", "")
+
+
+SORT_QUERY = _flag("CACHE_KEY_SORT_QUERY")
+STRIP_TRACKING_PARAMS = _flag("CACHE_KEY_STRIP_TRACKING")
+LOWERCASE_HOST = _flag("CACHE_KEY_LOWERCASE_HOST")
+COLLAPSE_DEFAULT_PORTS = _flag("CACHE_KEY_COLLAPSE_PORTS")
+
+TRACKING_PARAMS = [
+    "utm_*",
+    "fbclid",
+    "gclid",
+    "dclid",
+    "gbraid",
+    "wbraid",
+    "msclkid",
+    "yclid",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "_ga",
+    "_gl",
+    "ref_src",
+] + [p.strip() for p in os.environ.get("CACHE_KEY_STRIP_PARAMS", "").split(",") if p.strip()]
+
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+# Bounds for the raw-URL-per-key report.
+MAX_TRACKED_KEYS = 10000
+MAX_VARIANTS_PER_KEY = 100
+
+
+def _is_tracking_param(name, exact, prefixes):
+    name = name.lower()
+    return name in exact or name.startswith(prefixes)
+
+
+_EXACT_TRACKING = frozenset(p.lower() for p in TRACKING_PARAMS if not p.endswith("*"))
+_PREFIX_TRACKING = tuple(p[:-1].lower() for p in TRACKING_PARAMS if p.endswith("*"))
+
+
+def normalize_url(url, sort_query=SORT_QUERY, strip_tracking=STRIP_TRACKING_PARAMS,
+                  lowercase_host=LOWERCASE_HOST, collapse_ports=COLLAPSE_DEFAULT_PORTS):
+    """Return the canonical form of url used for cache keys and upstream fetches."""
+    scheme, netloc, path, query, _ = urlsplit(url)
+    scheme = scheme.lower()
+    if lowercase_host:
+        netloc = netloc.lower()
+    if collapse_ports and ":" in netloc:
+        host, _, port = netloc.rpartition(":")
+        if DEFAULT_PORTS.get(scheme) == port:
+            netloc = host
+    if not path:
+        path = "/"
+    if query:
+        # Work on the raw "name=value" pieces so the origin sees the same encoding.
+        params = [param for param in query.split("&") if param]
+        if strip_tracking:
+            params = [param for param in params
+                      if not _is_tracking_param(unquote_plus(param.split("=", 1)[0]),
+                                                _EXACT_TRACKING, _PREFIX_TRACKING)]
+        if sort_query:
+            # By name only: the sort is stable, so repeated names keep their order (?id=2&id=1).
+            params.sort(key=lambda param: param.split("=", 1)[0])
+        query = "&".join(params)
+    # Fragments never reach the origin, so they never belong in the key.
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+class KeyAliasTracker(object):
+    """Counts how many distinct raw URLs were folded into each normalized URL."""
+
+    def __init__(self, max_keys=MAX_TRACKED_KEYS, max_variants=MAX_VARIANTS_PER_KEY):
+        self.max_keys = max_keys
+        self.max_variants = max_variants
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, raw_url, normalized_url):
+        raw_digest = hashlib.blake2b(raw_url.encode("utf-8"), digest_size=8).digest()
+        with self._lock:
+            variants = self._variants.get(normalized_url)
+            if variants is None:
+                variants = self._variants[normalized_url] = set()
+                while len(self._variants) > self.max_keys:
+                    self._variants.popitem(last=False)
+            else:
+                self._variants.move_to_end(normalized_url)
+            if len(variants) < self.max_variants:
+                variants.add(raw_digest)
+
+    def stats(self, top=20):
+        with self._lock:
+            counts = [(url, len(variants)) for url, variants in self._variants.items()]
+        counts.sort(key=lambda item: item[1], reverse=True)
+        keys = len(counts)
+        distinct_raw = sum(count for _, count in counts)
+        return {
+            "normalized_keys": keys,
+            "distinct_raw_urls": distinct_raw,
+            "raw_urls_per_key": (distinct_raw / keys) if keys else 0.0,
+            "top_keys": [url_count for url_count in counts[:top] if url_count[1] > 1],
+        }
+
+
+key_aliases = KeyAliasTracker()
@@ -1,18 +1,113 @@
-import sqlite3
 from dataclasses import dataclass, asdict, field
 from datetime import datetime
 from pathlib import Path
+import base64
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
 import fixtures
+import startup
+from db import ConnectionPool, run_in_db_thread, submit_to_db_thread
 
 current_dir = Path(__file__).parent
 DATABASE_PATH = current_dir / "users.db"
 
-def get_connection():
-    return sqlite3.connect(DATABASE_PATH)
+FIDDLE_COLUMNS = "id, title, description, start_url, script, style, script_language, style_language, revision"
 
-def init_db():
-    conn = get_connection()
-    with conn:
+SAVE_FIDDLE_SQL = """INSERT INTO fiddles (id, title, description, start_url, script, style, script_language, style_language)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        title=excluded.title,
+        description=excluded.description,
+        start_url=excluded.start_url,
+        script=excluded.script,
+        style=excluded.style,
+        script_language=excluded.script_language,
+        style_language=excluded.style_language,
+        revision=fiddles.revision + 1,
+        updated=CURRENT_TIMESTAMP"""
+
+FIDDLE_BY_ID_SQL = "SELECT " + FIDDLE_COLUMNS + " FROM fiddles WHERE id=?"
+
+# Popularity is a view count that halves every POPULARITY_HALF_LIFE seconds.  Rather
+# than decaying every row over time, each view is stored with weight
+# 2^((t - POPULARITY_EPOCH) / half life), which keeps the ranking identical; rows hold
+# log2 of their summed weights so the numbers stay small.  Decayed score at time
+# now: 2^(score - (now - POPULARITY_EPOCH) / half life).
+POPULARITY_EPOCH = 1700000000
+POPULARITY_HALF_LIFE = float(os.environ.get("POPULARITY_HALF_LIFE_HOURS", 24)) * 3600
+VIEW_FLUSH_SECONDS = 10
+VIEW_FLUSH_PENDING = 500
+
+RECORD_VIEWS_SQL = """INSERT INTO fiddle_views (fiddle_id, views, mirror_views, score, last_viewed)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(fiddle_id) DO UPDATE SET
+        views=views + excluded.views,
+        mirror_views=mirror_views + excluded.mirror_views,
+        score=log2_add(score, excluded.score),
+        last_viewed=excluded.last_viewed"""
+
+# Both read fiddle_views in score order off fiddle_views_score, never sorting the table
+# (CROSS JOIN keeps SQLite from putting fiddles in the outer loop).
+TOP_FIDDLES_SQL = """SELECT v.fiddle_id, f.title, v.views, v.mirror_views, v.score, v.last_viewed
+    FROM fiddle_views v LEFT JOIN fiddles f ON f.id = v.fiddle_id ORDER BY v.score DESC LIMIT ?"""
+POPULAR_FIDDLES_SQL = ("SELECT " + ", ".join("f." + c for c in FIDDLE_COLUMNS.split(", ")) + " FROM fiddle_views v "
+                       "CROSS JOIN fiddles f ON f.id = v.fiddle_id WHERE f.start_url IS NOT NULL AND f.start_url != '' "
+                       "ORDER BY v.score DESC LIMIT ?")
+# Full-text search over fiddles.  fiddles_fts is an external-content FTS5 table: it
+# indexes fiddles' text by rowid without storing a second copy, and the triggers
+# keep it in step with every write to fiddles (Fiddle.save's upsert included).
+# VACUUM can renumber the implicit rowids of fiddles; run rebuild_search_index() after one.
+SEARCH_SCHEMA_SQL = [
+    """CREATE VIRTUAL TABLE fiddles_fts USING fts5(
+        title, description, script,
+        content='fiddles', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    # Matches in titles count most, then descriptions, then scripts.
+    "INSERT INTO fiddles_fts (fiddles_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+    """CREATE TRIGGER fiddles_fts_insert AFTER INSERT ON fiddles BEGIN
+        INSERT INTO fiddles_fts (rowid, title, description, script)
+        VALUES (new.rowid, new.title, new.description, new.script);
+    END""",
+    """CREATE TRIGGER fiddles_fts_delete AFTER DELETE ON fiddles BEGIN
+        INSERT INTO fiddles_fts (fiddles_fts, rowid, title, description, script)
+        VALUES ('delete', old.rowid, old.title, old.description, old.script);
+    END""",
+    """CREATE TRIGGER fiddles_fts_update AFTER UPDATE OF title, description, script ON fiddles BEGIN
+        INSERT INTO fiddles_fts (fiddles_fts, rowid, title, description, script)
+        VALUES ('delete', old.rowid, old.title, old.description, old.script);
+        INSERT INTO fiddles_fts (rowid, title, description, script)
+        VALUES (new.rowid, new.title, new.description, new.script);
+    END""",
+]
+SEARCH_PAGE_SIZE = 20
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Keyset pagination: each page continues after the (rank, rowid) of the last row of the
+# previous one, so deep pages cost the same as the first instead of re-sorting and
+# skipping everything before them the way OFFSET does.  Only the page's rows are
+# joined back to fiddles, after FTS5 has ranked the matches.
+SEARCH_FIDDLES_SQL = """SELECT f.id, f.title, f.description, f.start_url, m.rank, m.rowid FROM (
+        SELECT rowid, rank FROM fiddles_fts WHERE fiddles_fts MATCH ? AND (rank, rowid) > (?, ?)
+        ORDER BY rank, rowid LIMIT ?
+    ) AS m JOIN fiddles f ON f.rowid = m.rowid ORDER BY m.rank, m.rowid"""
+
+RECENT_FIDDLES_SQL = ("SELECT " + FIDDLE_COLUMNS + " FROM fiddles WHERE start_url IS NOT NULL AND start_url != '' "
+                      "ORDER BY updated DESC LIMIT ?")
+
+USER_BY_USERNAME_SQL = "SELECT id, username, password_hash FROM users WHERE username=?"
+CREATE_USER_SQL = "INSERT INTO users (username, password_hash) VALUES (?, ?)"
+UPDATE_PASSWORD_HASH_SQL = "UPDATE users SET password_hash=? WHERE username=?"
+
+# Called with the saved Fiddle after every Fiddle.save, e.g. to drop cached pages.
+save_listeners = []
+
+
+def create_schema(conn):
+    with startup.phase("models.schema"), conn:
         conn.execute(
             """CREATE TABLE IF NOT EXISTS fiddles (
                 id TEXT PRIMARY KEY,
@@ -24,9 +119,15 @@ def init_db():
                 script_language INTEGER,
                 style_language INTEGER,
                 created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                revision INTEGER NOT NULL DEFAULT 0
             )"""
         )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(fiddles)")]
+        if "revision" not in columns:
+            conn.execute("ALTER TABLE fiddles ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+        # For the sitemap's "fiddles updated since" refresh.
+        conn.execute("CREATE INDEX IF NOT EXISTS fiddles_updated ON fiddles (updated)")
         conn.execute(
             """CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -34,7 +135,33 @@ def init_db():
                 password_hash TEXT NOT NULL
             )"""
         )
-    conn.close()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS fiddle_views (
+                fiddle_id TEXT PRIMARY KEY,
+                views INTEGER NOT NULL DEFAULT 0,
+                mirror_views INTEGER NOT NULL DEFAULT 0,
+                score REAL NOT NULL,
+                last_viewed INTEGER
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS fiddle_views_score ON fiddle_views (score DESC)")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'fiddles_fts'").fetchone() is None:
+            for sql in SEARCH_SCHEMA_SQL:
+                conn.execute(sql)
+            # Index the fiddles saved before search existed.
+            conn.execute("INSERT INTO fiddles_fts (fiddles_fts) VALUES ('rebuild')")
+
+
+# The tables are created on first use; see create_schema.
+pool = ConnectionPool(DATABASE_PATH, schema=create_schema)
+
+
+def init_db():
+    """Create the tables now, e.g. after the database file was deleted or replaced."""
+    pool.reset()
+    with pool.connection():
+        pass
+
 
 @dataclass
 class Fiddle:
@@ -46,29 +173,14 @@ class Fiddle:
     title: str = ""
     description: str = ""
     start_url: str = ""
+    revision: int = 0
 
     @classmethod
     def save(cls, obj: "Fiddle"):
-        conn = get_connection()
-        with conn:
-            row = conn.execute("SELECT id FROM fiddles WHERE id=?", (obj.id,)).fetchone()
-            if row:
+        with pool.connection() as conn:
+            with conn:
                 conn.execute(
-                    """UPDATE fiddles SET title=?, description=?, start_url=?, script=?, style=?, script_language=?, style_language=?, updated=CURRENT_TIMESTAMP WHERE id=?""",
-                    (
-                        obj.title,
-                        obj.description,
-                        obj.start_url,
-                        obj.script,
-                        obj.style,
-                        obj.script_language,
-                        obj.style_language,
-                        obj.id,
-                    ),
-                )
-            else:
-                conn.execute(
-                    """INSERT INTO fiddles (id, title, description, start_url, script, style, script_language, style_language) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    SAVE_FIDDLE_SQL,
                     (
                         obj.id,
                         obj.title,
@@ -80,29 +192,41 @@ class Fiddle:
                         obj.style_language,
                     ),
                 )
-        conn.close()
+        for listener in save_listeners:
+            listener(obj)
+
+    @classmethod
+    def fromRow(cls, row) -> "Fiddle":
+        return Fiddle(
+            id=row[0],
+            title=row[1],
+            description=row[2],
+            start_url=row[3],
+            script=row[4],
+            style=row[5],
+            script_language=row[6],
+            style_language=row[7],
+            revision=row[8],
+        )
 
     @classmethod
     def byId(cls, fiddle_id: str) -> "Fiddle | None":
-        conn = get_connection()
-        row = conn.execute(
-            "SELECT id, title, description, start_url, script, style, script_language, style_language FROM fiddles WHERE id=?",
-            (fiddle_id,),
-        ).fetchone()
-        conn.close()
+        with pool.connection() as conn:
+            row = conn.execute(FIDDLE_BY_ID_SQL, (fiddle_id,)).fetchone()
         if row:
-            return Fiddle(
-                id=row[0],
-                title=row[1],
-                description=row[2],
-                start_url=row[3],
-                script=row[4],
-                style=row[5],
-                script_language=row[6],
-                style_language=row[7],
-            )
+            return cls.fromRow(row)
         return None
 
+    @classmethod
+    def popular(cls, limit: int = 20) -> "list[Fiddle]":
+        """Fiddles with a start_url, most popular first, then the most recently updated."""
+        with pool.connection() as conn:
+            rows = conn.execute(POPULAR_FIDDLES_SQL, (limit,)).fetchall()
+            if len(rows) < limit:
+                seen = set(row[0] for row in rows)
+                rows += [row for row in conn.execute(RECENT_FIDDLES_SQL, (limit,)) if row[0] not in seen]
+        return [cls.fromRow(row) for row in rows[:limit]]
+
     @classmethod
     def byUrlKey(cls, urlkey: str) -> "Fiddle | None":
         if not urlkey or urlkey.endswith("d8c4vu"):
@@ -113,6 +237,82 @@ class Fiddle:
         fid = urlkey[pos + 1 :]
         return cls.byId(fid)
 
+    @classmethod
+    def search(cls, text: str, cursor: str = None, limit: int = SEARCH_PAGE_SIZE) -> "tuple[list[dict], str | None]":
+        """Fiddles matching text, best first, and the cursor for the next page (None at the end)."""
+        query = search_query(text)
+        if not query:
+            return [], None
+        after_rank, after_rowid = decode_cursor(cursor)
+        with pool.connection() as conn:
+            rows = conn.execute(SEARCH_FIDDLES_SQL, (query, after_rank, after_rowid, limit + 1)).fetchall()
+        results = [{"id": row[0], "title": row[1], "description": row[2], "start_url": row[3]}
+                   for row in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1][4], rows[limit - 1][5]) if len(rows) > limit else None
+        return results, next_cursor
+
+    @classmethod
+    async def saveAsync(cls, obj: "Fiddle"):
+        await run_in_db_thread(cls.save, obj)
+
+    @classmethod
+    async def byIdAsync(cls, fiddle_id: str) -> "Fiddle | None":
+        return await run_in_db_thread(cls.byId, fiddle_id)
+
+    @classmethod
+    async def byUrlKeyAsync(cls, urlkey: str) -> "Fiddle | None":
+        if not urlkey or urlkey.endswith("d8c4vu"):
+            return default_fiddle
+        return await run_in_db_thread(cls.byUrlKey, urlkey)
+
+    @classmethod
+    async def searchAsync(cls, text: str, cursor: str = None, limit: int = SEARCH_PAGE_SIZE):
+        return await run_in_db_thread(cls.search, text, cursor, limit)
+
+    @classmethod
+    async def popularAsync(cls, limit: int = 20) -> "list[Fiddle]":
+        return await run_in_db_thread(cls.popular, limit)
+
+
+@dataclass
+class User:
+    id: int = 0
+    username: str = ""
+    password_hash: str = ""
+
+    @classmethod
+    def byUsername(cls, username: str) -> "User | None":
+        with pool.connection() as conn:
+            row = conn.execute(USER_BY_USERNAME_SQL, (username,)).fetchone()
+        if row:
+            return User(id=row[0], username=row[1], password_hash=row[2])
+        return None
+
+    @classmethod
+    def create(cls, username: str, password_hash: str):
+        """Insert a new user; raises sqlite3.IntegrityError if the name is taken."""
+        with pool.connection() as conn:
+            with conn:
+                conn.execute(CREATE_USER_SQL, (username, password_hash))
+
+    @classmethod
+    def updatePasswordHash(cls, username: str, password_hash: str):
+        with pool.connection() as conn:
+            with conn:
+                conn.execute(UPDATE_PASSWORD_HASH_SQL, (password_hash, username))
+
+    @classmethod
+    async def byUsernameAsync(cls, username: str) -> "User | None":
+        return await run_in_db_thread(cls.byUsername, username)
+
+    @classmethod
+    async def createAsync(cls, username: str, password_hash: str):
+        await run_in_db_thread(cls.create, username, password_hash)
+
+    @classmethod
+    async def updatePasswordHashAsync(cls, username: str, password_hash: str):
+        await run_in_db_thread(cls.updatePasswordHash, username, password_hash)
+
 # default fiddle
 default_fiddle = Fiddle(
     id="d8c4vu",
@@ -130,4 +330,123 @@ default_fiddle = Fiddle(
     start_url="www.google.com",
 )
 
-init_db()
+
+def search_query(text, max_terms=8):
+    """An FTS5 query matching every word of free text, the last one as a prefix.
+
+    Words are quoted, so FTS5 operators and punctuation typed by users are
+    treated as text rather than query syntax.
+    """
+    words = _WORD_RE.findall(text or "")[:max_terms]
+    if not words:
+        return ""
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def encode_cursor(rank, rowid):
+    return base64.urlsafe_b64encode(("%r:%d" % (rank, rowid)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(rank, rowid) to continue after; the start of the results for no or a bad cursor."""
+    if cursor:
+        try:
+            rank, rowid = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+            return float(rank), int(rowid)
+        except ValueError:
+            pass
+    return float("-inf"), 0
+
+
+def rebuild_search_index():
+    with pool.connection() as conn, conn:
+        conn.execute("INSERT INTO fiddles_fts (fiddles_fts) VALUES ('rebuild')")
+
+
+def log2_add(a, b):
+    """log2(2^a + 2^b) without overflowing."""
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def decayed_score(score, now=None):
+    return 2 ** (score - ((now or time.time()) - POPULARITY_EPOCH) / POPULARITY_HALF_LIFE)
+
+
+def top_fiddles(limit=20, now=None):
+    with pool.connection() as conn:
+        rows = conn.execute(TOP_FIDDLES_SQL, (limit,)).fetchall()
+    return [{"id": fiddle_id, "title": title, "views": views, "mirror_views": mirror_views,
+             "score": round(decayed_score(score, now), 3), "last_viewed": last_viewed}
+            for fiddle_id, title, views, mirror_views, score, last_viewed in rows]
+
+
+class ViewCounter(object):
+    """Buffers fiddle views in memory and writes them to fiddle_views in one batch."""
+
+    def __init__(self, flush_seconds=VIEW_FLUSH_SECONDS, flush_pending=VIEW_FLUSH_PENDING, clock=time.time):
+        self.flush_seconds = flush_seconds
+        self.flush_pending = flush_pending
+        self.clock = clock
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flushing = None
+
+    def record(self, fiddle_id, mirror=False):
+        """Count a view of the fiddle page, or with mirror=True of a page proxied for it.
+
+        Called from request handlers, so a due batch is written on the db thread
+        pool rather than on the event loop.
+        """
+        with self._lock:
+            counts = self._pending.get(fiddle_id)
+            if counts is None:
+                counts = self._pending[fiddle_id] = [0, 0]
+            counts[1 if mirror else 0] += 1
+            if self._flushing is None and (len(self._pending) >= self.flush_pending
+                                           or time.monotonic() - self._last_flush >= self.flush_seconds):
+                self._flushing = submit_to_db_thread(self._background_flush)
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._flushing = None
+
+    def drain(self):
+        """Wait for a batch being written in the background, if any."""
+        flushing = self._flushing
+        if flushing is not None:
+            flushing.result()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        now = self.clock()
+        # Views since the last flush are all weighted as if they happened now.
+        exponent = (now - POPULARITY_EPOCH) / POPULARITY_HALF_LIFE
+        try:
+            with pool.connection() as conn:
+                conn.create_function("log2_add", 2, log2_add, deterministic=True)
+                with conn:
+                    conn.executemany(RECORD_VIEWS_SQL, [
+                        (fiddle_id, views, mirror_views, exponent + math.log2(views + mirror_views), int(now))
+                        for fiddle_id, (views, mirror_views) in pending.items()])
+        except sqlite3.Error as e:
+            # View counts are advisory; never fail a request over them, but keep the batch for the next flush.
+            logging.warning("Could not record fiddle views: %s", e)
+            with self._lock:
+                for fiddle_id, (views, mirror_views) in pending.items():
+                    counts = self._pending.setdefault(fiddle_id, [0, 0])
+                    counts[0] += views
+                    counts[1] += mirror_views
+
+
+fiddle_views = ViewCounter()
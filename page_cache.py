@@ -0,0 +1,81 @@
+"""In-memory cache of rendered fiddle pages.
+
+A fiddle page only changes when the fiddle is saved, so rendered bodies are
+cached per worker under (fiddle id, revision, url, user) and served with a
+strong ETag.  The revision comes from the fiddles row, so a save made on any
+worker changes the key everywhere; Fiddle.save also drops this worker's
+entries for the fiddle straight away.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 2000
+
+
+class CachedPage(object):
+    __slots__ = ("fiddle_id", "body", "etag")
+
+    def __init__(self, fiddle_id, body):
+        self.fiddle_id = fiddle_id
+        self.body = body
+        self.etag = make_etag(body)
+
+
+def make_etag(body):
+    return '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches etag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class PageCache(object):
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            page = self._entries.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, fiddle_id, body):
+        page = CachedPage(fiddle_id, body)
+        with self._lock:
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return page
+
+    def invalidate(self, fiddle_id):
+        with self._lock:
+            for key in [k for k, page in self._entries.items() if page.fiddle_id == fiddle_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+page_cache = PageCache()
@@ -0,0 +1,104 @@
+"""bcrypt hashing off the event loop.
+
+bcrypt is deliberately slow, so hashing inside an ``async def`` route stalls
+every other request on the worker.  PasswordHasher runs it on a small
+dedicated thread pool, caps how many hashes run at once and rejects callers
+that would wait too long for a slot with PasswordBusy.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from mirror.ratelimit import rate_limiter
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+MAX_CONCURRENT_HASHES = int(os.environ.get("BCRYPT_MAX_CONCURRENT", 2))
+MAX_WAITING_HASHES = int(os.environ.get("BCRYPT_MAX_WAITING", 16))
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("BCRYPT_QUEUE_TIMEOUT", 2.0))
+
+# Per-account login attempts: a burst of 10, then one every 30 seconds.
+LOGIN_ATTEMPT_BURST = float(os.environ.get("LOGIN_ATTEMPT_BURST", 10))
+LOGIN_ATTEMPT_RATE = float(os.environ.get("LOGIN_ATTEMPT_RATE", 1 / 30.0))
+
+
+class PasswordBusy(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+def hash_rounds(hashed):
+    """Cost factor of a "$2b$12$..." hash, or None if it can't be parsed."""
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher(object):
+    def __init__(self, rounds=BCRYPT_ROUNDS, max_concurrent=MAX_CONCURRENT_HASHES,
+                 max_waiting=MAX_WAITING_HASHES, queue_timeout=QUEUE_TIMEOUT_SECONDS):
+        self.rounds = rounds
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="bcrypt")
+        self._slots = None
+        self._loop = None
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+            self._loop = loop
+        return self._slots
+
+    async def _run(self, fn, *args):
+        slots = self._semaphore()
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise PasswordBusy()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PasswordBusy()
+        finally:
+            self.waiting -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            slots.release()
+
+    async def hash(self, password):
+        salt = bcrypt.gensalt(rounds=self.rounds)
+        hashed = await self._run(bcrypt.hashpw, password.encode(), salt)
+        return hashed.decode()
+
+    async def verify(self, password, hashed):
+        return await self._run(bcrypt.checkpw, password.encode(), hashed.encode())
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+
+def login_retry_after(username):
+    """Seconds the account must wait before another login attempt, or 0."""
+    try:
+        return rate_limiter.take("login:" + username, LOGIN_ATTEMPT_BURST, LOGIN_ATTEMPT_RATE)
+    except sqlite3.Error as e:
+        logging.warning("Login throttle unavailable: %s", e)
+        return 0
+
+
+def login_succeeded(username):
+    """A correct password clears the account's attempt budget."""
+    rate_limiter.reset("login:" + username)
+
+
+password_hasher = PasswordHasher()
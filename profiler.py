@@ -0,0 +1,288 @@
+"""On-demand sampling profiler for live requests.
+
+Nothing is sampled until an admin asks for it, one profile at a time per
+worker:
+
+* a request carrying ``X-Profile: 1`` and a valid ``X-Admin-Token`` is
+  profiled on its own; the response gets an ``X-Profile-Id`` header.
+* ``POST /_admin/profile?seconds=10`` profiles the worker that answers it
+  for that long (``threads=all`` includes the db thread pool).
+
+A background thread looks at the target thread's Python stack every
+PROFILE_INTERVAL_MS milliseconds; for a single request, samples are only
+kept while that request's task is the one running on the event loop, so
+concurrent traffic doesn't show up in its profile.  Time spent inside C
+functions (regex matching, SQLite, json) is charged to the Python frame
+that called them.
+
+Profiles are saved under PROFILE_DIR so any worker can serve them:
+``GET /_admin/profile/{id}`` has the stage summary and the hottest
+functions, ``GET /_admin/profile/{id}/folded`` the stacks in the collapsed
+format flamegraph.pl, inferno and speedscope read.
+"""
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+import timing
+from admin import is_admin, require_admin
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "webfiddle-profiles"))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", 2)) / 1000
+PROFILE_MAX_SECONDS = 60
+# Saved profiles beyond this many are deleted, oldest first.
+PROFILE_KEEP = 50
+MAX_DEPTH = 100
+TOP_FUNCTIONS = 25
+
+_ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_ID_RE = re.compile(r"^[0-9]+-[0-9a-f]{8}$")
+_paths = {}
+# Held while a profile runs in this worker.
+_busy = threading.Lock()
+
+
+def _short_path(filename):
+    short = _paths.get(filename)
+    if short is None:
+        if filename.startswith(_ROOT):
+            short = filename[len(_ROOT):]
+        elif "site-packages" + os.sep in filename:
+            short = filename.split("site-packages" + os.sep, 1)[1]
+        else:
+            short = os.path.basename(filename)
+        _paths[filename] = short
+    return short
+
+
+def folded_stack(frame, limit=MAX_DEPTH):
+    """frame's stack as "outer;...;inner" function names."""
+    names = []
+    while frame is not None and len(names) < limit:
+        code = frame.f_code
+        names.append("%s (%s:%d)" % (code.co_name, _short_path(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler(object):
+    """Samples the stacks of thread_ids (all threads if None) from a background thread.
+
+    With task set, a sample is only taken while task is running on loop.
+    """
+
+    def __init__(self, thread_ids=None, task=None, loop=None, interval=PROFILE_INTERVAL):
+        self.thread_ids = thread_ids
+        self.task = task
+        self.loop = loop
+        self.interval = interval
+        self.stacks = Counter()
+        self.ticks = 0
+        self.samples = 0
+        self.seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self._started
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            self.ticks += 1
+            if self.task is not None and asyncio.current_task(self.loop) is not self.task:
+                continue
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (self.thread_ids is not None and ident not in self.thread_ids):
+                    continue
+                stack = folded_stack(frame)
+                if self.thread_ids is None or len(self.thread_ids) > 1:
+                    if ident not in names:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                    stack = names.get(ident, "thread-%d" % ident) + ";" + stack
+                self.stacks[stack] += 1
+                self.samples += 1
+
+    def folded(self):
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.stacks.most_common())
+
+    def top(self, limit=TOP_FUNCTIONS):
+        """Functions by self time (innermost frame) and by total time (anywhere on the stack)."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        samples = self.samples or 1
+        return [{"function": name, "self_pct": round(100.0 * count / samples, 1),
+                 "total_pct": round(100.0 * total[name] / samples, 1)}
+                for name, count in own.most_common(limit)]
+
+
+class StageTotals(object):
+    """timing.request_listeners hook summing stage times over the requests in a window."""
+
+    def __init__(self):
+        self.requests = 0
+        self.stages = {}
+
+    def record_request(self, timing, status, content_type, body_bytes):
+        self.requests += 1
+        for name, seconds in list(timing.stages.items()) + [("total", timing.elapsed())]:
+            entry = self.stages.setdefault(name, {"count": 0, "ms": 0.0})
+            entry["count"] += 1
+            entry["ms"] += seconds * 1000
+
+    def summary(self):
+        return {name: {"count": e["count"], "ms": round(e["ms"], 2), "mean_ms": round(e["ms"] / e["count"], 2)}
+                for name, e in sorted(self.stages.items(), key=lambda item: -item[1]["ms"])}
+
+
+def new_profile_id():
+    return "%d-%s" % (time.time(), os.urandom(4).hex())
+
+
+def save_profile(profile_id, sampler, **details):
+    """Write a finished profile to PROFILE_DIR and return its summary (everything but the stacks)."""
+    summary = dict(details, id=profile_id, pid=os.getpid(), started=int(time.time() - sampler.seconds),
+                   seconds=round(sampler.seconds, 3), interval_ms=sampler.interval * 1000,
+                   ticks=sampler.ticks, samples=sampler.samples, top=sampler.top())
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, profile_id + ".json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(dict(summary, folded=sampler.folded()), f)
+    os.replace(path + ".tmp", path)
+    _prune()
+    return summary
+
+
+def _prune(keep=PROFILE_KEEP):
+    names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")),
+                   key=lambda n: os.path.getmtime(os.path.join(PROFILE_DIR, n)))
+    for name in names[:-keep]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def load_profile(profile_id):
+    if not _ID_RE.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, profile_id + ".json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ProfileMiddleware(object):
+    """Profiles single requests that ask for it with X-Profile and an admin token.
+
+    Installed inside TimingMiddleware so the request's stage timings are at hand.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not any(name == b"x-profile" for name, _ in scope.get("headers", ()))
+                or not is_admin(Request(scope)) or not _busy.acquire(blocking=False)):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = new_profile_id()
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", []))
+                               + [(b"x-profile-id", profile_id.encode("latin-1"))])
+            await send(message)
+
+        sampler = Sampler(thread_ids={threading.get_ident()}, task=asyncio.current_task(),
+                          loop=asyncio.get_running_loop())
+        request_timing = timing.current()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            _busy.release()
+            stages = {}
+            if request_timing is not None:
+                stages = {name: round(seconds * 1000, 2) for name, seconds in request_timing.stages.items()}
+                stages["total"] = round(request_timing.elapsed() * 1000, 2)
+            path = scope.get("path", "") + ("?" + scope["query_string"].decode("latin-1")
+                                            if scope.get("query_string") else "")
+            save_profile(profile_id, sampler, kind="request", path=path, stages=stages)
+
+
+profile_router = APIRouter(prefix="/_admin/profile", dependencies=[Depends(require_admin)])
+
+
+@profile_router.post("")
+async def profile_window_handler(seconds: float = 10, threads: str = "loop"):
+    """Profile this worker for seconds while it serves its normal traffic."""
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail="seconds must be between 0 and %d" % PROFILE_MAX_SECONDS)
+    if threads not in ("loop", "all"):
+        raise HTTPException(status_code=400, detail="threads must be 'loop' or 'all'")
+    if not _busy.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running in this worker")
+    stage_totals = StageTotals()
+    sampler = Sampler(thread_ids=None if threads == "all" else {threading.get_ident()})
+    timing.request_listeners.append(stage_totals.record_request)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+        timing.request_listeners.remove(stage_totals.record_request)
+        _busy.release()
+    return save_profile(new_profile_id(), sampler, kind="window", threads=threads,
+                        requests=stage_totals.requests, stages=stage_totals.summary())
+
+
+@profile_router.get("")
+async def profile_list_handler():
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR) if os.path.isdir(PROFILE_DIR) else [], reverse=True):
+        profile = load_profile(name[:-len(".json")]) if name.endswith(".json") else None
+        if profile is not None:
+            profiles.append({k: profile.get(k) for k in ("id", "kind", "path", "pid", "seconds", "samples")})
+    return profiles
+
+
+@profile_router.get("/{profile_id}")
+async def profile_handler(profile_id: str):
+    profile = load_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404)
+    profile.pop("folded")
+    return profile
+
+
+@profile_router.get("/{profile_id}/folded")
+async def profile_folded_handler(profile_id: str):
+    profile = load_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(profile["folded"])
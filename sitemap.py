@@ -0,0 +1,164 @@
+"""Sitemaps for every saved fiddle.
+
+``/sitemap.xml`` is a sitemap index pointing at gzipped child sitemaps,
+``/sitemap-{n}.xml.gz``, of at most SHARD_SIZE fiddles each (the sitemap
+protocol allows 50,000 URLs per file).  Shard n holds the fiddles with
+rowids n * SHARD_SIZE + 1 to (n + 1) * SHARD_SIZE, so a fiddle stays in the
+same shard for good and new fiddles only ever land in the last shards.
+
+Shards are written under SITEMAP_DIR, streaming rows from the fiddles
+table a batch at a time so the table is never held in memory, and shared by
+every worker on the machine.  At most every SITEMAP_REFRESH_SECONDS a
+refresh looks up the fiddles updated since the last one (by the index on
+``fiddles.updated``) and rewrites only the shards they are in.
+"""
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+import models
+
+SITEMAP_DIR = os.environ.get("SITEMAP_DIR", os.path.join(tempfile.gettempdir(), "webfiddle-sitemaps"))
+SITEMAP_REFRESH_SECONDS = float(os.environ.get("SITEMAP_REFRESH_SECONDS", 600))
+SITE_URL = "https://" + os.environ.get("SITE_HOST", "webfiddle.net")
+SHARD_SIZE = 50000
+BATCH_SIZE = 1000
+
+SHARD_ROWS_SQL = """SELECT rowid, id, title, updated FROM fiddles
+    WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?"""
+UPDATED_SINCE_SQL = "SELECT rowid FROM fiddles WHERE updated >= ?"
+
+_STRIP_RE = re.compile(r"[.\t,:;()'@!\\?#/<>&]|[^\x00-\x7f]")
+
+
+def fiddle_path(fiddle_id, title):
+    """The path the editor gives a fiddle: /<title as a slug>-<id> (see webutils.urlencode)."""
+    slug = _STRIP_RE.sub("", re.sub(r"\s", "-", title or "")).lower()
+    return "/" + quote(slug + "-" + fiddle_id)
+
+
+def lastmod(updated):
+    """W3C datetime for a fiddles.updated value (UTC "YYYY-MM-DD HH:MM:SS")."""
+    return updated.replace(" ", "T") + "+00:00" if updated else None
+
+
+class SitemapCache(object):
+    def __init__(self, directory=SITEMAP_DIR, base_url=SITE_URL, shard_size=SHARD_SIZE,
+                 refresh_seconds=SITEMAP_REFRESH_SECONDS, clock=time.time):
+        self.directory = directory
+        self.base_url = base_url
+        self.shard_size = shard_size
+        self.refresh_seconds = refresh_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, "sitemap-%d.xml.gz" % shard)
+
+    def _state_path(self):
+        return os.path.join(self.directory, "state.json")
+
+    def load_state(self):
+        """{"refreshed", "watermark", "shards": {n: {"urls", "lastmod"}}, ...} or None."""
+        try:
+            with open(self._state_path()) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("shard_size") != self.shard_size or state.get("base_url") != self.base_url:
+            return None
+        state["shards"] = {int(n): shard for n, shard in state["shards"].items()}
+        return state
+
+    def _save_state(self, state):
+        path = self._state_path()
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    def _write_shard(self, conn, shard):
+        """Stream shard's fiddles into its file; returns (url count, latest update)."""
+        first = shard * self.shard_size
+        last = first + self.shard_size
+        path = self.shard_path(shard)
+        # Other workers may be refreshing too; each writes its own file and renames it into place.
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        urls, latest = 0, None
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            after = first
+            while True:
+                rows = conn.execute(SHARD_ROWS_SQL, (after, last, BATCH_SIZE)).fetchall()
+                for rowid, fiddle_id, title, updated in rows:
+                    f.write("<url><loc>%s</loc>%s</url>\n" % (
+                        escape(self.base_url + fiddle_path(fiddle_id, title)),
+                        "<lastmod>%s</lastmod>" % lastmod(updated) if updated else ""))
+                    if updated and (latest is None or updated > latest):
+                        latest = updated
+                urls += len(rows)
+                if len(rows) < BATCH_SIZE:
+                    break
+                after = rows[-1][0]
+            f.write("</urlset>\n")
+        if urls:
+            os.replace(tmp, path)
+        else:
+            os.remove(tmp)
+            if os.path.exists(path):
+                os.remove(path)
+        return urls, latest
+
+    def refresh(self, force=False):
+        """Rewrite the shards with fiddles updated since the last refresh (all of them if force
+        or there is no cache yet).  Returns the shard numbers rewritten, or None if the cache
+        was fresh enough."""
+        with self._lock:
+            state = None if force else self.load_state()
+            if state is not None and self.clock() - state["refreshed"] < self.refresh_seconds:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            with models.pool.connection() as conn:
+                # Read before looking for changes: anything saved from here on is at or after it.
+                watermark = conn.execute("SELECT max(updated) FROM fiddles").fetchone()[0]
+                if state is None:
+                    state = {"shards": {}}
+                    max_rowid = conn.execute("SELECT max(rowid) FROM fiddles").fetchone()[0] or 0
+                    dirty = set(range((max_rowid + self.shard_size - 1) // self.shard_size))
+                elif state["watermark"] is None:
+                    dirty = {(rowid - 1) // self.shard_size for (rowid,) in conn.execute("SELECT rowid FROM fiddles")}
+                else:
+                    # updated has one second resolution, so >= rechecks the last second
+                    # of the previous refresh rather than missing saves made during it.
+                    dirty = {(rowid - 1) // self.shard_size
+                             for (rowid,) in conn.execute(UPDATED_SINCE_SQL, (state["watermark"],))}
+                for shard in sorted(dirty):
+                    urls, latest = self._write_shard(conn, shard)
+                    if urls:
+                        state["shards"][shard] = {"urls": urls, "lastmod": lastmod(latest)}
+                    else:
+                        state["shards"].pop(shard, None)
+            state.update(refreshed=self.clock(), watermark=watermark, shard_size=self.shard_size,
+                         base_url=self.base_url)
+            self._save_state(state)
+            return sorted(dirty)
+
+    def index_xml(self):
+        state = self.load_state() or {"shards": {}}
+        entries = []
+        for shard, info in sorted(state["shards"].items()):
+            entries.append("<sitemap><loc>%s/sitemap-%d.xml.gz</loc>%s</sitemap>\n" % (
+                escape(self.base_url), shard, "<lastmod>%s</lastmod>" % info["lastmod"] if info["lastmod"] else ""))
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n%s</sitemapindex>\n'
+                % "".join(entries))
+
+
+sitemaps = SitemapCache()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Cold start accounting.
+
+``with startup.phase("name"):`` times a piece of work done while a worker
+gets ready: creating schemas, loading templates, compiling regexes.  Most
+of these run lazily on first use, so phases can be recorded during the
+first request as well as at import.
+
+To see where a cold start goes, run
+
+    python startup.py [--top 20] [--json]
+
+which imports the app in a fresh interpreter under ``python -X importtime``,
+serves one request for "/", and prints import time per module (this app's
+modules, then third-party packages grouped by top-level package) followed
+by every phase recorded.  ``--compile-templates`` fills the Jinja bytecode
+cache instead, e.g. at deploy time.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Roughly when the worker started: this module is among main's first imports.
+STARTED = time.perf_counter()
+
+# [name, seconds] in the order the phases finished.
+phases = []
+
+_CHILD = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    served = time.perf_counter()
+    client.get("/")
+    done = time.perf_counter()
+import startup
+print(json.dumps({"import_ms": (imported - start) * 1000, "lifespan_ms": (served - imported) * 1000,
+                  "first_request_ms": (done - served) * 1000, "phases": startup.phases}))
+"""
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append([name, time.perf_counter() - start])
+
+
+def summary():
+    """One line for the log: time since startup began and the phases so far."""
+    return "ready after %.0f ms (%s)" % ((time.perf_counter() - STARTED) * 1000,
+                                        ", ".join("%s %.1f ms" % (name, s * 1000) for name, s in phases) or
+                                        "no phases")
+
+
+def _is_local(module):
+    top = module.split(".", 1)[0]
+    return os.path.exists(os.path.join(ROOT, top + ".py")) or os.path.isdir(os.path.join(ROOT, top))
+
+
+def parse_importtime(lines):
+    """{module: (self_us, cumulative_us)} from ``python -X importtime`` output."""
+    modules = {}
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules
+
+
+def import_report(modules, top=20):
+    local = sorted(((name, own, cumulative) for name, (own, cumulative) in modules.items() if _is_local(name)),
+                   key=lambda row: -row[2])
+    packages = {}
+    for name, (own, _) in modules.items():
+        if not _is_local(name):
+            package = name.split(".", 1)[0]
+            packages[package] = packages.get(package, 0) + own
+    return {
+        "total_ms": round(sum(own for own, _ in modules.values()) / 1000, 1),
+        "local": [{"module": name, "self_ms": round(own / 1000, 1), "cumulative_ms": round(cumulative / 1000, 1)}
+                  for name, own, cumulative in local[:top]],
+        "packages": [{"package": name, "ms": round(us / 1000, 1)}
+                     for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]],
+    }
+
+
+def measure(top=20):
+    import subprocess
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", _CHILD], cwd=ROOT, capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        raise RuntimeError("Starting the app failed:\n" + result.stderr[-2000:])
+    child = json.loads(result.stdout.strip().splitlines()[-1])
+    report = import_report(parse_importtime(result.stderr.splitlines()), top)
+    report.update({k: round(child[k], 1) for k in ("import_ms", "lifespan_ms", "first_request_ms")})
+    report["phases"] = [{"phase": name, "ms": round(seconds * 1000, 2)} for name, seconds in child["phases"]]
+    return report
+
+
+def main(argv=None):
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print JSON instead of tables")
+    parser.add_argument("--compile-templates", action="store_true", help="fill the Jinja bytecode cache and exit")
+    args = parser.parse_args(argv)
+
+    if args.compile_templates:
+        sys.path.insert(0, ROOT)
+        import templating
+        logging.basicConfig(level=logging.INFO)
+        print("compiled %d templates into %s" % (templating.precompile(), templating.bytecode_cache_dir()))
+        return
+
+    report = measure(args.top)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    print("import main %.0f ms, startup events %.0f ms, first request %.0f ms (all imports %.0f ms)\n" % (
+        report["import_ms"], report["lifespan_ms"], report["first_request_ms"], report["total_ms"]))
+    print("%10s %10s  %s" % ("self ms", "cumul. ms", "app module"))
+    for row in report["local"]:
+        print("%10.1f %10.1f  %s" % (row["self_ms"], row["cumulative_ms"], row["module"]))
+    print("\n%10s  %s" % ("ms", "package (own import time of all its modules)"))
+    for row in report["packages"]:
+        print("%10.1f  %s" % (row["ms"], row["package"]))
+    print("\n%10s  %s" % ("ms", "phase"))
+    for row in report["phases"]:
+        print("%10.2f  %s" % (row["ms"], row["phase"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""The app's Jinja templates, shared by every router and loaded on first use.
+
+Compiled templates are kept in a bytecode cache (JINJA_CACHE_DIR, by default
+jinja_cache/ next to this file, or the temp directory when that isn't
+writable) so a new worker doesn't parse and compile them again;
+``python startup.py --compile-templates`` fills it at deploy time.
+"""
+import logging
+import os
+import tempfile
+import threading
+
+import startup
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", os.path.join(TEMPLATE_DIR, "jinja_cache"))
+PRECOMPILE_DIRS = ("templates",)
+
+
+def bytecode_cache_dir():
+    for directory in (JINJA_CACHE_DIR, os.path.join(tempfile.gettempdir(), "webfiddle-jinja")):
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(directory, os.W_OK):
+            return directory
+    return None
+
+
+class LazyTemplates(object):
+    """Stands in for a Jinja2Templates, building it (and importing jinja2) on first use."""
+
+    def __init__(self, directory=TEMPLATE_DIR):
+        self.directory = directory
+        self._templates = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._templates is None:
+            with self._lock:
+                if self._templates is None:
+                    with startup.phase("templates"):
+                        import jinja2
+                        from fastapi.templating import Jinja2Templates
+
+                        cache_dir = bytecode_cache_dir()
+                        env = jinja2.Environment(
+                            loader=jinja2.FileSystemLoader(self.directory),
+                            autoescape=True,
+                            bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir) if cache_dir else None,
+                        )
+                        self._templates = Jinja2Templates(env=env)
+        return self._templates
+
+    def __getattr__(self, name):
+        # get_template, TemplateResponse, env, ...
+        return getattr(self._load(), name)
+
+
+templates = LazyTemplates()
+
+
+def precompile():
+    """Compile every template under PRECOMPILE_DIRS into the bytecode cache; returns how many."""
+    count = 0
+    for directory in PRECOMPILE_DIRS:
+        for dirpath, _, filenames in os.walk(os.path.join(TEMPLATE_DIR, directory)):
+            for filename in filenames:
+                if not filename.endswith((".jinja2", ".html")):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename), TEMPLATE_DIR).replace(os.sep, "/")
+                try:
+                    templates.get_template(name)
+                    count += 1
+                except Exception as e:
+                    logging.warning("Could not compile %s: %s", name, e)
+    return count
@@ -0,0 +1,81 @@
+import gzip
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+# Keep rate-limit buckets out of the working directory so runs don't throttle each other.
+os.environ.setdefault("RATE_LIMIT_DB", os.path.join(tempfile.mkdtemp(), "ratelimit.db"))
+os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp())
+os.environ.setdefault("COSTLOG_PATH", os.path.join(tempfile.mkdtemp(), "costlog.jsonl"))
+os.environ.setdefault("PROFILE_DIR", tempfile.mkdtemp())
+os.environ.setdefault("SITEMAP_DIR", tempfile.mkdtemp())
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Serves ``pages`` from the server: path -> (content type, body bytes).
+
+    With ``gzip`` set on the server, bodies are gzipped even for clients asking for
+    identity, as some origins do.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        page = self.server.pages.get(self.path)
+        if page is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content_type, body = page
+        encoded = self.server.gzip
+        if encoded:
+            body = gzip.compress(body)
+        range_header = self.headers.get("Range", "")
+        self.server.range_headers.append(range_header)
+        if range_header.startswith("bytes=") and "," not in range_header:
+            # Single ranges only; enough to check that ranges are relayed.
+            first, _, last = range_header[len("bytes="):].partition("-")
+            start, end = int(first), min(int(last or len(body) - 1), len(body) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(body)))
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if encoded:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        page = self.server.pages.get(self.path)
+        self.send_response(200 if page else 404)
+        self.send_header("Content-Length", str(len(page[1]) if page else 0))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    """A local upstream origin; returns the server, with ``host`` like 127.0.0.1:PORT."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+    server.pages = {}
+    server.requests = []
+    server.range_headers = []
+    server.gzip = False
+    server.host = "127.0.0.1:%d" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
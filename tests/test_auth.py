@@ -30,3 +30,16 @@ def test_register_and_login():
         assert resp.status_code == 400
 
 
+def test_login_succeeds_when_the_rehash_cannot_get_a_slot(monkeypatch):
+    from passwords import PasswordBusy, password_hasher
+
+    async def busy(password):
+        raise PasswordBusy()
+
+    with TestClient(app) as client:
+        client.post('/register', data={'username': 'bob', 'password': 'secret'}, follow_redirects=False)
+        client.get('/logout', follow_redirects=False)
+        monkeypatch.setattr(password_hasher, "needs_rehash", lambda hashed: True)
+        monkeypatch.setattr(password_hasher, "hash", busy)
+        resp = client.post('/login', data={'username': 'bob', 'password': 'secret'}, follow_redirects=False)
+        assert resp.status_code == 302
@@ -0,0 +1,66 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from blacklist import BLACKLISTED_URLS, BlacklistMatcher
+
+
+def test_builtin_path_rules_match():
+    matcher = BlacklistMatcher(BLACKLISTED_URLS)
+    assert matcher.match("cgi4.ebay.com/ws") == "cgi4.ebay.com/ws"
+    assert matcher.match("cgi4.ebay.com/ws/eBayISAPI.dll") == "cgi4.ebay.com/ws"
+    assert matcher.match("CGI4.ebay.com/ws?x=1") == "cgi4.ebay.com/ws"
+    assert matcher.match("www.facebook.com/anything") == "www.facebook.com"
+    assert matcher.match("cgi4.ebay.com/wsx") is None
+    assert matcher.match("cgi4.ebay.com") is None
+    assert matcher.match("www.ebay.com") is None
+    assert matcher.match("example.com/ws") is None
+
+
+def test_trailing_dots_and_doubled_slashes_do_not_bypass_rules():
+    matcher = BlacklistMatcher(BLACKLISTED_URLS)
+    assert matcher.match("cgi4.ebay.com./ws") == "cgi4.ebay.com/ws"
+    assert matcher.match("cgi4.ebay.com//ws") == "cgi4.ebay.com/ws"
+    assert matcher.match("cgi4.ebay.com/ws//eBayISAPI.dll") == "cgi4.ebay.com/ws"
+    assert matcher.match("www.facebook.com.:443//login") == "www.facebook.com"
+    assert matcher.match("cgi4.ebay.com./wsx") is None
+
+
+def test_suffix_rules_and_stats(tmp_path):
+    rules = tmp_path / "rules.txt"
+    rules.write_text("# comment\n*.evil.test\n.phish.test/login\n")
+    matcher = BlacklistMatcher(path=rules)
+    assert matcher.match("evil.test/") == "*.evil.test"
+    assert matcher.match("a.b.evil.test/page") == "*.evil.test"
+    assert matcher.match("notevil.test/") is None
+    assert matcher.match("www.phish.test/login/step2") == ".phish.test/login"
+    assert matcher.match("www.phish.test/about") is None
+
+    stats = matcher.stats()
+    assert stats["rules"] == 2
+    assert stats["lookups"] == 5
+    assert stats["blocked"] == 3
+    assert stats["top_rules"][0] == ("*.evil.test", 2)
+
+
+def test_rules_file_hot_reload(tmp_path):
+    rules = tmp_path / "rules.txt"
+    rules.write_text("first.test\n")
+    matcher = BlacklistMatcher(path=rules, check_interval=0)
+    assert matcher.match("first.test/") == "first.test"
+    assert matcher.match("second.test/") is None
+
+    rules.write_text("second.test\n")
+    stat = rules.stat()
+    os.utime(rules, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert matcher.match("second.test/") == "second.test"
+    assert matcher.match("first.test/") is None
+
+
+def test_large_rule_sets_load(tmp_path):
+    rules = tmp_path / "rules.txt"
+    rules.write_text("".join("host%d.example/path%d\n" % (i, i) for i in range(100000)))
+    matcher = BlacklistMatcher(path=rules)
+    assert matcher.match("host99999.example/path99999/x") == "host99999.example/path99999"
+    assert matcher.match("host99999.example/path1") is None
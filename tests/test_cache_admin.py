@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+
+from fastapi.testclient import TestClient
+
+import admin
+from main import app
+from mirror import cache_admin
+from mirror.cache_admin import HitCounter, backfill_hosts, host_stats, purge, top_keys
+from mirror.mirror import init_db
+
+
+def make_db(tmp_path, rows):
+    conn = sqlite3.connect(str(tmp_path / "cache.db"))
+    conn.execute("CREATE TABLE mirrored_content (key_name TEXT PRIMARY KEY, original_address TEXT, data BLOB, "
+                 "host TEXT, hits INTEGER DEFAULT 0, size INTEGER)")
+    conn.executemany("INSERT INTO mirrored_content (key_name, original_address, data) VALUES (?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+
+def test_backfill_stats_top_and_purge(tmp_path):
+    rows = [("a%d" % i, "http://Big.example.com/static/%d.js" % i, b"x" * 100) for i in range(7)]
+    rows += [("b1", "http://big.example.com/page.html", b"x" * 10), ("c1", "http://small.org/", b"y")]
+    conn = make_db(tmp_path, rows)
+    assert backfill_hosts(conn, batch_size=4) == 9
+
+    stats = host_stats(conn)
+    assert stats["entries"] == 9 and stats["bytes"] == 711
+    assert stats["hosts"][0] == {"host": "big.example.com", "entries": 8, "bytes": 710, "hits": 0}
+    assert top_keys(conn, "size", 1)[0]["bytes"] == 100
+
+    assert purge(conn, prefix="http://Big.example.com/static/", batch_size=3, pause=0) == 7
+    assert purge(conn, host="BIG.example.com") == 1
+    assert [h["host"] for h in host_stats(conn)["hosts"]] == ["small.org"]
+
+
+def test_hit_counter_flushes_in_batches(tmp_path):
+    conn = make_db(tmp_path, [("k", "http://a.com/", b"")])
+    counter = HitCounter(str(tmp_path / "cache.db"), flush_seconds=3600, flush_pending=2)
+    counter.record("k")
+    counter.record("k")
+    assert conn.execute("SELECT hits FROM mirrored_content").fetchone()[0] == 0
+    counter.record("other")
+    counter.drain()
+    assert conn.execute("SELECT hits FROM mirrored_content").fetchone()[0] == 2
+    assert top_keys(conn, "hits")[0]["hits"] == 2
+
+
+def test_admin_endpoints_require_token(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_admin, "CACHE_DB_PATH", str(tmp_path / "cache.db"))
+    make_db(tmp_path, [("k", "http://a.com/", b"abc")])
+    client = TestClient(app)
+
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "")
+    assert client.get("/_admin/cache/stats").status_code == 404
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    assert client.get("/_admin/cache/stats", headers={"x-admin-token": "wrong"}).status_code == 403
+
+    headers = {"x-admin-token": "secret"}
+    assert client.get("/_admin/cache/stats", headers=headers).json()["entries"] == 1
+    assert client.get("/_admin/cache/top?by=nope", headers=headers).status_code == 400
+    assert client.post("/_admin/cache/purge", headers=headers).status_code == 400
+
+
+def test_init_db_adds_host_index():
+    init_db()
+    conn = sqlite3.connect(cache_admin.CACHE_DB_PATH)
+    indexes = [row[1] for row in conn.execute("PRAGMA index_list(mirrored_content)")]
+    assert "mirrored_content_host_size_hits" in indexes and "mirrored_content_host" not in indexes
+
+
+def test_stats_and_top_keys_read_from_indexes(tmp_path):
+    conn = cache_admin.connect(str(tmp_path / "indexed.db"))
+    traced = []
+    conn.set_trace_callback(traced.append)
+    host_stats(conn)
+    top_keys(conn, "size")
+    top_keys(conn, "hits")
+    conn.set_trace_callback(None)
+    plans = [[row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql.replace("LIMIT 20", "LIMIT 1"))]
+             for sql in traced]
+    assert plans[0][0] == "SCAN mirrored_content USING COVERING INDEX mirrored_content_host_size_hits"
+    assert len(plans[1]) == 1 and "USING COVERING INDEX" in plans[1][0]
+    assert plans[2] == ["SCAN mirrored_content USING INDEX mirrored_content_size"]
+    assert plans[3] == ["SCAN mirrored_content USING INDEX mirrored_content_hits"]
+
+
+def test_admin_stats_on_a_fresh_cache_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_admin, "CACHE_DB_PATH", str(tmp_path / "fresh.db"))
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    response = TestClient(app).get("/_admin/cache/stats", headers={"x-admin-token": "secret"})
+    assert response.status_code == 200 and response.json()["entries"] == 0
+
+
+def test_hit_counter_writes_off_the_calling_thread(tmp_path):
+    make_db(tmp_path, [("k", "http://a.com/", b"")])
+    counter = HitCounter(str(tmp_path / "cache.db"), flush_seconds=3600, flush_pending=1)
+    flushed_on = []
+    original = counter.flush
+    counter.flush = lambda: (flushed_on.append(threading.current_thread().name), original())
+    counter.record("k")
+    counter.drain()
+    assert flushed_on and flushed_on[0].startswith("db")
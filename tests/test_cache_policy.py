@@ -0,0 +1,69 @@
+import uuid
+
+from fastapi.testclient import TestClient
+from main import app
+from mirror.cache_policy import CachePolicyEngine, upstream_ttl
+
+NOW = 1700000000
+
+
+def test_ttl_follows_upstream_headers_within_policy_bounds():
+    engine = CachePolicyEngine()
+    decision = engine.decide("k", 200, {"cache-control": "public, max-age=7200"}, "text/css", 100, now=NOW)
+    assert decision.store and decision.ttl == 7200
+    decision = engine.decide("k", 200, {"cache-control": "max-age=5"}, "image/png", 100, now=NOW)
+    assert decision.ttl == engine.classify("image/png").min_ttl
+    decision = engine.decide("k", 200, {}, "text/html; charset=utf-8", 100, now=NOW)
+    assert decision.policy.name == "html"
+    assert decision.ttl == decision.policy.default_ttl
+
+
+def test_no_store_private_and_errors_are_not_cached():
+    engine = CachePolicyEngine()
+    assert not engine.decide("k", 200, {"cache-control": "no-store"}, "text/css", 1, now=NOW).store
+    assert not engine.decide("k", 200, {"cache-control": "private, max-age=60"}, "text/css", 1, now=NOW).store
+    assert not engine.decide("k", 503, {}, "text/html", 1, now=NOW).store
+    assert engine.counters["css"]["rejected"] == 2
+
+
+def test_large_bodies_are_admitted_on_second_request():
+    engine = CachePolicyEngine(large_body_bytes=1000)
+    assert not engine.decide("big", 200, {}, "video/mp4", 5000, now=NOW).store
+    assert engine.decide("big", 200, {}, "video/mp4", 5000, now=NOW).store
+    assert engine.decide("small", 200, {}, "video/mp4", 10, now=NOW).store
+
+
+def test_range_fills_follow_large_body_admission():
+    engine = CachePolicyEngine(large_body_bytes=1000)
+    assert engine.admit_fill("small", 10)
+    assert not engine.admit_fill("big", 5000)
+    assert engine.admit_fill("big", 5000)
+    # The fill's own decide() is the one that takes the admission.
+    assert engine.decide("big", 200, {}, "video/mp4", 5000, now=NOW).store
+    assert not engine.admit_fill("big", 5000)
+
+
+def test_client_cache_control():
+    engine = CachePolicyEngine()
+    assert engine.client_cache_control("text/html", NOW + 3600, now=NOW) == "no-cache"
+    assert engine.client_cache_control("image/png", NOW + 60, now=NOW) == "public, max-age=60"
+    assert engine.client_cache_control("text/css", NOW + 30 * 86400, now=NOW) == "public, max-age=86400"
+
+
+def test_expires_header():
+    assert upstream_ttl({"expires": "Tue, 14 Nov 2023 23:13:20 GMT"}, NOW) == 3600
+    assert upstream_ttl({"expires": "0"}, NOW) == 0
+    assert upstream_ttl({}, NOW) is None
+
+
+def test_mirror_reports_policy_hit_ratio(origin):
+    path = "/style-%s.css" % uuid.uuid4().hex
+    origin.pages[path] = ("text/css", b"body { color: red; }")
+    client = TestClient(app)
+    url = "/cats-d8c4vu/%s%s" % (origin.host, path)
+    before = client.get("/_stats/cache").json()["policies"]["css"]
+    assert client.get(url).headers["cache-control"].startswith("public, max-age=")
+    client.get(url)
+    after = client.get("/_stats/cache").json()["policies"]["css"]
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
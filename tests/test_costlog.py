@@ -0,0 +1,55 @@
+import json
+import uuid
+
+from fastapi.testclient import TestClient
+
+import costlog
+from costlog import CostLogWriter, cost_log, report
+from main import app
+
+
+def write_records(path, records):
+    path.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+
+def test_reports_aggregate_in_one_pass(tmp_path):
+    write_records(tmp_path / "a.jsonl", [
+        {"path": "/a", "status": 200, "ms": 10, "bytes": 100},
+        {"path": "/b", "status": 200, "ms": 50, "bytes": 5000},
+        {"path": "/a", "status": 502, "ms": 30, "bytes": 10},
+    ])
+    write_records(tmp_path / "b.jsonl", [{"path": "/c", "status": 404, "ms": 5, "bytes": 1}])
+    files = [str(tmp_path / "a.jsonl"), str(tmp_path / "b.jsonl")]
+
+    assert [(r["path"], r["ms"]) for r in report("cost", files)] == [("/b", 50), ("/a", 40), ("/c", 5)]
+    assert report("size", files, top=1)[0]["max_bytes"] == 5000
+    errors = report("errors", files)
+    assert [(r["path"], r["requests"]) for r in errors] == [("/a", 1), ("/c", 1)]
+
+
+def test_writer_rotates(tmp_path):
+    writer = CostLogWriter(str(tmp_path / "logs" / "cost.jsonl"), max_bytes=200, backups=2)
+    for i in range(30):
+        writer.write({"path": "/%d" % i, "padding": "x" * 20})
+        writer.flush()
+    names = set(p.name for p in (tmp_path / "logs").iterdir())
+    assert {"cost.jsonl.1", "cost.jsonl.2"} <= names <= {"cost.jsonl", "cost.jsonl.1", "cost.jsonl.2"}
+    assert writer.written == 30 and writer.dropped == 0
+
+
+def test_mirror_requests_are_logged(origin):
+    path = "/c-%s.css" % uuid.uuid4().hex
+    origin.pages[path] = ("text/css", b"a{}")
+    client = TestClient(app)
+    client.get("/cats-d8c4vu/%s%s" % (origin.host, path))
+    client.get("/cats-d8c4vu/%s%s?utm_source=news" % (origin.host, path))
+    cost_log.flush()
+
+    records = [r for r in costlog.read_records([cost_log.path]) if r["path"].endswith(path)]
+    assert [r["cache"] for r in records] == ["miss", "hit"]
+    first = records[0]
+    assert first["route"] == "/{fiddle_name}/{base_url:path}"
+    assert first["fiddle"] == "cats-d8c4vu" and first["origin"] == origin.host
+    assert first["status"] == 200 and first["bytes"] == 3 and first["type"] == "text/css"
+    assert "fetch" in first["stages"] and "write" in first["stages"]
+    assert "query" not in first and records[1]["query"] == "utm_source=news"
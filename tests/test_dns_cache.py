@@ -0,0 +1,119 @@
+import asyncio
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from mirror.dns_cache import DNSCache, DNSResolutionError, happy_eyeballs_connect
+
+
+class StubResolver:
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = 0
+
+    async def __call__(self, host, port):
+        self.calls += 1
+        answer = self.answers.get(host)
+        if answer is None:
+            raise socket.gaierror(socket.EAI_NONAME, "not found")
+        return answer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_positive_entries_respect_ttl():
+    clock = FakeClock()
+    resolver = StubResolver({"example.com": ([(socket.AF_INET, "10.0.0.1")], 30)})
+    cache = DNSCache(resolver=resolver, clock=clock, min_ttl=1)
+
+    async def run():
+        assert await cache.resolve("example.com") == [(socket.AF_INET, "10.0.0.1")]
+        assert await cache.resolve("EXAMPLE.com") == [(socket.AF_INET, "10.0.0.1")]
+        assert resolver.calls == 1
+        clock.now += 31
+        await cache.resolve("example.com")
+        assert resolver.calls == 2
+
+    asyncio.run(run())
+
+
+def test_negative_entries_are_cached():
+    clock = FakeClock()
+    resolver = StubResolver({})
+    cache = DNSCache(resolver=resolver, clock=clock, negative_ttl=10)
+
+    async def run():
+        for _ in range(3):
+            with pytest.raises(DNSResolutionError):
+                await cache.resolve("missing.invalid")
+        assert resolver.calls == 1
+        clock.now += 11
+        with pytest.raises(DNSResolutionError):
+            await cache.resolve("missing.invalid")
+        assert resolver.calls == 2
+
+    asyncio.run(run())
+
+
+def test_concurrent_lookups_are_coalesced():
+    async def slow_resolver(host, port):
+        slow_resolver.calls += 1
+        await asyncio.sleep(0.01)
+        return [(socket.AF_INET, "10.0.0.2")], None
+    slow_resolver.calls = 0
+    cache = DNSCache(resolver=slow_resolver)
+
+    async def run():
+        await asyncio.gather(*[cache.resolve("example.com") for _ in range(10)])
+
+    asyncio.run(run())
+    assert slow_resolver.calls == 1
+
+
+def test_ip_literals_skip_the_resolver():
+    resolver = StubResolver({})
+    cache = DNSCache(resolver=resolver)
+    assert asyncio.run(cache.resolve("127.0.0.1")) == [(socket.AF_INET, "127.0.0.1")]
+    assert resolver.calls == 0
+
+
+class FakeStream:
+    def __init__(self, address):
+        self.address = address
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+def test_happy_eyeballs_falls_back_to_ipv4_when_ipv6_hangs():
+    started = []
+
+    async def connect(address):
+        started.append(address)
+        if address[0] == socket.AF_INET6:
+            await asyncio.sleep(10)
+        return FakeStream(address)
+
+    addresses = [(socket.AF_INET, "10.0.0.1"), (socket.AF_INET6, "::1")]
+    stream = asyncio.run(happy_eyeballs_connect(addresses, connect, delay=0.01))
+    assert stream.address == (socket.AF_INET, "10.0.0.1")
+    assert started[0][0] == socket.AF_INET6
+
+
+def test_happy_eyeballs_raises_when_all_attempts_fail():
+    async def connect(address):
+        raise OSError("refused %s" % address[1])
+
+    addresses = [(socket.AF_INET, "10.0.0.1"), (socket.AF_INET, "10.0.0.2")]
+    with pytest.raises(OSError):
+        asyncio.run(happy_eyeballs_connect(addresses, connect, delay=0.01))
@@ -32,3 +32,23 @@ def test_create_and_fetch_fiddle():
     fetched2 = Fiddle.byUrlKey('my-fiddle-abc123')
     assert fetched2 is not None
     assert fetched2.script == 'alert(1)'
+
+
+def test_save_updates_existing_fiddle():
+    Fiddle.save(Fiddle(id='upd123', title='Before', script='a()'))
+    Fiddle.save(Fiddle(id='upd123', title='After', script='b()'))
+    fetched = Fiddle.byId('upd123')
+    assert fetched.title == 'After'
+    assert fetched.script == 'b()'
+
+
+def test_async_wrappers():
+    import asyncio
+
+    async def run():
+        await Fiddle.saveAsync(Fiddle(id='async1', title='Async'))
+        return await Fiddle.byUrlKeyAsync('async-async1')
+
+    fetched = asyncio.run(run())
+    assert fetched is not None
+    assert fetched.title == 'Async'
@@ -0,0 +1,55 @@
+import sys
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import loadshed
+from loadshed import LoadShedMiddleware, LoopLagMonitor
+
+
+def make_client(monitor):
+    app = FastAPI()
+
+    @app.get("/page")
+    async def page():
+        return {"degraded": loadshed.is_degraded()}
+
+    @app.get("/_ah/health")
+    async def health():
+        return {"ok": True}
+
+    app.add_middleware(LoadShedMiddleware, monitor=monitor, degrade_lag=0.1, shed_lag=0.5)
+    return TestClient(app)
+
+
+def test_levels_follow_loop_lag():
+    monitor = LoopLagMonitor(interval=60)
+    client = make_client(monitor)
+    assert client.get("/page").json() == {"degraded": False}
+
+    monitor.observe(0.2)
+    assert client.get("/page").json() == {"degraded": True}
+
+    monitor.observe(2.0)
+    response = client.get("/page")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert client.get("/_ah/health").status_code == 200
+
+    stats = loadshed.stats()
+    assert stats["shed"] == 1
+    assert stats["degraded"] == 1
+    assert stats["admitted"] == 1
+
+
+def test_lag_decays_and_histogram_counts():
+    monitor = LoopLagMonitor()
+    monitor.observe(1.0)
+    for _ in range(10):
+        monitor.observe(0.0)
+    assert monitor.lag < 0.2
+    histogram = dict(monitor.histogram())
+    assert histogram[0.005] == 10
+    assert histogram[1.0] == 11
@@ -0,0 +1,81 @@
+import json
+import os
+import uuid
+
+from fastapi.testclient import TestClient
+
+import admin
+from main import app
+from metrics import Metrics, metrics
+
+
+def test_snapshots_from_all_workers_are_merged(tmp_path):
+    worker = Metrics(str(tmp_path), flush_seconds=3600)
+    worker.inc("webfiddle_cache_lookups_total", result="hit", policy="css")
+    worker.inc("webfiddle_cache_lookups_total", result="miss", policy="css")
+    worker.observe("webfiddle_stage_seconds", 0.02, stage="fetch")
+    # Another worker's snapshot, as written by its own flush().
+    (tmp_path / "99999.json").write_text(json.dumps({
+        "counters": [["webfiddle_cache_lookups_total", 'policy="css",result="hit"', 2]],
+        "histograms": [["webfiddle_stage_seconds", 'stage="fetch"',
+                        {"buckets": [0] * 12 + [1], "sum": 7.0, "count": 1}]],
+    }))
+
+    text = worker.render()
+    assert 'webfiddle_cache_lookups_total{policy="css",result="hit"} 3' in text
+    assert "webfiddle_cache_hit_ratio 0.75" in text
+    assert 'webfiddle_stage_seconds_bucket{stage="fetch",le="0.025"} 1' in text
+    assert 'webfiddle_stage_seconds_bucket{stage="fetch",le="+Inf"} 2' in text
+    assert 'webfiddle_stage_seconds_count{stage="fetch"} 2' in text
+    assert worker.snapshot_name().startswith("%d-" % os.getpid())
+    assert os.path.exists(tmp_path / worker.snapshot_name())
+
+
+def test_exited_workers_are_retired_and_reused_pids_dont_overwrite(tmp_path):
+    old = Metrics(str(tmp_path), flush_seconds=3600)
+    old.inc("webfiddle_requests_total", 5, status="2xx")
+    old.flush()
+    running = Metrics(str(tmp_path), flush_seconds=3600)
+    running.inc("webfiddle_requests_total", 2, status="2xx")
+    running.flush()
+    # old exits; its replacement happens to get the same pid.
+    old._lock_file.close()
+    new = Metrics(str(tmp_path), flush_seconds=3600)
+    new.inc("webfiddle_requests_total", 1, status="2xx")
+    assert new.snapshot_name() != old.snapshot_name()
+
+    for _ in range(2):
+        counters, _ = new.collect()
+        assert counters[("webfiddle_requests_total", 'status="2xx"')] == 8
+    assert sorted(n for n in os.listdir(tmp_path) if n.endswith(".json")) == sorted(
+        [new.snapshot_name(), running.snapshot_name(), "retired.json"])
+
+
+def test_label_values_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr("metrics.MAX_LABEL_VALUES", 2)
+    worker = Metrics(str(tmp_path))
+    for origin in ("a", "b", "c", "d"):
+        worker.inc("webfiddle_upstream_errors_total", origin=origin)
+    assert 'webfiddle_upstream_errors_total{origin="other"} 2' in worker.render()
+
+
+def test_metrics_endpoint_reports_mirror_stages(origin, monkeypatch):
+    path = "/m-%s.css" % uuid.uuid4().hex
+    origin.pages[path] = ("text/css", b"a{}")
+    client = TestClient(app)
+    client.get("/cats-d8c4vu/%s%s" % (origin.host, path))
+    client.get("/cats-d8c4vu/%s%s" % (origin.host, path))
+    client.get("/cats-d8c4vu/127.0.0.1:1/unreachable.css")
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    for stage in ("blacklist", "cache_memory", "cache_disk", "fetch", "transform", "write"):
+        assert 'webfiddle_stage_seconds_count{stage="%s"}' % stage in text
+    assert 'webfiddle_served_bytes_total{content_type="text/css"}' in text
+    # Origins are only broken out for admins.
+    assert 'webfiddle_upstream_errors_total{reason="ConnectError"}' in text and "origin=" not in text
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    text = client.get("/metrics", headers={"x-admin-token": "secret"}).text
+    assert 'webfiddle_upstream_errors_total{origin="127.0.0.1:1",reason="ConnectError"}' in text
+    assert metrics.snapshot()["counters"]
@@ -0,0 +1,44 @@
+import uuid
+
+from fastapi.testclient import TestClient
+from main import app
+from models import Fiddle
+
+
+def test_binary_entries_honor_if_none_match_and_if_modified_since(origin):
+    path = "/img-%s.bin" % uuid.uuid4().hex
+    origin.pages[path] = ("application/octet-stream", b"\x00\x01" * 100)
+    client = TestClient(app)
+    url = "/cats-d8c4vu/%s%s" % (origin.host, path)
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    last_modified = first.headers["last-modified"]
+
+    revalidated = client.get(url, headers={"if-none-match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    assert revalidated.headers["etag"] == etag
+
+    assert client.get(url, headers={"if-modified-since": last_modified}).status_code == 304
+    assert client.get(url, headers={"if-none-match": '"other"'}).status_code == 200
+
+
+def test_html_validator_changes_with_fiddle_revision(origin):
+    path = "/page-%s.html" % uuid.uuid4().hex
+    origin.pages[path] = ("text/html", b"<html><head></head><body>hi</body></html>")
+    Fiddle.save(Fiddle(id="cond1", script="console.log(1)"))
+    client = TestClient(app)
+    url = "/my-cond1/%s%s" % (origin.host, path)
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert client.get(url, headers={"if-none-match": etag}).status_code == 304
+
+    Fiddle.save(Fiddle(id="cond1", script="console.log(2)"))
+    changed = client.get(url, headers={"if-none-match": etag})
+    assert changed.status_code == 200
+    assert "console.log(2)" in changed.text
+    assert changed.headers["etag"] != etag
@@ -0,0 +1,53 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from fastapi.testclient import TestClient
+from main import app
+from models import DATABASE_PATH, init_db, Fiddle
+from page_cache import etag_matches, page_cache
+
+
+def setup_module(module):
+    if os.path.exists(DATABASE_PATH):
+        os.remove(DATABASE_PATH)
+    init_db()
+    page_cache.clear()
+
+
+def test_fiddle_page_etag_and_invalidation():
+    Fiddle.save(Fiddle(id='etag1', title='First title'))
+    with TestClient(app) as client:
+        first = client.get('/my-fiddle-etag1')
+        assert first.status_code == 200
+        etag = first.headers['etag']
+        assert 'First title' in first.text
+
+        cached = client.get('/my-fiddle-etag1', headers={'if-none-match': etag})
+        assert cached.status_code == 304
+        assert cached.content == b''
+
+        Fiddle.save(Fiddle(id='etag1', title='Second title'))
+        assert Fiddle.byId('etag1').revision == 1
+        updated = client.get('/my-fiddle-etag1', headers={'if-none-match': etag})
+        assert updated.status_code == 200
+        assert updated.headers['etag'] != etag
+        assert 'Second title' in updated.text
+
+
+def test_default_page_is_prerendered_at_startup():
+    page_cache.clear()
+    with TestClient(app, base_url='https://webfiddle.net') as client:
+        hits = page_cache.hits
+        response = client.get('/')
+        assert response.status_code == 200
+        assert page_cache.hits == hits + 1
+
+
+def test_etag_matching():
+    assert etag_matches('"a", "b"', '"b"')
+    assert etag_matches('W/"b"', '"b"')
+    assert etag_matches('*', '"b"')
+    assert not etag_matches('"c"', '"b"')
+    assert not etag_matches(None, '"b"')
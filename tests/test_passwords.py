@@ -0,0 +1,41 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from passwords import PasswordBusy, PasswordHasher, hash_rounds
+
+
+def test_hash_verify_and_rehash_detection():
+    hasher = PasswordHasher(rounds=4)
+
+    async def run():
+        hashed = await hasher.hash("secret")
+        assert await hasher.verify("secret", hashed)
+        assert not await hasher.verify("wrong", hashed)
+        return hashed
+
+    hashed = asyncio.run(run())
+    assert hash_rounds(hashed) == 4
+    assert not hasher.needs_rehash(hashed)
+    assert PasswordHasher(rounds=5).needs_rehash(hashed)
+
+
+def test_rejects_when_queue_wait_times_out():
+    hasher = PasswordHasher(rounds=4, max_concurrent=1, queue_timeout=0.01)
+
+    async def run():
+        await hasher._semaphore().acquire()
+        with pytest.raises(PasswordBusy):
+            await hasher.hash("secret")
+
+    asyncio.run(run())
+    assert hasher.rejected == 1
+
+
+def test_rejects_when_too_many_waiting():
+    hasher = PasswordHasher(rounds=4, max_waiting=0)
+    with pytest.raises(PasswordBusy):
+        asyncio.run(hasher.hash("secret"))
@@ -0,0 +1,94 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+import requests
+
+from mirror.mirror import get_url_key_name
+import mirror.peers
+from mirror.peers import HashRing, PeerCache, token_ok
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_ring_spreads_keys_and_moves_few_on_membership_change():
+    ring = HashRing(["http://a", "http://b", "http://c"])
+    keys = ["key-%d" % i for i in range(3000)]
+    owners = {key: ring.owner(key) for key in keys}
+    counts = Counter(owners.values())
+    assert min(counts.values()) > 700
+    bigger = HashRing(["http://a", "http://b", "http://c", "http://d"])
+    moved = [key for key in keys if bigger.owner(key) != owners[key]]
+    assert all(bigger.owner(key) == "http://d" for key in moved)
+    assert len(moved) < 1200
+
+
+def test_peering_needs_a_token(monkeypatch):
+    peers = ["http://a", "http://b"]
+    assert not PeerCache(peers, "http://a", token="").enabled
+    assert PeerCache(peers, "http://a", token="t0ken").enabled
+    monkeypatch.setattr(mirror.peers, "PEER_TOKEN", "")
+    assert not token_ok("") and not token_ok(None)
+    monkeypatch.setattr(mirror.peers, "PEER_TOKEN", "t0ken")
+    assert token_ok("t0ken") and not token_ok("wrong")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_instance(port, peers, tmp_path):
+    env = dict(os.environ, PEERS=",".join(peers), PEER_SELF="http://127.0.0.1:%d" % port,
+               PEER_TOKEN="t0ken", CACHE_DB_PATH=str(tmp_path / ("cache-%d.db" % port)),
+               RATE_LIMIT_DB=str(tmp_path / ("ratelimit-%d.db" % port)))
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                             "--log-level", "warning"], cwd=str(ROOT), env=env)
+
+
+def wait_ready(base):
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            return requests.get(base + "/_stats/peers", timeout=1).json()
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise AssertionError("%s did not start" % base)
+
+
+def test_instances_fetch_from_the_owning_peer(origin, tmp_path):
+    ports = [free_port(), free_port()]
+    peers = ["http://127.0.0.1:%d" % port for port in ports]
+    processes = [start_instance(port, peers, tmp_path) for port in ports]
+    try:
+        for peer in peers:
+            assert wait_ready(peer)["enabled"]
+        ring = HashRing(peers)
+        # Pick a URL owned by the second instance, then request it through the first.
+        while True:
+            path = "/asset-%s.css" % uuid.uuid4().hex
+            if ring.owner(get_url_key_name("http://%s%s" % (origin.host, path))) == peers[1]:
+                break
+        origin.pages[path] = ("text/css", b"body { color: red }")
+        url = "/cats-d8c4vu/%s%s" % (origin.host, path)
+
+        first = requests.get(peers[0] + url)
+        assert first.status_code == 200 and b"color: red" in first.content
+        assert requests.get(peers[1] + url).status_code == 200
+        assert origin.requests.count(path) == 1
+
+        stats = requests.get(peers[0] + "/_stats/peers").json()
+        assert stats["peers"][peers[1]]["hits"] == 1
+        assert requests.get(peers[1] + "/_stats/peers").json()["served"] == 1
+        assert requests.get(peers[1] + "/_peer/cache", params={"url": "http://x/", "base": "b", "translated": "x/"},
+                            headers={"x-peer-token": "wrong"}).status_code == 403
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(10)
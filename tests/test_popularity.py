@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+import uuid
+
+from fastapi.testclient import TestClient
+
+import models
+from db import ConnectionPool
+from main import app
+from models import POPULARITY_EPOCH, POPULARITY_HALF_LIFE, Fiddle, ViewCounter, fiddle_views, top_fiddles
+
+
+def use_temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(models, "pool", ConnectionPool(str(tmp_path / "users.db"), schema=models.create_schema))
+
+
+def test_views_are_batched_and_decay(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    now = [POPULARITY_EPOCH + 1000 * POPULARITY_HALF_LIFE]
+    counter = ViewCounter(flush_seconds=3600, flush_pending=1000, clock=lambda: now[0])
+    for _ in range(10):
+        counter.record("old")
+    counter.record("old", mirror=True)
+    assert top_fiddles() == []
+    counter.flush()
+
+    # Five half-lives later, 3 fresh views outrank 11 old ones (worth 11/32 now).
+    now[0] += 5 * POPULARITY_HALF_LIFE
+    for _ in range(3):
+        counter.record("new")
+    counter.flush()
+    top = top_fiddles(now=now[0])
+    assert [(f["id"], f["views"], f["mirror_views"]) for f in top] == [("new", 3, 0), ("old", 10, 1)]
+    assert top[0]["score"] == 3.0 and abs(top[1]["score"] - 11 / 32) < 1e-3
+
+    # Scores keep accumulating in log space without overflowing.
+    counter.record("old")
+    counter.flush()
+    assert abs(top_fiddles(now=now[0])[1]["score"] - (1 + 11 / 32)) < 1e-3
+
+
+def test_top_fiddles_read_from_the_score_index(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    with models.pool.connection() as conn:
+        for sql in (models.TOP_FIDDLES_SQL, models.POPULAR_FIDDLES_SQL):
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, (20,))]
+            assert plan[0] == "SCAN v USING INDEX fiddle_views_score"
+            assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_fiddle_page_views_rank_popular_fiddles(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    for fiddle_id in ("pop1", "pop2", "pop3"):
+        Fiddle.save(Fiddle(id=fiddle_id, title="t", start_url="example.com/" + fiddle_id))
+    client = TestClient(app)
+    fiddle_views.flush()
+    # Unknown keys fall back to the default fiddle, which isn't counted either way.
+    for key in ["t-pop2"] * 3 + ["t-pop1", "t-nosuchfiddle", "t-d8c4vu"]:
+        assert client.get("/" + key).status_code == 200
+    fiddle_views.drain()
+    fiddle_views.flush()
+
+    assert [f["id"] for f in client.get("/_stats/fiddles").json()] == ["pop2", "pop1"]
+    # Viewed fiddles first, then the rest by last update.
+    assert [f.id for f in Fiddle.popular(3)] == ["pop2", "pop1", "pop3"]
+
+
+def test_due_views_are_written_off_the_calling_thread(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    counter = ViewCounter(flush_seconds=3600, flush_pending=1)
+    flushed_on = []
+    original = counter.flush
+    counter.flush = lambda: (flushed_on.append(threading.current_thread().name), original())
+    counter.record("f1")
+    counter.drain()
+    assert flushed_on and flushed_on[0].startswith("db")
+    assert [f["id"] for f in top_fiddles()] == ["f1"]
+
+
+def test_views_are_kept_when_a_flush_fails(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    working = models.pool
+
+    class LockedPool(object):
+        def connection(self):
+            raise sqlite3.OperationalError("database is locked")
+
+    counter = ViewCounter(flush_seconds=3600, flush_pending=1000)
+    counter.record("kept")
+    counter.record("kept", mirror=True)
+    monkeypatch.setattr(models, "pool", LockedPool())
+    counter.flush()
+    counter.record("kept")
+    monkeypatch.setattr(models, "pool", working)
+    counter.flush()
+    assert [(f["id"], f["views"], f["mirror_views"]) for f in top_fiddles()] == [("kept", 2, 1)]
@@ -0,0 +1,77 @@
+import asyncio
+import uuid
+
+from fastapi.testclient import TestClient
+
+from main import app
+from mirror.prefetch import Prefetcher, extract_subresources, preload_header, prefetcher
+
+PAGE = b"""<html><head>
+<link rel="stylesheet" href="/css/site.css">
+<link rel=icon href="/favicon.ico">
+<link rel="preload" as="font" href="https://fonts.example.com/a.woff2">
+<script src='app.js#x'></script><script>inline()</script>
+</head><body><img src="//img.example.com/logo.png"><img src="data:image/png;base64,xx"></body></html>"""
+
+
+def test_extract_subresources_resolves_and_classifies():
+    found = extract_subresources(PAGE, "http://example.com/blog/post.html")
+    assert found == [
+        ["http://example.com/css/site.css", "style"],
+        ["https://fonts.example.com/a.woff2", "font"],
+        ["http://example.com/blog/app.js", "script"],
+        ["http://img.example.com/logo.png", "image"],
+    ]
+    assert preload_header("cats-d8c4vu", found) == (
+        "</cats-d8c4vu/example.com/css/site.css>; rel=preload; as=style, "
+        "</cats-d8c4vu/example.com/blog/app.js>; rel=preload; as=script")
+
+
+def test_prefetcher_limits_per_host_and_in_total():
+    fetched = []
+
+    async def fetch(url):
+        await asyncio.sleep(0.01)
+        fetched.append(url)
+
+    async def run():
+        limited = Prefetcher(concurrency=2, max_pending=5, per_host=2)
+        limited.schedule(["http://a/%d" % i for i in range(4)] + ["http://b/%d" % i for i in range(4)]
+                         + ["http://c/1", "http://d/1"], fetch)
+        await limited.drain()
+        return limited.stats()
+
+    stats = asyncio.run(run())
+    assert stats == {"scheduled": 5, "fetched": 5, "failed": 0, "dropped": 1, "host_limited": 4, "pending": 0}
+    assert len(fetched) == 5
+
+
+def test_html_miss_prefetches_subresources_and_sends_preload(origin):
+    token = uuid.uuid4().hex
+    origin.pages["/p-%s.html" % token] = (
+        "text/html", b'<html><head><link rel="stylesheet" href="/s-%s.css"></head><body>'
+                     b'<img src="/i-%s.png"></body></html>' % (token.encode(), token.encode()))
+    origin.pages["/s-%s.css" % token] = ("text/css", b"body{}")
+    origin.pages["/i-%s.png" % token] = ("image/png", b"png")
+    with TestClient(app) as client:
+        response = client.get("/cats-d8c4vu/%s/p-%s.html" % (origin.host, token))
+        assert response.status_code == 200
+        assert response.headers["link"] == "</cats-d8c4vu/%s/s-%s.css>; rel=preload; as=style" % (origin.host, token)
+        client.portal.call(prefetcher.drain)
+        assert client.get("/cats-d8c4vu/%s/s-%s.css" % (origin.host, token)).status_code == 200
+    assert origin.requests.count("/s-%s.css" % token) == 1
+    assert origin.requests.count("/i-%s.png" % token) == 1
+
+
+def test_non_ascii_subresources_are_percent_encoded_in_preload(origin):
+    token = uuid.uuid4().hex
+    origin.pages["/u-%s.html" % token] = (
+        "text/html", ('<html><head><link rel="stylesheet" href="/css/\u6837\u5f0f-%s.css"></head></html>'
+                      % token).encode("utf-8"))
+    with TestClient(app) as client:
+        for _ in range(2):  # the miss, then the hit served with the stored subresources
+            response = client.get("/cats-d8c4vu/%s/u-%s.html" % (origin.host, token))
+            assert response.status_code == 200
+            assert response.headers["link"] == (
+                "</cats-d8c4vu/%s/css/%%E6%%A0%%B7%%E5%%BC%%8F-%s.css>; rel=preload; as=style" % (origin.host, token))
+        client.portal.call(prefetcher.drain)
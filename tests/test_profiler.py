@@ -0,0 +1,62 @@
+import threading
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+
+import admin
+from main import app
+from profiler import Sampler
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def test_sampler_folds_stacks_of_the_target_thread():
+    sampler = Sampler(thread_ids={threading.get_ident()}, interval=0.001)
+    sampler.start()
+    busy_loop(0.1)
+    sampler.stop()
+
+    assert sampler.samples > 10
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in sampler.folded().splitlines())
+    hottest = sampler.top()[0]
+    assert hottest["function"].startswith("busy_loop (tests/test_profiler.py:")
+    assert hottest["self_pct"] > 50 and hottest["total_pct"] >= hottest["self_pct"]
+
+
+def test_profile_one_request_needs_admin_token(origin, monkeypatch):
+    path = "/p-%s.html" % uuid.uuid4().hex
+    origin.pages[path] = origin.pages[path + "?x=1"] = (
+        "text/html", b"<html><body>%s</body></html>" % (b"<p>text</p>" * 5000))
+    url = "/cats-d8c4vu/%s%s" % (origin.host, path)
+    client = TestClient(app)
+
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    assert "x-profile-id" not in client.get(url, headers={"x-profile": "1"}).headers
+    response = client.get(url + "?x=1", headers={"x-profile": "1", "x-admin-token": "secret"})
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+
+    profile = client.get("/_admin/profile/" + profile_id, headers={"x-admin-token": "secret"}).json()
+    assert profile["kind"] == "request" and profile["path"] == url + "?x=1"
+    assert "fetch" in profile["stages"] and profile["stages"]["total"] > 0
+    assert profile["ticks"] >= profile["samples"]
+    folded = client.get("/_admin/profile/%s/folded" % profile_id, headers={"x-admin-token": "secret"})
+    assert folded.headers["content-type"].startswith("text/plain")
+    assert client.get("/_admin/profile/%s" % profile_id).status_code == 403
+    assert client.get("/_admin/profile/..secret", headers={"x-admin-token": "secret"}).status_code == 404
+
+
+def test_profile_window_sums_stages(monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    client = TestClient(app)
+    response = client.post("/_admin/profile?seconds=0.2&threads=all", headers={"x-admin-token": "secret"})
+    assert response.status_code == 200
+    profile = response.json()
+    assert profile["kind"] == "window" and profile["samples"] > 0 and profile["requests"] == 0
+    assert profile["id"] in [p["id"] for p in client.get("/_admin/profile", headers={"x-admin-token": "secret"}).json()]
+    assert client.post("/_admin/profile?seconds=600", headers={"x-admin-token": "secret"}).status_code == 400
@@ -0,0 +1,96 @@
+import uuid
+
+from fastapi.testclient import TestClient
+
+from main import app
+from mirror.mirror import hot_cache
+from mirror.prefetch import prefetcher
+from mirror.ranges import if_range_allows, parse_range
+
+BODY = bytes(range(256)) * 40
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-9", 100) == [(0, 9)]
+    assert parse_range("bytes=90-", 100) == [(90, 99)]
+    assert parse_range("bytes=-10", 100) == [(90, 99)]
+    assert parse_range("bytes=50-500", 100) == [(50, 99)]
+    assert parse_range("bytes=0-4, 5-9, 20-29,25-30", 100) == [(0, 9), (20, 30)]
+    assert parse_range("bytes=200-300", 100) == []
+    assert parse_range("bytes=9-1", 100) is None
+    assert parse_range("items=0-1", 100) is None
+    assert parse_range("bytes=" + ",".join("%d-%d" % (i, i) for i in range(0, 40, 2)), 100) is None
+
+
+def test_if_range():
+    assert if_range_allows(None, '"a"', 1700000000)
+    assert if_range_allows('"a"', '"a"', 1700000000)
+    assert not if_range_allows('W/"a"', '"a"', 1700000000)
+    assert if_range_allows("Tue, 14 Nov 2023 22:13:20 GMT", '"a"', 1700000000)
+    assert not if_range_allows("Tue, 14 Nov 2023 22:13:21 GMT", '"a"', 1700000000)
+
+
+def cached_url(origin):
+    path = "/video-%s.mp4" % uuid.uuid4().hex
+    origin.pages[path] = ("video/mp4", BODY)
+    return "/cats-d8c4vu/%s%s" % (origin.host, path)
+
+
+def test_ranges_are_served_from_the_cache(origin):
+    client = TestClient(app)
+    url = cached_url(origin)
+    full = client.get(url)
+    assert full.headers["accept-ranges"] == "bytes"
+    etag = full.headers["etag"]
+
+    for from_memory in (True, False):
+        if not from_memory:
+            # Read the slice straight out of cache.db.
+            hot_cache.clear()
+        partial = client.get(url, headers={"range": "bytes=100-199"})
+        assert partial.status_code == 206
+        assert partial.headers["content-range"] == "bytes 100-199/%d" % len(BODY)
+        assert partial.content == BODY[100:200]
+
+    multi = client.get(url, headers={"range": "bytes=0-9,-5"})
+    assert multi.status_code == 206
+    boundary = multi.headers["content-type"].split("boundary=")[1]
+    parts = multi.content.split(b"--" + boundary.encode())
+    assert len(parts) == 4 and parts[3] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + BODY[:10] + b"\r\n")
+    assert b"Content-Range: bytes %d-%d/%d" % (len(BODY) - 5, len(BODY) - 1, len(BODY)) in parts[2]
+    assert int(multi.headers["content-length"]) == len(multi.content)
+
+    assert client.get(url, headers={"range": "bytes=0-9", "if-range": etag}).status_code == 206
+    assert client.get(url, headers={"range": "bytes=0-9", "if-range": '"old"'}).content == BODY
+    unsatisfiable = client.get(url, headers={"range": "bytes=999999-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == "bytes */%d" % len(BODY)
+    assert origin.range_headers.count("") == 1
+
+
+def test_ranges_on_uncached_objects_go_upstream(origin):
+    url = cached_url(origin)
+    with TestClient(app) as client:
+        partial = client.get(url, headers={"range": "bytes=10-19"})
+        assert partial.status_code == 206
+        assert partial.content == BODY[10:20]
+        # The relayed range starts a fill of the whole body, and later ranges come from the cache.
+        client.portal.call(prefetcher.drain)
+        assert origin.range_headers == ["bytes=10-19", ""]
+        assert client.get(url, headers={"range": "bytes=20-29"}).content == BODY[20:30]
+        assert client.get(url).content == BODY
+    assert origin.range_headers == ["bytes=10-19", ""]
+
+
+def test_encoded_upstream_ranges_are_not_relayed(origin):
+    # An origin gzipping despite accept-encoding: identity gets fetched whole and decoded instead.
+    origin.gzip = True
+    path = "/app-%s.js" % uuid.uuid4().hex
+    origin.pages[path] = ("application/javascript", BODY)
+    client = TestClient(app)
+    url = "/cats-d8c4vu/%s%s" % (origin.host, path)
+    first = client.get(url, headers={"range": "bytes=10-19"})
+    assert first.status_code == 200 and first.content == BODY
+    partial = client.get(url, headers={"range": "bytes=10-19"})
+    assert partial.status_code == 206 and partial.content == BODY[10:20]
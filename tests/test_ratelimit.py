@@ -0,0 +1,71 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from starlette.requests import Request
+
+from mirror.ratelimit import RateLimiter, client_ip, parse_networks
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_refills(tmp_path):
+    clock = FakeClock()
+    limiter = RateLimiter(str(tmp_path / "rl.db"), clock=clock)
+    for _ in range(3):
+        assert limiter.take("ip:1.2.3.4", burst=3, rate=0.5) == 0
+    wait = limiter.take("ip:1.2.3.4", burst=3, rate=0.5)
+    assert 1.9 < wait <= 2.0
+
+    clock.now += 2
+    assert limiter.take("ip:1.2.3.4", burst=3, rate=0.5) == 0
+    assert limiter.take("ip:1.2.3.4", burst=3, rate=0.5) > 0
+
+
+def test_buckets_are_shared_between_limiters(tmp_path):
+    clock = FakeClock()
+    db = str(tmp_path / "rl.db")
+    first = RateLimiter(db, clock=clock)
+    second = RateLimiter(db, clock=clock)
+    assert first.take("fiddle:a-b", burst=2, rate=1) == 0
+    assert second.take("fiddle:a-b", burst=2, rate=1) == 0
+    assert first.take("fiddle:a-b", burst=2, rate=1) > 0
+    assert second.take("fiddle:other-b", burst=2, rate=1) == 0
+
+
+def test_zero_rate_disables_limit(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "rl.db"))
+    for _ in range(10):
+        assert limiter.take("global", burst=0, rate=0) == 0
+
+
+def make_request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers + [(b"cf-connecting-ip", b"6.6.6.6")],
+                    "client": (peer, 1234)})
+
+
+def test_forwarded_for_is_only_believed_from_trusted_proxies():
+    trusted = parse_networks("10.0.0.0/8, cloudflare")
+    # Direct connections can't pick their own bucket.
+    assert client_ip(make_request("1.2.3.4", "9.9.9.9"), trusted) == "1.2.3.4"
+    # Behind our proxies, the rightmost hop they didn't add; hops to its left are the client's own.
+    assert client_ip(make_request("10.0.0.5", "9.9.9.9, 5.6.7.8, 162.158.1.1"), trusted) == "5.6.7.8"
+    assert client_ip(make_request("10.0.0.5", "2.2.2.2"), trusted) == "2.2.2.2"
+    assert client_ip(make_request("10.0.0.5"), trusted) == "10.0.0.5"
+    assert client_ip(make_request("10.0.0.5", "9.9.9.9"), []) == "10.0.0.5"
+
+
+def test_tunnel_on_loopback_is_keyed_by_the_real_client():
+    loopback = parse_networks("127.0.0.1/32,::1")
+    assert client_ip(make_request("127.0.0.1", "203.0.113.7"), loopback) == "203.0.113.7"
+    assert client_ip(make_request("::1", "203.0.113.7"), loopback) == "203.0.113.7"
+    # Without X-Forwarded-For, cloudflared's CF-Connecting-IP names the client.
+    assert client_ip(make_request("127.0.0.1"), loopback) == "6.6.6.6"
+    assert client_ip(make_request("127.0.0.1"), []) == "127.0.0.1"
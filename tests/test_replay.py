@@ -0,0 +1,44 @@
+import asyncio
+import sys
+import uuid
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "benchmarks"))
+from replay import ResponseStore, load_requests, make_transport, parse_line, replay, upstream_hints
+
+
+def test_parse_cost_log_and_access_log_lines():
+    assert parse_line('{"method":"GET","path":"/cats-d8c4vu/example.com/a.css","query":"v=1","status":200,'
+                      '"bytes":5,"type":"text/css"}') == {
+        "method": "GET", "path": "/cats-d8c4vu/example.com/a.css", "query": "v=1", "status": 200, "bytes": 5,
+        "type": "text/css"}
+    assert parse_line('1.2.3.4 - - [10/Oct/2024:13:55:36 +0000] "HEAD /cats-d8c4vu/example.com/?q=x HTTP/1.1" '
+                      '304 - "-" "curl"') == {
+        "method": "HEAD", "path": "/cats-d8c4vu/example.com/", "query": "q=x", "status": 304, "bytes": None,
+        "type": None}
+    assert parse_line("garbage") is None
+
+
+def test_replay_serves_upstream_from_store(tmp_path):
+    host = "replay-%s.example.com" % uuid.uuid4().hex[:8]
+    log = tmp_path / "costlog.jsonl"
+    log.write_text("".join([
+        '{"method":"GET","path":"/cats-d8c4vu/%s/app.js","status":200,"bytes":900,"type":"application/javascript"}\n'
+        % host,
+        '{"method":"POST","path":"/save","status":200}\n',
+        '{"method":"GET","path":"/cats-d8c4vu/%s/data.json","status":200}\n' % host,
+    ] * 3))
+    requests = load_requests([str(log)])
+    assert len(requests) == 6
+
+    store = ResponseStore(str(tmp_path / "upstream.db"))
+    store.put("%s/data.json" % host, 200, [["content-type", "application/json"]], b'{"recorded": true}')
+    transport = make_transport(store, upstream_hints(requests))
+    stats = asyncio.run(replay(requests, transport, concurrency=1, verbose=False))
+
+    summary = stats.summary()
+    assert summary["requests"] == 6 and summary["statuses"] == {"200": 6}
+    assert summary["hit_ratio"] == 0.667
+    # One miss per URL (a GET plus the HEAD redirect probe upstream); the rest are cache hits.
+    assert transport.counters == {"stored": 2, "recorded": 0, "synthetic": 2, "missing": 0}
+    assert stats.timeline[-1]["rss_mb"] > 0
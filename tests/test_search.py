@@ -0,0 +1,84 @@
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+import models
+from db import ConnectionPool
+from main import app
+from models import Fiddle, search_query
+
+
+def use_temp_db(tmp_path, monkeypatch):
+    path = str(tmp_path / "users.db")
+    monkeypatch.setattr(models, "pool", ConnectionPool(path, schema=models.create_schema))
+    return path
+
+
+def ids(results):
+    return [r["id"] for r in results]
+
+
+def test_search_ranks_titles_first_and_follows_saves(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    Fiddle.save(Fiddle(id="in-script", title="Dogs", script="drawCanvas()"))
+    Fiddle.save(Fiddle(id="in-title", title="Canvas clock", script="tick()"))
+    Fiddle.save(Fiddle(id="in-description", title="Birds", description="a canvas of birds"))
+    assert ids(Fiddle.search("canvas")[0]) == ["in-title", "in-description"]
+    # The last word matches as a prefix, for search as you type.
+    assert ids(Fiddle.search("canv")[0]) == ["in-title", "in-description"]
+    assert ids(Fiddle.search("drawcanvas")[0]) == ["in-script"]
+
+    Fiddle.save(Fiddle(id="in-title", title="Clock", script="tick()"))
+    assert ids(Fiddle.search("canvas")[0]) == ["in-description"]
+    with models.pool.connection() as conn, conn:
+        conn.execute("DELETE FROM fiddles WHERE id = 'in-description'")
+    assert Fiddle.search("canvas") == ([], None)
+
+
+def test_search_pages_with_a_cursor(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    for i in range(25):
+        Fiddle.save(Fiddle(id="f%d" % i, title="spinner %d" % i, description="spinner " * (i % 4)))
+    seen, cursor, pages = [], None, 0
+    while True:
+        results, cursor = Fiddle.search("spinner", cursor, limit=10)
+        seen += ids(results)
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 3 and sorted(seen) == sorted("f%d" % i for i in range(25))
+    # A cursor that doesn't decode starts from the top rather than failing.
+    assert ids(Fiddle.search("spinner", "not a cursor", limit=10)[0]) == seen[:10]
+
+
+def test_search_query_escapes_fts_syntax():
+    assert search_query('cat OR "dog" NEAR(x') == '"cat" "OR" "dog" "NEAR" "x"*'
+    assert search_query("  --  ") == ""
+
+
+def test_existing_fiddles_are_indexed_when_search_is_added(tmp_path, monkeypatch):
+    path = use_temp_db(tmp_path, monkeypatch)
+    Fiddle.save(Fiddle(id="old", title="Mandelbrot"))
+    models.pool.close_all()
+    conn = sqlite3.connect(path)
+    for name in ("fiddles_fts_insert", "fiddles_fts_update", "fiddles_fts_delete"):
+        conn.execute("DROP TRIGGER %s" % name)
+    conn.execute("DROP TABLE fiddles_fts")
+    conn.commit()
+    conn.close()
+
+    models.pool.reset()
+    assert ids(Fiddle.search("mandelbrot")[0]) == ["old"]
+
+
+def test_search_endpoint(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    for i in range(3):
+        Fiddle.save(Fiddle(id="t%d" % i, title="Tetris %d" % i, start_url="https://example.com"))
+    client = TestClient(app)
+    first = client.get("/search", params={"q": "tetris", "limit": 2}).json()
+    assert len(first["results"]) == 2 and first["next"]
+    assert first["results"][0]["start_url"] == "https://example.com"
+    rest = client.get("/search", params={"q": "tetris", "limit": 2, "cursor": first["next"]}).json()
+    assert len(rest["results"]) == 1 and rest["next"] is None
+    assert client.get("/search").json() == {"results": [], "next": None}
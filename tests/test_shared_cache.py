@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+from db import ConnectionPool
+from mirror.shared_cache import LEASE_TABLE_SQL, FetchLeases, HotCache, SingleFlight
+
+
+class Content(object):
+    def __init__(self, data, expiry=10 ** 10):
+        self.data = data
+        self.expiry = expiry
+
+
+def make_leases(tmp_path, clock=None):
+    pool = ConnectionPool(str(tmp_path / "cache.db"))
+    with pool.connection() as conn:
+        conn.execute(LEASE_TABLE_SQL)
+    return FetchLeases(pool, clock=clock) if clock else FetchLeases(pool)
+
+
+def test_hot_cache_bounds_bytes_and_age():
+    now = [1000.0]
+    cache = HotCache(max_bytes=10, max_entry_bytes=6, max_age=30, clock=lambda: now[0])
+    cache.put("a", Content(b"aaaa"))
+    cache.put("b", Content(b"bbbb"))
+    cache.put("huge", Content(b"x" * 7))
+    assert cache.get("huge") is None
+    cache.get("a")
+    cache.put("c", Content(b"cccc"))
+    assert cache.get("b") is None and cache.get("a") is not None
+    assert cache.bytes == 8
+    cache.put("short", Content(b"s", expiry=1005))
+    now[0] += 10
+    assert cache.get("short") is None and cache.get("a") is not None
+    now[0] += 30
+    assert cache.get("a") is None
+
+
+def test_concurrent_misses_in_one_worker_fetch_once(tmp_path):
+    flight = SingleFlight(make_leases(tmp_path), lambda key: None)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "page"
+
+    async def run():
+        return await asyncio.gather(*[flight.do("k", fetch) for _ in range(5)])
+
+    assert asyncio.run(run()) == ["page"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"leader": 1, "joined": 4, "waited": 0, "waited_hit": 0, "inflight": 0}
+
+
+def test_other_workers_wait_for_the_lease_holder(tmp_path):
+    leases = make_leases(tmp_path)
+    store = {}
+    # Separate instances share only the lease table and the store, like separate processes.
+    workers = [SingleFlight(leases, store.get) for _ in range(3)]
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        store["k"] = "page"
+        return "page"
+
+    async def run():
+        return await asyncio.gather(*[worker.do("k", fetch) for worker in workers])
+
+    assert asyncio.run(run()) == ["page"] * 3
+    assert len(calls) == 1
+    assert sum(worker.counters["waited_hit"] for worker in workers) == 2
+
+
+def test_lease_and_lookup_calls_stay_off_the_event_loop(tmp_path):
+    leases = make_leases(tmp_path)
+    loop_thread = threading.current_thread()
+    lookups = []
+
+    def lookup(key):
+        lookups.append(threading.current_thread())
+        return "page" if len(lookups) > 1 else None
+
+    async def run():
+        assert leases.acquire("k")
+        # Another worker holds the lease, so this one polls cache.db for the result.
+        return await SingleFlight(leases, lookup).do("k", None)
+
+    assert asyncio.run(run()) == "page"
+    assert lookups and loop_thread not in lookups
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    now = [1000.0]
+    leases = make_leases(tmp_path, clock=lambda: now[0])
+    owner = leases.acquire("k")
+    assert owner and leases.acquire("k") is None and leases.held("k")
+    now[0] += leases.lease_seconds + 1
+    assert not leases.held("k")
+    second = leases.acquire("k")
+    assert second and second != owner
+    leases.release("k", owner)
+    assert leases.acquire("k") is None
+    leases.release("k", second)
+    assert leases.acquire("k") is not None
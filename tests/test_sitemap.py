@@ -0,0 +1,77 @@
+import gzip
+import re
+
+from fastapi.testclient import TestClient
+
+import models
+import sitemap
+from db import ConnectionPool
+from main import app
+from models import Fiddle
+from sitemap import SitemapCache, fiddle_path
+
+
+def use_temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(models, "pool", ConnectionPool(str(tmp_path / "users.db"), schema=models.create_schema))
+
+
+def shard_urls(cache, shard):
+    with gzip.open(cache.shard_path(shard), "rt") as f:
+        return re.findall(r"<loc>([^<]+)</loc>", f.read())
+
+
+def test_fiddle_path_matches_the_editor():
+    assert fiddle_path("abc", "My Cool Fiddle: v2.0!") == "/my-cool-fiddle-v20-abc"
+    assert fiddle_path("abc", None) == "/-abc"
+
+
+def test_shards_are_regenerated_incrementally(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    for i in range(10):
+        Fiddle.save(Fiddle(id="f%d" % i, title="Fiddle %d" % i))
+    with models.pool.connection() as conn, conn:
+        conn.execute("UPDATE fiddles SET updated = datetime('2000-01-01', '+' || rowid || ' seconds')")
+    now = [1000.0]
+    cache = SitemapCache(str(tmp_path / "sitemaps"), base_url="https://example.com", shard_size=3,
+                         refresh_seconds=60, clock=lambda: now[0])
+    assert cache.refresh() == [0, 1, 2, 3]
+    assert shard_urls(cache, 0) == ["https://example.com/fiddle-%d-f%d" % (i, i) for i in range(3)]
+    assert shard_urls(cache, 3) == ["https://example.com/fiddle-9-f9"]
+    index = cache.index_xml()
+    assert re.findall(r"<loc>([^<]+)</loc>", index) == ["https://example.com/sitemap-%d.xml.gz" % i
+                                                       for i in range(4)]
+    assert "<lastmod>2000-01-01T00:00:03+00:00</lastmod>" in index
+
+    # Fresh enough: nothing is looked at.
+    assert cache.refresh() is None
+
+    # Only shards with changes are rewritten, plus the one holding the latest update
+    # already seen, since updated only has one second resolution.
+    with models.pool.connection() as conn, conn:
+        conn.execute("UPDATE fiddles SET updated = '2000-01-02 00:00:00', title = 'Renamed' WHERE id = 'f4'")
+    now[0] += 61
+    assert cache.refresh() == [1, 3]
+    assert shard_urls(cache, 1) == ["https://example.com/fiddle-3-f3", "https://example.com/renamed-f4",
+                                    "https://example.com/fiddle-5-f5"]
+
+    with models.pool.connection() as conn, conn:
+        conn.execute("INSERT INTO fiddles (id, title, updated) VALUES ('f10', 'New', '2000-01-03 00:00:00')")
+    now[0] += 61
+    assert cache.refresh() == [1, 3]
+    assert shard_urls(cache, 3) == ["https://example.com/fiddle-9-f9", "https://example.com/new-f10"]
+    assert cache.load_state()["shards"][3]["lastmod"] == "2000-01-03T00:00:00+00:00"
+
+
+def test_sitemap_endpoints(tmp_path, monkeypatch):
+    use_temp_db(tmp_path, monkeypatch)
+    Fiddle.save(Fiddle(id="x1", title="Hello"))
+    cache = SitemapCache(str(tmp_path / "sitemaps"), base_url="https://example.com")
+    monkeypatch.setattr(sitemap, "sitemaps", cache)
+    client = TestClient(app)
+
+    index = client.get("/sitemap.xml")
+    assert index.status_code == 200 and "https://example.com/sitemap-0.xml.gz" in index.text
+    shard = client.get("/sitemap-0.xml.gz")
+    assert shard.headers["content-type"] == "application/gzip"
+    assert b"https://example.com/hello-x1" in gzip.decompress(shard.content)
+    assert client.get("/sitemap-1.xml.gz").status_code == 404
@@ -0,0 +1,46 @@
+from db import ConnectionPool
+from startup import import_report, parse_importtime
+from templating import LazyTemplates
+
+
+def test_pool_creates_schema_on_first_use(tmp_path):
+    calls = []
+
+    def schema(conn):
+        calls.append(conn)
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS t (x)")
+
+    pool = ConnectionPool(str(tmp_path / "lazy.db"), schema=schema)
+    assert calls == [] and not (tmp_path / "lazy.db").exists()
+    for _ in range(3):
+        with pool.connection() as conn, conn:
+            conn.execute("INSERT INTO t VALUES (1)")
+    assert len(calls) == 1
+    pool.reset()
+    with pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 3
+    assert len(calls) == 2
+
+
+def test_import_report_splits_app_modules_from_packages():
+    modules = parse_importtime([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       100 |        100 |     jinja2.utils",
+        "import time:       300 |        400 |   jinja2",
+        "import time:      2000 |       2000 |   models",
+        "import time:      1500 |       3900 | main",
+    ])
+    assert modules["jinja2.utils"] == (100, 100) and modules["main"] == (1500, 3900)
+    report = import_report(modules)
+    assert [row["module"] for row in report["local"]] == ["main", "models"]
+    assert report["packages"] == [{"package": "jinja2", "ms": 0.4}]
+    assert report["total_ms"] == 3.9
+
+
+def test_templates_load_on_first_use(tmp_path):
+    (tmp_path / "hello.jinja2").write_text("hi {{ name }}")
+    templates = LazyTemplates(str(tmp_path))
+    assert templates._templates is None
+    assert templates.get_template("hello.jinja2").render(name="<b>") == "hi &lt;b&gt;"
+    assert templates._templates is not None
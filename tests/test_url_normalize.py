@@ -0,0 +1,55 @@
+import uuid
+
+from fastapi.testclient import TestClient
+
+import admin
+from main import app
+from mirror.url_normalize import KeyAliasTracker, key_aliases, normalize_url
+
+
+def test_normalize_url():
+    assert normalize_url("http://Example.COM:80/a?b=2&a=1") == "http://example.com/a?a=1&b=2"
+    assert normalize_url("http://example.com/a?utm_source=x&id=3&fbclid=y") == "http://example.com/a?id=3"
+    assert normalize_url("http://example.com?utm_medium=x") == "http://example.com/"
+    assert normalize_url("https://example.com:443/a#frag") == "https://example.com/a"
+    assert normalize_url("http://example.com:8080/a?q=a%20b&flag") == "http://example.com:8080/a?flag&q=a%20b"
+    assert normalize_url("http://example.com/Path/") == "http://example.com/Path/"
+    # Repeated names keep their order; only names are sorted.
+    assert normalize_url("http://example.com/?id=2&b=1&id=1") == "http://example.com/?b=1&id=2&id=1"
+    assert normalize_url("http://example.com/?id=1&id=2") != normalize_url("http://example.com/?id=2&id=1")
+
+
+def test_normalize_can_be_disabled():
+    url = "http://Example.com:80/a?b=2&a=1"
+    assert normalize_url(url, sort_query=False, lowercase_host=False, collapse_ports=False) == url
+
+
+def test_alias_tracker_counts_raw_variants():
+    tracker = KeyAliasTracker()
+    for raw in ("http://a.com/?x=1&y=2", "http://a.com/?y=2&x=1", "http://A.com/?x=1&y=2", "http://a.com/?x=1&y=2"):
+        tracker.record(raw, normalize_url(raw))
+    tracker.record("http://b.com/", "http://b.com/")
+    stats = tracker.stats()
+    assert stats["normalized_keys"] == 2
+    assert stats["distinct_raw_urls"] == 4
+    assert stats["top_keys"] == [("http://a.com/?x=1&y=2", 3)]
+
+
+def test_query_variants_share_one_upstream_fetch(origin):
+    path = "/data-%s.css" % uuid.uuid4().hex
+    origin.pages[path + "?a=1&b=2"] = ("text/css", b"p { margin: 0; }")
+    client = TestClient(app)
+    base = "/cats-d8c4vu/%s%s" % (origin.host, path)
+    assert client.get(base + "?b=2&a=1&utm_source=mail").status_code == 200
+    assert client.get(base + "?a=1&b=2").status_code == 200
+    assert origin.requests.count(path + "?a=1&b=2") == 1
+
+
+def test_top_aliased_urls_are_admin_only(monkeypatch):
+    key_aliases.record("http://a.com/?y=2&x=1", "http://a.com/?x=1&y=2")
+    key_aliases.record("http://a.com/?x=1&y=2", "http://a.com/?x=1&y=2")
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    client = TestClient(app)
+    assert client.get("/_stats/cache").json()["normalization"]["top_keys"] == []
+    top = client.get("/_stats/cache", headers={"x-admin-token": "secret"}).json()["normalization"]["top_keys"]
+    assert ["http://a.com/?x=1&y=2", 2] in top
@@ -0,0 +1,75 @@
+import asyncio
+import sqlite3
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+
+import models
+import warmup
+from db import ConnectionPool
+from main import app
+from mirror import cache_admin, mirror
+from models import Fiddle
+
+
+def test_warmup_loads_hot_entries_and_popular_start_pages(origin, tmp_path, monkeypatch):
+    monkeypatch.setattr(models, "pool", ConnectionPool(str(tmp_path / "users.db"), schema=models.create_schema))
+    hot_path = "/hot-%s.css" % uuid.uuid4().hex
+    origin.pages[hot_path] = ("text/css", b"a{}")
+    start_path = "/start-%s.html" % uuid.uuid4().hex
+    origin.pages[start_path] = ("text/html", b'<html><head><link rel="stylesheet" href="/s.css"></head></html>')
+    Fiddle.save(Fiddle(id="warm1", title="warm", start_url=origin.host + start_path))
+
+    client = TestClient(app)
+    for _ in range(2):
+        client.get("/cats-d8c4vu/%s%s" % (origin.host, hot_path))
+    mirror.cache_hits.flush()
+    mirror.hot_cache.clear()
+
+    report = client.get("/_ah/warmup").json()
+    steps = {step["step"]: step for step in report["steps"]}
+    assert [step["step"] for step in report["steps"]] == ["pools", "default_page", "hot_entries", "popular_fiddles"]
+    assert all(step["status"] == "ok" for step in report["steps"])
+    assert steps["hot_entries"]["loaded"] >= 1 and mirror.hot_cache.stats()["entries"] >= 1
+    assert steps["popular_fiddles"]["fiddles"] == 1 and steps["popular_fiddles"]["fetched"] == 1
+    assert steps["popular_fiddles"]["subresources"] == 1
+    assert start_path in origin.requests
+
+    # Already cached the second time round.
+    assert client.get("/warmup").json()["steps"][3]["cached"] == 1
+
+
+def test_warmup_keeps_to_its_budget(monkeypatch):
+    async def slow(deadline):
+        await asyncio.sleep(10)
+
+    async def fails(deadline):
+        raise RuntimeError("boom")
+
+    async def quick(deadline):
+        return {"done": 1}
+
+    monkeypatch.setattr(warmup, "steps", [])
+    warmup.register("quick", quick, order=2)
+    warmup.register("fails", fails, order=1)
+    warmup.register("slow", slow, order=3)
+    warmup.register("late", quick, order=4)
+    report = asyncio.run(warmup.run(budget=0.2))
+    assert [(s["step"], s["status"]) for s in report["steps"]] == [
+        ("fails", "error"), ("quick", "ok"), ("slow", "timeout"), ("late", "skipped")]
+    assert report["steps"][1]["done"] == 1 and report["ms"] < 1000
+
+
+def test_hot_entries_come_from_the_hits_index(tmp_path, monkeypatch):
+    conn = sqlite3.connect(str(tmp_path / "cache.db"))
+    mirror.create_schema(conn)
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN SELECT key_name FROM mirrored_content "
+                                           "ORDER BY hits DESC LIMIT 10")]
+    assert plan == ["SCAN mirrored_content USING INDEX mirrored_content_hits"]
+
+    def no_query(*args):
+        raise AssertionError("queried after the deadline")
+
+    monkeypatch.setattr(cache_admin, "top_keys", no_query)
+    assert mirror.load_hot_entries(10, time.monotonic() - 1) == {"candidates": 0, "loaded": 0, "bytes": 0}
@@ -0,0 +1,116 @@
+"""Per-request stage timing.
+
+Handlers wrap expensive steps in ``with timing.stage("name"):`` and the
+TimingMiddleware reports the totals back to the client in a
+``Server-Timing`` header.  Outside of a request the helpers are no-ops.
+
+Functions in ``request_listeners`` are called as
+``listener(timing, status, content_type, body_bytes)`` after each request;
+by then the time spent sending the response is recorded as stage "write".
+Handlers can attach details for them with ``timing.annotate(key=value)``.
+"""
+import logging
+import contextvars
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("request_timing", default=None)
+
+request_listeners = []
+
+
+class RequestTiming(object):
+    def __init__(self, path="", method="GET", query=""):
+        self.path = path
+        self.method = method
+        self.query = query
+        # Route template, e.g. "/{fiddle_name}/{base_url:path}"; set once routing is done.
+        self.route = None
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tags = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        parts = ["%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in self.stages.items()]
+        parts.append("total;dur=%.1f" % (self.elapsed() * 1000))
+        return ", ".join(parts)
+
+
+def current():
+    return _current.get()
+
+
+def detach():
+    """Stop attributing work in this task to the request that started it."""
+    _current.set(None)
+
+
+def annotate(**tags):
+    """Attach details (fiddle, origin, cache outcome...) to the current request."""
+    timing = _current.get()
+    if timing is not None:
+        timing.tags.update(tags)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage ``name`` of the current request."""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start)
+
+
+class TimingMiddleware(object):
+    """ASGI middleware that starts a RequestTiming for every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming(scope.get("path", ""), scope.get("method", "GET"),
+                               scope.get("query_string", b"").decode("latin-1"))
+        token = _current.set(timing)
+        response = {"status": 500, "content_type": None, "bytes": 0, "started": None}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["started"] = time.perf_counter()
+                headers = list(message.get("headers", []))
+                for name, value in headers:
+                    if name.lower() == b"content-type":
+                        response["content_type"] = value.decode("latin-1")
+                headers.append((b"server-timing", timing.server_timing().encode("latin-1")))
+                message = dict(message, headers=headers)
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            if response["started"] is not None:
+                timing.add("write", time.perf_counter() - response["started"])
+            timing.route = getattr(scope.get("route"), "path", None)
+            for listener in request_listeners:
+                try:
+                    listener(timing, response["status"], response["content_type"], response["bytes"])
+                except Exception:
+                    logging.exception("Request listener failed")
@@ -0,0 +1,56 @@
+"""Instance warmup: do the first users' work before they arrive.
+
+App Engine sends ``/_ah/warmup`` to a new instance before routing traffic
+to it (``inbound_services: warmup`` in app.yaml); ``/warmup`` runs the same
+thing by hand.  Modules register steps with ``register(name, fn, order)``;
+each ``fn(deadline)`` is a coroutine returning a dict of what it did.
+
+Steps run in order within WARMUP_SECONDS.  A step that fails or runs out of
+time is logged and the steps after it still get whatever time is left, so
+warmup never fails the instance; the returned report lists every step's
+outcome and time.
+"""
+import asyncio
+import logging
+import os
+import time
+
+WARMUP_SECONDS = float(os.environ.get("WARMUP_SECONDS", 8))
+
+# [order, name, fn]
+steps = []
+
+
+def register(name, fn, order=50):
+    steps.append([order, name, fn])
+    steps.sort(key=lambda step: step[0])
+
+
+def remaining(deadline):
+    return max(0.0, deadline - time.monotonic())
+
+
+async def run(budget=WARMUP_SECONDS):
+    started = time.monotonic()
+    deadline = started + budget
+    report = []
+    for _, name, fn in list(steps):
+        step_started = time.monotonic()
+        entry = {"step": name}
+        if remaining(deadline) <= 0:
+            entry["status"] = "skipped"
+        else:
+            try:
+                entry.update(await asyncio.wait_for(fn(deadline), remaining(deadline)) or {})
+                entry["status"] = "ok"
+            except asyncio.TimeoutError:
+                entry["status"] = "timeout"
+            except Exception as e:
+                logging.exception("Warmup step %s failed", name)
+                entry["status"] = "error"
+                entry["error"] = str(e)
+        entry["ms"] = round((time.monotonic() - step_started) * 1000, 1)
+        logging.info("Warmup %s: %s in %.0f ms", name, entry["status"], entry["ms"])
+        report.append(entry)
+    return {"status": "ok", "ms": round((time.monotonic() - started) * 1000, 1), "budget_ms": budget * 1000,
+            "steps": report}